@@ -1,11 +1,23 @@
-import serial
 import time
+startup_start = time.perf_counter()
+import os
 import PyQt5.QtWidgets as qtw
-from PyQt5 import QtGui
-import mysql.connector
-import pandas as pd
-import qdarkstyle
-import threading
+from PyQt5 import QtGui, QtCore
+import collections
+import logging
+import batch
+import calibration
+import database
+import discovery
+import liveplot
+import metrics
+from core import (Arduino, ArduinoSession, Run, load_rigs, tare_steps, force_steps,
+    home_steps, move_steps, calibration_steps, test_steps, batch_steps,
+    extend, retract)
+import recipes
+from curvestore import CurveStore
+from journal import Journal, SyncWorker
+from testsmodel import TestsModel
 
 
 ######################################################################################################################
@@ -14,14 +26,107 @@ import threading
 ######################################################################################################################
 ######################################################################################################################
 
-extend = 11
-retract = 10
-fullspeed = 255.0
-halfspeed = 127.0
-quarterspeed = 63.75
-default_pausetime = 5
-default_forcestop = 2
-perm_offset = 14.76
+
+#################################################  RIGS ########################################
+class Rig():
+    def __init__(self, name, serial_port, arduino=None, calibrations=None):
+        """
+        One test station: its serial session (which owns the port, the
+        reader thread and the force stream), its newest calibration from
+        `calibrations` and a thread pool of its own with a single worker,
+        so one rig's jobs queue behind each other but never wait on another
+        rig's
+        """
+        self.name = name
+        self.serial_port = serial_port
+        self.calibrations = calibrations if calibrations is not None else calibration.History()
+        self.session = ArduinoSession(serial_port, arduino=arduino,
+            calibration=self.calibrations.current(name))
+        self.pool = QtCore.QThreadPool()
+        self.pool.setMaxThreadCount(1)
+        self.job = None
+
+    def start(self, job):
+        self.job = job
+        self.pool.start(job)
+
+    def status(self):
+        if self.job is not None:
+            return 'running'
+        a = self.session.arduino
+        if a is None:
+            return 'not connected'
+        return 'ready' if a.failout == 'good conn' else 'disconnected'
+
+    def close(self, timeout=5000):
+        if self.job is not None:
+            self.job.abort()
+        self.pool.waitForDone(timeout)
+        self.session.close()
+
+    def reattach(self, serial_port, arduino=None):
+        """
+        Points an idle rig at the port it was plugged back in on
+        """
+        self.session.close()
+        self.serial_port = serial_port
+        self.session.serial_port = serial_port
+        self.session.arduino = arduino
+
+
+class RigRegistry():
+    def __init__(self, rigs=None):
+        """
+        The rigs this process drives, by name, in the order they were added.
+        Without a configured list, the rigs discovery has cached as attached
+        are added straight away and watch() finds the rest
+        """
+        self.rigs = collections.OrderedDict()
+        self.calibrations = calibration.History()
+        self.discovery = None
+        if rigs is None:
+            rigs = load_rigs()
+        if rigs is None:
+            self.discovery = discovery.Discovery(Arduino)
+            rigs = self.discovery.known()
+        for name, serial_port in rigs:
+            self.add(name, serial_port)
+
+    def add(self, name, serial_port, arduino=None):
+        if name in self.rigs:
+            raise ValueError('rig ' + repr(name) + ' already registered')
+        rig = Rig(name, serial_port, arduino, self.calibrations)
+        self.rigs[name] = rig
+        return rig
+
+    def watch(self, added, removed, failed=None):
+        """
+        Hot-plugs rigs: calls added(name, port, arduino) for each rig found,
+        removed(name) for each unplugged and failed(error) for a port scan
+        that failed, from the discovery thread
+        """
+        if self.discovery is not None:
+            self.discovery.watch(added, removed, failed)
+
+    def remove(self, name):
+        rig = self.rigs.pop(name)
+        rig.close()
+        return rig
+
+    def __getitem__(self, name):
+        return self.rigs[name]
+
+    def __iter__(self):
+        return iter(self.rigs.values())
+
+    def __len__(self):
+        return len(self.rigs)
+
+    def close(self):
+        if self.discovery is not None:
+            self.discovery.stop()
+        for rig in self.rigs.values():
+            rig.close()
 
 ######################################################################################################################
 ######################################################################################################################
@@ -29,62 +134,64 @@ perm_offset = 14.76
 ######################################################################################################################
 ######################################################################################################################
 
-#################################################  SERIAL COMMUNICATION CLASS ########################################
-class Arduino():
-    def __init__(self, serial_port='COM3', baud_rate=9600,
-            read_timeout=5):
+
+#################################################  TEST SEQUENCES ##################################################
+class WorkerSignals(QtCore.QObject):
+    progress = QtCore.pyqtSignal(int)
+    result = QtCore.pyqtSignal(str, object, str)
+    curve = QtCore.pyqtSignal(str, object)
+    failed = QtCore.pyqtSignal(str, str)
+    finished = QtCore.pyqtSignal()
+
+
+class TestJob(QtCore.QRunnable):
+    def __init__(self, steps, *args):
         """
-        Initializes the serial connection to the Arduino board
+        Runs a sequence of steps (see core.Run) on the Qt thread pool. What
+        the steps report reaches the GUI through self.signals
         """
+        super().__init__()
+        self.signals = WorkerSignals()
+        self.test = Run(steps, *args, progress=self.signals.progress.emit,
+            result=self.signals.result.emit, record=self.signals.curve.emit)
+
+    def run(self):
         try:
-            self.conn = serial.Serial(serial_port, baud_rate)
-            self.conn.timeout = read_timeout # Timeout for readline()
-            self.failout = 'good conn'
-        
-        except:
-            self.failout = 'failed out of arduino'
-
-    def gohome(self):
-        command = (''.join(('WH', str(0), ':', str(0)))).encode()
-        self.conn.write(command)
-
-    def go_the_distance(self, pin_number, distance, speedvalue):
-        command = (''.join(('WG', str(pin_number), ':',
-            str(distance),':', str(speedvalue)))).encode()
-        self.conn.write(command)
-
-    def force_stop(self, force, offset):
-        command = (''.join(('WF', str(0), ':',
-            str(force), ':', str(offset)))).encode()
-        self.conn.write(command)
-        line_received = self.conn.readline().decode().strip()
-        return line_received
-
-    def stop(self):
-        command = (''.join(('WS', str(0), ':',
-            str(0)))).encode()
-        self.conn.write(command)
+            failure = self.test.execute()
+            if failure is not None:
+                self.signals.failed.emit(*failure)
+        finally:
+            self.signals.finished.emit()
 
-    def close(self):
-        self.conn.close()
+    def cancel(self):
+        self.test.cancel()
 
-    def read(self, offset):
-        command = (''.join(('RF', str(0), ':', str(offset)))).encode()
-        self.conn.write(command) 
-        line_received = self.conn.readline().decode().strip()
-        return line_received
+    def abort(self):
+        self.test.abort()
 
-    def tare(self):
-        command = (''.join(('RT', str(0), ':', str(0)))).encode()
-        self.conn.write(command)
-        line_received = self.conn.readline().decode().strip()
-        return line_received
 
-    def calib(self, spring):
-        command = (''.join(('WC', str(0), ':',
-            str(spring), ':', str(0)))).encode()
-        self.conn.write(command)
-        return
+class CommitSignals(QtCore.QObject):
+    done = QtCore.pyqtSignal(object, str)
+
+
+class CommitJob(QtCore.QRunnable):
+    def __init__(self, journal, curvestore, sample, operator, test_date, test_names):
+        """
+        Commits a finished batch sample off the GUI thread, so the next
+        sample can start while its curves are written
+        """
+        super().__init__()
+        self.args = (journal, curvestore, sample, operator, test_date, test_names)
+        self.sample = sample
+        self.signals = CommitSignals()
+
+    def run(self):
+        try:
+            batch.commit_sample(*self.args)
+        except Exception as error:
+            self.signals.done.emit(self.sample, str(error))
+        else:
+            self.signals.done.emit(self.sample, '')
 
 ######################################################################################################################
 ######################################################################################################################
@@ -94,17 +201,30 @@ class Arduino():
 
 
 #################################################  GUI CONSTRUCTION ########################################
-class MainWindow(qtw.QWidget):
-    def __init__(self):
-
+class StationPanel(qtw.QWidget):
+    def __init__(self, rig, journal, syncer, curvestore):
+        """
+        The controls and results of one rig. Every panel commits through the
+        same journal and sync thread
+        """
         super().__init__()
-        self.setStyleSheet(qdarkstyle.load_stylesheet_pyqt5())
+        self.rig = rig
+        self.session = rig.session
+        self.job = None
+        self.curves = {}
+        self.curvestore = curvestore
+        self.journal = journal
+        self.syncer = syncer
+        #the imported sample list, the batch running through it and the
+        #sample on the rig
+        self.samples = []
+        self.batch = None
+        self.batchsample = None
 
         ######## Layout Management ########
         #set main layout
         mainlayout = qtw.QGridLayout()
         self.setLayout(mainlayout)
-        self.setWindowTitle("Universal Foam Tester")
         #setup sublayouts
         topboxlayout = qtw.QHBoxLayout()
         leftbuttonlayout = qtw.QVBoxLayout()
@@ -128,31 +248,44 @@ class MainWindow(qtw.QWidget):
 
         ##Test Selection
         #define the test selection
+        #one entry per recipe under recipes/
+        skipped = []
+        self.recipes = recipes.load_all(skipped=skipped)
         self.testchoose = qtw.QComboBox()
         self.testchoose.addItem("Choose Test")
-        self.testchoose.addItem("Firmness")
-        self.testchoose.addItem("Firmness (local)")
-        self.testchoose.addItem("Support Factor")
-        # self.testchoose.addItem("Support Factor")
-        # self.testchoose.addItem("Hysteresis")
+        for recipe in self.recipes:
+            self.testchoose.addItem(recipe.name)
         test_l = qtw.QLabel('&Test:')
         test_l.setBuddy(self.testchoose)
         #add the widgets to the topboxlayout
         topboxlayout.addWidget(test_l)
         topboxlayout.addWidget(self.testchoose)
+        #recipes that didn't load are named, with why, in the tooltip
+        if skipped:
+            skippedlabel = qtw.QLabel(str(len(skipped)) + " recipe(s) skipped")
+            skippedlabel.setToolTip("\n".join(os.path.basename(path) + ": " + error for path, error in skipped))
+            topboxlayout.addWidget(skippedlabel)
 
         ##Start/Stop Buttons
         #define the start/stop widgets
         self.startbutton = qtw.QPushButton("Start Test", clicked = lambda: self.test_initiate())
+        self.cancelbutton = qtw.QPushButton("Cancel Test", clicked = lambda: self.cancel_test())
+        self.abortbutton = qtw.QPushButton("Abort", clicked = lambda: self.abort_test())
+        self.cancelbutton.setEnabled(False)
+        self.abortbutton.setEnabled(False)
         #add the widgets to the leftbuttonlayout
         leftbuttonlayout.addWidget(self.startbutton)
+        leftbuttonlayout.addWidget(self.cancelbutton)
+        leftbuttonlayout.addWidget(self.abortbutton)
         
         ##Force/Displ Display
         #define the display widgets
         self.forcereading = qtw.QLabel('0.0')
-        self.forcebutton = qtw.QPushButton("Display Force",  clicked = lambda: self.thread2())
-        self.tare_button = qtw.QPushButton("Set Tare", clicked = lambda: self.thread())
-        self.tare_label = qtw.QLabel('0.0')
+        self.forcebutton = qtw.QPushButton("Display Force",  clicked = lambda: self.display_force())
+        self.tare_button = qtw.QPushButton("Set Tare", clicked = lambda: self.set_tare())
+        self.tare_label = qtw.QLabel('not tared')
+        #the last drift alert the operator was shown
+        self.tare_alert = None
         
 
         #add the widgets to the displaylayout
@@ -160,6 +293,9 @@ class MainWindow(qtw.QWidget):
         displaylayout.addWidget(self.forcereading, 0, 1)
         displaylayout.addWidget(self.tare_button, 1, 0)
         displaylayout.addWidget(self.tare_label, 1, 1)
+        #keep the force label live while the board is streaming
+        self.forcetimer = QtCore.QTimer(self, timeout = self.update_force)
+        self.forcetimer.start(100)
 
         ##Extend/Retract Radio Buttons
         #define the radiobutton widgets
@@ -225,35 +361,83 @@ class MainWindow(qtw.QWidget):
         tab1hbox.addWidget(self.support_calc, 2, 3)
         tab1hbox.addWidget(firmness_l_label, 3, 2)
         tab1hbox.addWidget(self.firmness_l_calc, 3, 3)
-        tab1hbox.addWidget(self.enterbutton, 4, 3)
-        tab1hbox.addWidget(proglabel, 4, 0)
-        tab1hbox.addWidget(self.pbar, 4, 1, 1, 2)
+        #results of other recipes get a row here the first time they run
+        self.extraresults = qtw.QFormLayout()
+        tab1hbox.addLayout(self.extraresults, 4, 2, 1, 2)
+        tab1hbox.addWidget(self.enterbutton, 5, 3)
+        tab1hbox.addWidget(proglabel, 5, 0)
+        tab1hbox.addWidget(self.pbar, 5, 1, 1, 2)
+        self.results = collections.OrderedDict((
+            ('firmness', (self.firmness_calc, 'firmness (N)')),
+            ('firmness_local', (self.firmness_l_calc, 'firmness (N) (local)')),
+            ('support', (self.support_calc, 'support factor (N/N)'))))
 
         ## Tab2
-        self.table = qtw.QTableWidget(10, 10)
-        self.table.setAlternatingRowColors(True)
-        #define back end widgets
-        tab2hbox.setContentsMargins(5, 5, 5, 5)
-        tab2hbox.addWidget(self.table)
-        conn = mysql.connector.connect(host = 'localhost', user = 'root', passwd = 'password', database = 'foam')
-        query = """select * from tests order by sample_id desc"""
-        df = pd.read_sql(query, conn)
-        self.table.setHorizontalHeaderLabels(df.columns)
-        for row in df.iterrows():
-            values = row[1]
-            for col_index, value in enumerate(values):
-                tableItem = qtw.QTableWidgetItem(str(value))
-                self.table.setItem(row[0], col_index, tableItem)
+        #define widgets for batch tab, the checked tests run on every sample
+        self.importbutton = qtw.QPushButton("Import Samples...", clicked = lambda: self.import_samples())
+        self.batchfile = qtw.QLabel("No samples imported")
+        self.batchtable = qtw.QTableWidget(0, 5)
+        self.batchtable.setHorizontalHeaderLabels(['Sample ID', 'DOE_ID', 'Thickness (mm)', 'Status', 'Results'])
+        self.batchtable.setEditTriggers(qtw.QAbstractItemView.NoEditTriggers)
+        self.batchtable.horizontalHeader().setStretchLastSection(True)
+        self.batchrecipes = qtw.QListWidget()
+        for recipe in self.recipes:
+            item = qtw.QListWidgetItem(recipe.name)
+            item.setFlags(item.flags() | QtCore.Qt.ItemIsUserCheckable)
+            item.setCheckState(QtCore.Qt.Unchecked)
+            self.batchrecipes.addItem(item)
+        self.batchstart = qtw.QPushButton("Start Batch", clicked = lambda: self.start_batch())
+        self.batchnext = qtw.QPushButton("Next Sample", clicked = lambda: self.next_sample())
+        self.batchstop = qtw.QPushButton("Stop Batch", clicked = lambda: self.stop_batch())
+        self.batchnext.setEnabled(False)
+        self.batchstop.setEnabled(False)
+        self.batchprompt = qtw.QLabel("Import a sample list (CSV with sample_id, DOE_ID and thickness columns)")
+        #define tab layout
+        tab2hbox.addWidget(self.importbutton, 0, 0)
+        tab2hbox.addWidget(self.batchfile, 0, 1)
+        tab2hbox.addWidget(self.batchtable, 1, 0, 4, 2)
+        tab2hbox.addWidget(qtw.QLabel("Tests:"), 0, 2)
+        tab2hbox.addWidget(self.batchrecipes, 1, 2)
+        tab2hbox.addWidget(self.batchstart, 2, 2)
+        tab2hbox.addWidget(self.batchnext, 3, 2)
+        tab2hbox.addWidget(self.batchstop, 4, 2)
+        tab2hbox.addWidget(self.batchprompt, 5, 0, 1, 3)
+        tab2hbox.setColumnStretch(1, 1)
 
         ## Tab3
-        #define entry widgets for test tab
-        self.calibrate = qtw.QPushButton("Run Calibration", clicked = lambda: self.calibration())
+        #define entry widgets for calibration tab, one point per known load
+        self.capture = calibration.Capture(rig.name)
+        self.capture_load = None
+        self.fitted = None
+        self.calib_label = qtw.QLabel('')
+        self.calib_label.setWordWrap(True)
+        self.load_entry = qtw.QLineEdit()
+        load_label = qtw.QLabel("Known load (N):")
+        self.capturebutton = qtw.QPushButton("Capture Point", clicked = lambda: self.capture_point())
+        self.pointtable = qtw.QTableWidget(0, 4)
+        self.pointtable.setHorizontalHeaderLabels(['Load (N)', 'Readings', 'Mean', 'Std Dev'])
+        self.pointtable.setEditTriggers(qtw.QAbstractItemView.NoEditTriggers)
+        self.fitbutton = qtw.QPushButton("Fit", clicked = lambda: self.fit_calibration())
+        self.savecalib = qtw.QPushButton("Save Calibration", clicked = lambda: self.save_calibration())
+        self.clearpoints = qtw.QPushButton("Clear Points", clicked = lambda: self.clear_points())
+        self.fit_label = qtw.QLabel("Tare with the load cell clear, then capture each known load"
+            " on the way up and again on the way down")
+        self.fit_label.setWordWrap(True)
         #define tab layout
-        tab3hbox.addWidget(self.calibrate, 0,0)
+        tab3hbox.addWidget(self.calib_label, 0, 0, 1, 4)
+        tab3hbox.addWidget(load_label, 1, 0)
+        tab3hbox.addWidget(self.load_entry, 1, 1)
+        tab3hbox.addWidget(self.capturebutton, 1, 2)
+        tab3hbox.addWidget(self.pointtable, 2, 0, 3, 3)
+        tab3hbox.addWidget(self.fitbutton, 2, 3)
+        tab3hbox.addWidget(self.savecalib, 3, 3)
+        tab3hbox.addWidget(self.clearpoints, 4, 3)
+        tab3hbox.addWidget(self.fit_label, 5, 0, 1, 4)
+        self.show_calibration()
     
         #add tabs to widget
         self.entryfields.addTab(tab1, "&Test Results")
-        self.entryfields.addTab(tab2, "Test Database")
+        self.entryfields.addTab(tab2, "&Batch")
         self.entryfields.addTab(tab3, "Device Calibration")
     
         ######## Add Sublayouts to MainLayout ########
@@ -264,8 +448,14 @@ class MainWindow(qtw.QWidget):
         mainlayout.addLayout(displacementlayout, 1, 1)
         mainlayout.addLayout(buttonlayout, 2, 1)
         mainlayout.addWidget(self.entryfields, 3, 0, 1, 2)
-    
-        self.show()
+        #live force against time and displacement, cleared as each test starts
+        self.timeplot = liveplot.ForcePlot(self.session.stream, 'time')
+        self.positionplot = liveplot.ForcePlot(self.session.stream, 'position')
+        plotlayout = qtw.QVBoxLayout()
+        plotlayout.addWidget(self.timeplot)
+        plotlayout.addWidget(self.positionplot)
+        mainlayout.addLayout(plotlayout, 0, 2, 4, 1)
+        mainlayout.setColumnStretch(2, 1)
 
 ######################################################################################################################
 ######################################################################################################################
@@ -277,141 +467,113 @@ class MainWindow(qtw.QWidget):
 #################################################  FORCE CELL COMMUNICATION FUNCTIONS ################################
     
     def set_tare(self):
-        self.click()
-        a = Arduino()
-        if a.failout == 'failed out of arduino':
-            noent = qtw.QMessageBox()
-            noent.setIcon(qtw.QMessageBox.Warning)
-            noent.setText("Check USB Connections")
-            noent.setWindowTitle("No Serial Connect")
-            noent.setStandardButtons(qtw.QMessageBox.Ok)
-            noent.buttonClicked.connect(self.unclick)
-            noent.exec()
-            return
-        else:
-            time.sleep(2)
-            offset = a.tare()
-            offset = a.tare()
-            offset = a.tare()
-            self.tare_label.setText(offset)
-            a.close()
-            self.unclick()
+        self.run_job(tare_steps)
         return
 
     def display_force(self):
-        self.click()
-        if float(self.tare_label.text()) > -1.0:
+        if self.session.tare.offset is None:
             self.tare_check()
         else:
-            a = Arduino()
-            if a.failout == 'failed out of arduino':
-                noent = qtw.QMessageBox()
-                noent.setIcon(qtw.QMessageBox.Warning)
-                noent.setText("Check USB Connections")
-                noent.setWindowTitle("No Serial Connect")
-                noent.setStandardButtons(qtw.QMessageBox.Ok)
-                noent.buttonClicked.connect(self.unclick)
-                noent.exec()
-                return
-            else:
-                time.sleep(2)
-                offset = self.tare_label.text()
-                for i in range(1):
-                    force = float(a.read(offset)) - perm_offset
-                self.forcereading.setText(str(round(force, 1)))
-                a.close()
-                self.unclick()
+            self.run_job(force_steps)
         return
 
+    def update_force(self):
+        force = self.session.stream.latest()
+        if force is not None:
+            self.forcereading.setText(str(round(force, 1)))
+        self.show_tare()
+        return
+
+    def show_tare(self):
+        tare = self.session.tare
+        self.tare_label.setText(tare.describe())
+        self.tare_label.setToolTip(tare.alert or '')
+        if tare.alert is not None and self.tare_alert is None and self.job is None:
+            #once per drift past the limit, and never over a running test
+            self.tare_alert = tare.alert
+            noent = qtw.QMessageBox()
+            noent.setIcon(qtw.QMessageBox.Warning)
+            noent.setText(tare.alert + ", clear the load cell and set tare")
+            noent.setWindowTitle(self.rig.name + ": Zero Drift")
+            noent.setStandardButtons(qtw.QMessageBox.Ok)
+            noent.exec()
+        elif tare.alert is None:
+            self.tare_alert = None
+        return
 
     def tare_check(self):
         noent = qtw.QMessageBox()
         noent.setIcon(qtw.QMessageBox.Warning)
-        noent.setText("Set tare with no weight")
+        noent.setText("Home the platen or set tare with no weight")
         noent.setWindowTitle("Load calibration")
         noent.setStandardButtons(qtw.QMessageBox.Ok)
         noent.exec()
         return
 
-    def calibration(self):
-        commence = qtw.QMessageBox()
-        commence.setIcon(qtw.QMessageBox.Question)
-        commence.setText("Proceed with Calibration?\nEnsure that the load cell is clear and the desired spring is loaded for calibration")
-        commence.setWindowTitle("Proceed")
-        commence.setStandardButtons(qtw.QMessageBox.Ok | qtw.QMessageBox.No)
-        commence.buttonClicked.connect(self.calibration_1)
-        commence.exec()
+    def show_calibration(self):
+        current = self.session.calibration
+        if current.version:
+            self.calib_label.setText("Calibration " + current.label + " of " + str(current.created)
+                + (" by " + current.operator if current.operator else "") + ": " + current.describe())
+        else:
+            self.calib_label.setText("Not calibrated, readings only have the default offset removed")
         return
 
-    def calibration_1(self, i):
-        self.click()
-        if i.text() == 'OK':
-            a = Arduino()
-            if a.failout == 'failed out of arduino':
-                noent = qtw.QMessageBox()
-                noent.setIcon(qtw.QMessageBox.Warning)
-                noent.setText("Check USB Connections")
-                noent.setWindowTitle("No Serial Connect")
-                noent.setStandardButtons(qtw.QMessageBox.Ok)
-                noent.buttonClicked.connect(self.unclick)
-                noent.exec()
-                return
-            else:
-                time.sleep(2)
-                spring_force = 101.69
-                a.calib(spring_force)
-                for x in range(15):
-                    print(a.conn.readline().decode().strip())
-                
-                a.go_the_distance(retract, 40, fullspeed)
-                a.close()
-            self.unclick()
-            return
-
-    def set_tare(self):
-        self.click()
-        a = Arduino()
-        if a.failout == 'failed out of arduino':
+    def capture_point(self):
+        try:
+            self.capture_load = float(self.load_entry.text())
+        except ValueError:
             noent = qtw.QMessageBox()
             noent.setIcon(qtw.QMessageBox.Warning)
-            noent.setText("Check USB Connections")
-            noent.setWindowTitle("No Serial Connect")
+            noent.setText("Enter the known load in N")
+            noent.setWindowTitle("Blank Entry")
             noent.setStandardButtons(qtw.QMessageBox.Ok)
-            noent.buttonClicked.connect(self.unclick)
             noent.exec()
             return
-        else:
-            time.sleep(2)
-            offset = a.tare()
-            self.tare_label.setText(offset)
-            a.close()
-            self.unclick()
+        if self.tare_ready():
+            self.run_job(calibration_steps)
+        return
+
+    def add_point(self, readings):
+        try:
+            self.capture.add(self.capture_load, readings)
+        except calibration.CalibrationError as error:
+            self.fit_label.setText(str(error))
             return
-    
-    def display_force(self):
-        self.click()
-        if float(self.tare_label.text()) > -1.0:
-            self.tare_check()
-        else:
-            a = Arduino()
-            if a.failout == 'failed out of arduino':
-                noent = qtw.QMessageBox()
-                noent.setIcon(qtw.QMessageBox.Warning)
-                noent.setText("Check USB Connections")
-                noent.setWindowTitle("No Serial Connect")
-                noent.setStandardButtons(qtw.QMessageBox.Ok)
-                noent.buttonClicked.connect(self.unclick)
-                noent.exec()
-                return
-            else:
-                time.sleep(2)
-                offset = self.tare_label.text()
-                for i in range(4):
-                    force = float(a.read(offset)) - perm_offset
-                self.forcereading.setText(str(round(force, 5)))
-                a.close()
-            self.unclick()
+        load, readings = self.capture.points[-1]
+        row = self.pointtable.rowCount()
+        self.pointtable.insertRow(row)
+        for column, text in enumerate(('%g' % load, str(len(readings)),
+                '%.3f' % readings.mean(), '%.3f' % readings.std())):
+            self.pointtable.setItem(row, column, qtw.QTableWidgetItem(text))
+        self.fitted = None
+        return
+
+    def fit_calibration(self):
+        try:
+            self.fitted = self.capture.fit(self.opID_entry.text())
+        except calibration.CalibrationError as error:
+            self.fit_label.setText(str(error))
+            return
+        self.fit_label.setText("Fit: " + self.fitted.describe() + ". Save it to use it")
+        return
+
+    def save_calibration(self):
+        if self.fitted is None:
+            self.fit_label.setText("Capture the points and fit them first")
             return
+        saved = self.rig.calibrations.save(self.fitted)
+        self.session.calibration = saved
+        self.clear_points()
+        self.fit_label.setText("Saved as " + saved.label)
+        self.show_calibration()
+        return
+
+    def clear_points(self):
+        self.capture = calibration.Capture(self.rig.name)
+        self.fitted = None
+        self.pointtable.setRowCount(0)
+        return
 
 
 ######################################################################################################################
@@ -425,22 +587,7 @@ class MainWindow(qtw.QWidget):
     
 
     def home_function(self):
-        self.click()
-        a = Arduino()
-        if a.failout == 'failed out of arduino':
-            noent = qtw.QMessageBox()
-            noent.setIcon(qtw.QMessageBox.Warning)
-            noent.setText("Check USB Connections")
-            noent.setWindowTitle("No Serial Connect")
-            noent.setStandardButtons(qtw.QMessageBox.Ok)
-            noent.buttonClicked.connect(self.unclick)
-            noent.exec()
-            return
-        else:
-            time.sleep(2)
-            a.gohome()
-            a.close()
-            self.unclick()
+        self.run_job(home_steps)
         return
 
     def test_initiate(self):
@@ -451,206 +598,60 @@ class MainWindow(qtw.QWidget):
             nochoose.setWindowTitle("No test selected")
             nochoose.setStandardButtons(qtw.QMessageBox.Ok)
             nochoose.exec()
-        if self.testchoose.currentIndex() == 1:
-            self.firmness()
-        elif self.testchoose.currentIndex() == 2:
-            self.firmness_l()
-        elif self.testchoose.currentIndex() == 3:
-            self.support()
-        return
-
-    def firmness(self):
-        a = Arduino()
-        if a.failout == 'failed out of arduino':
-                noent = qtw.QMessageBox()
-                noent.setIcon(qtw.QMessageBox.Warning)
-                noent.setText("Check USB Connections")
-                noent.setWindowTitle("No Serial Connect")
-                noent.setStandardButtons(qtw.QMessageBox.Ok)
-                noent.buttonClicked.connect(self.unclick)
-                noent.exec()
-                return
         else:
-            time.sleep(2)
-            offset = self.tare_label.text()
-            if (-50000 > float(offset) > -1):
-                self.tare_check()
-            else:
-                if not self.th_entry.text():
-                    self.thickness_check()
-                else:
-                    a.force_stop(default_forcestop, offset)
-                    a.close()
-                    commence = qtw.QMessageBox()
-                    commence.setIcon(qtw.QMessageBox.Question)
-                    commence.setText("Proceed with measurement?")
-                    commence.setWindowTitle("Proceed")
-                    commence.setStandardButtons(qtw.QMessageBox.Ok | qtw.QMessageBox.No)
-                    commence.buttonClicked.connect(self.firmness_1)
-                    commence.exec()
-            a.close()
-
-    def firmness_1(self, i):
-        self.click()
-        if i.text() == 'OK':
-            pausetime = default_pausetime
-            offset = self.tare_label.text()
-            a = Arduino()
-            if a.failout == 'failed out of arduino':
-                noent = qtw.QMessageBox()
-                noent.setIcon(qtw.QMessageBox.Warning)
-                noent.setText("Check USB Connections")
-                noent.setWindowTitle("No Serial Connect")
-                noent.setStandardButtons(qtw.QMessageBox.Ok)
-                noent.buttonClicked.connect(self.unclick)
-                noent.exec()
-                return
-            else:
-                time.sleep(2)
-                thickness = self.th_entry.text()
-                twofive_distance = 0.25*float(thickness)
-                a.go_the_distance(extend, twofive_distance, 20)
-                time.sleep(pausetime)
-                force = float(a.read(offset)) - perm_offset
-                self.firmness_calc.setText((str(round(force, 1))))
-                time.sleep(0.1)
-                a.go_the_distance(retract, (10), fullspeed)
-                a.close()
-                # for i in range(100):
-                #     time.sleep(0.1)
-                #     self.pbar.setValue(i)
-            self.unclick()
+            recipe = self.recipes[self.testchoose.currentIndex() - 1]
+            self.test_check(lambda i: self.recipe_1(i, recipe))
         return
-        
-    def firmness_l(self):
-        a = Arduino()
-        if a.failout == 'failed out of arduino':
-            noent = qtw.QMessageBox()
-            noent.setIcon(qtw.QMessageBox.Warning)
-            noent.setText("Check USB Connections")
-            noent.setWindowTitle("No Serial Connect")
-            noent.setStandardButtons(qtw.QMessageBox.Ok)
-            noent.buttonClicked.connect(self.unclick)
-            noent.exec()
+
+    def test_check(self, proceed):
+        """
+        Checks the tare and thickness before asking the operator to start,
+        then hands the answer to `proceed`. The board is only reached from
+        the job, so a missing one is reported when the test runs
+        """
+        if not self.tare_ready():
             return
+        if not self.th_entry.text():
+            self.thickness_check()
         else:
-            time.sleep(2)
-            offset = self.tare_label.text()
-            if (-50000 > float(offset) > -1):
-                self.tare_check()
-            else:
-                if not self.th_entry.text():
-                    self.thickness_check()
-                else:
-                    a.force_stop(default_forcestop, offset)
-                    a.close()
-                    commence = qtw.QMessageBox()
-                    commence.setIcon(qtw.QMessageBox.Question)
-                    commence.setText("Proceed with measurement?")
-                    commence.setWindowTitle("Proceed")
-                    commence.setStandardButtons(qtw.QMessageBox.Ok | qtw.QMessageBox.No)
-                    commence.buttonClicked.connect(self.firmness_l_1)
-                    commence.exec()
-            a.close()
-
-    def firmness_l_1(self, i):
-        self.click()
-        if i.text() == 'OK':
-            pausetime = default_pausetime
-            offset = self.tare_label.text()
-            a = Arduino()
-            if a.failout == 'failed out of arduino':
-                noent = qtw.QMessageBox()
-                noent.setIcon(qtw.QMessageBox.Warning)
-                noent.setText("Check USB Connections")
-                noent.setWindowTitle("No Serial Connect")
-                noent.setStandardButtons(qtw.QMessageBox.Ok)
-                noent.buttonClicked.connect(self.unclick)
-                noent.exec()
-                return
-            else:
-                time.sleep(2)
-                thickness = self.th_entry.text()
-                twofive_distance = 0.25*float(thickness)
-                a.go_the_distance(extend, twofive_distance, 20)
-                time.sleep(pausetime)
-                force = float(a.read(offset)) - perm_offset
-                self.firmness_l_calc.setText((str(round(force, 1))))
-                time.sleep(0.1)
-                a.go_the_distance(retract, (10), fullspeed)
-                a.close()
-                # for i in range(100):
-                #     time.sleep(0.1)
-                #     self.pbar.setValue(i)
-        self.unclick()
+            commence = qtw.QMessageBox()
+            commence.setIcon(qtw.QMessageBox.Question)
+            commence.setText("Proceed with measurement?")
+            commence.setWindowTitle("Proceed")
+            commence.setStandardButtons(qtw.QMessageBox.Ok | qtw.QMessageBox.No)
+            commence.buttonClicked.connect(proceed)
+            commence.exec()
         return
-    def support(self):
-        a = Arduino()
-        if a.failout == 'failed out of arduino':
-            noent = qtw.QMessageBox()
-            noent.setIcon(qtw.QMessageBox.Warning)
-            noent.setText("Check USB Connections")
-            noent.setWindowTitle("No Serial Connect")
-            noent.setStandardButtons(qtw.QMessageBox.Ok)
-            noent.buttonClicked.connect(self.unclick)
-            noent.exec()
-            return
-        else:
-            time.sleep(2)
-            offset = self.tare_label.text()
-            if (-50000 > float(offset) > -1):
-                self.tare_check()
-            else:
-                if not self.th_entry.text():
-                    self.thickness_check()
-                else:
-                    a.force_stop(default_forcestop, offset)
-                    a.close()
-                    commence = qtw.QMessageBox()
-                    commence.setIcon(qtw.QMessageBox.Question)
-                    commence.setText("Proceed with measurement?")
-                    commence.setWindowTitle("Proceed")
-                    commence.setStandardButtons(qtw.QMessageBox.Ok | qtw.QMessageBox.No)
-                    commence.buttonClicked.connect(self.support_1)
-                    commence.exec()
-            a.close()
-
-    def support_1(self, i):
-        self.click()
+
+    def tare_ready(self):
+        """
+        True once the load cell has been tared, otherwise tells the operator
+        to home the platen or set the tare first
+        """
+        if self.session.tare.offset is None:
+            self.tare_check()
+            return False
+        return True
+
+    def recipe_1(self, i, recipe):
         if i.text() == 'OK':
-            a = Arduino()
-            if a.failout == 'failed out of arduino':
-                noent = qtw.QMessageBox()
-                noent.setIcon(qtw.QMessageBox.Warning)
-                noent.setText("Check USB Connections")
-                noent.setWindowTitle("No Serial Connect")
-                noent.setStandardButtons(qtw.QMessageBox.Ok)
-                noent.buttonClicked.connect(self.unclick)
-                noent.exec()
-                return
-            else:
-                time.sleep(2)
-                thickness = self.th_entry.text()
-                twofive_distance = 0.25*float(thickness)
-                offset = self.tare_label.text()
-                a.go_the_distance(extend, twofive_distance, quarterspeed)
-                time.sleep(default_pausetime)
-                force = float(a.read(offset))
-                force = force - perm_offset
-                self.firmness_calc.setText((str(round(force, 1))))
-                time.sleep(60)
-                fourtydistance = 0.4*float(thickness)
-                a.go_the_distance(extend, fourtydistance, quarterspeed)
-                time.sleep(default_pausetime)
-                sixfiveforce = a.read(offset)
-                force = (float(sixfiveforce)-perm_offset)/(float(self.firmness_calc.text()))
-                self.support_calc.setText((str(round(force, 1))))
-                time.sleep(0.5)
-                a.go_the_distance(retract, 10, fullspeed)
-                a.close()
-            self.unclick()
+            thickness = float(self.th_entry.text())
+            for key, test_name in recipe.results().items():
+                self.result_label(key, test_name)
+            self.session.stream.trace.clear()
+            self.run_job(test_steps, recipe, thickness)
         return
-    
+
+    def result_label(self, key, test_name):
+        """
+        Returns the label showing result `key`, adding a row for results
+        the panel hasn't shown before
+        """
+        if key not in self.results:
+            label = qtw.QLabel('')
+            self.extraresults.addRow(qtw.QLabel(test_name[:1].upper() + test_name[1:] + ":"), label)
+            self.results[key] = (label, test_name)
+        return self.results[key][0]
 
     def move_function(self):
         if not self.distance.text() or not self.speed.text():
@@ -661,7 +662,6 @@ class MainWindow(qtw.QWidget):
             noent.setStandardButtons(qtw.QMessageBox.Ok)
             noent.exec()
         else: 
-            self.click()    
             if self.extendbox.isChecked():
                 pin_number = extend
             if self.retractbox.isChecked():
@@ -669,27 +669,169 @@ class MainWindow(qtw.QWidget):
 
             travel = self.distance.text()
             speedvalue = (float(self.speed.text())/100)*255
-            
-            
-            a = Arduino()
-            if a.failout == 'failed out of arduino':
-                noent = qtw.QMessageBox()
-                noent.setIcon(qtw.QMessageBox.Warning)
-                noent.setText("Check USB Connections")
-                noent.setWindowTitle("No Serial Connect")
-                noent.setStandardButtons(qtw.QMessageBox.Ok)
-                noent.buttonClicked.connect(self.unclick)
-                noent.exec()
-                return
-            else:
-                time.sleep(2)
-                a.go_the_distance(pin_number, travel, speedvalue)
-                time.sleep(1)
-                a.close()
-                self.unclick()
+            self.run_job(move_steps, pin_number, travel, speedvalue)
+        return
+
+    def cancel_test(self):
+        if self.job is not None:
+            self.job.cancel()
+        return
+
+    def abort_test(self):
+        if self.job is not None:
+            self.job.abort()
+        return
+
+
+
+######################################################################################################################
+######################################################################################################################
+######################################################################################################################
+######################################################################################################################
+######################################################################################################################
+
+
+#################################################  BATCH TESTING ################################
+    def import_samples(self):
+        path, _ = qtw.QFileDialog.getOpenFileName(self, "Import Samples", "",
+            "Sample lists (*.csv *.txt);;All files (*)")
+        if not path:
+            return
+        try:
+            self.samples = batch.load_samples(path)
+        except (OSError, ValueError) as error:
+            self.job_failed('Sample List', str(error))
+            return
+        self.batchfile.setText(os.path.basename(path) + " (" + str(len(self.samples)) + " samples)")
+        self.batchtable.setRowCount(len(self.samples))
+        for row, sample in enumerate(self.samples):
+            for column, text in enumerate((sample.sample_id, sample.doe_id, '%g' % sample.thickness)):
+                self.batchtable.setItem(row, column, qtw.QTableWidgetItem(text))
+            self.batch_row(sample)
+        self.batchprompt.setText("Check the tests to run and press Start Batch")
+        return
+
+    def batch_row(self, sample):
+        """
+        Shows a sample's status and results in the batch table
+        """
+        if sample not in self.samples:
+            return
+        row = self.samples.index(sample)
+        status = sample.status + (': ' + sample.note if sample.note else '')
+        results = ', '.join(key + ' ' + str(round(value, 1)) for key, value, note, curve in sample.results)
+        self.batchtable.setItem(row, 3, qtw.QTableWidgetItem(status))
+        self.batchtable.setItem(row, 4, qtw.QTableWidgetItem(results))
+        return
+
+    def start_batch(self):
+        chosen = [recipe for index, recipe in enumerate(self.recipes)
+            if self.batchrecipes.item(index).checkState() == QtCore.Qt.Checked]
+        if not self.samples:
+            self.batchprompt.setText("Import a sample list first")
+        elif not chosen:
+            self.batchprompt.setText("Check at least one test")
+        elif not self.opID_entry.text() or not self.date_entry.text():
+            self.batchprompt.setText("Enter the operator ID and date on the Test Results tab")
+        elif self.tare_ready():
+            self.batch = batch.Batch(self.samples, chosen, self.opID_entry.text(), self.date_entry.text())
+            self.batch.start()
+            for sample in self.samples:
+                self.batch_row(sample)
+            self.batch_prompt()
+        return
+
+    def batch_prompt(self):
+        """
+        Tells the operator which sample to load next, or ends the batch
+        when there are none left
+        """
+        sample = self.batch.current
+        if sample is None:
+            counts = self.batch.counts()
+            self.batchprompt.setText(("Batch stopped: " if self.batch.stopped else "Batch finished: ")
+                + str(counts.get(batch.done, 0)) + " done, " + str(counts.get(batch.failed, 0)) + " failed, "
+                + str(len(self.samples) - counts.get(batch.done, 0) - counts.get(batch.failed, 0)) + " not run")
+            self.batch = None
+        else:
+            self.batchprompt.setText("Load sample " + sample.sample_id + " (" + '%g' % sample.thickness
+                + " mm) and press Next Sample")
+        self.unclick()
+        return
+
+    def next_sample(self):
+        sample = self.batch.current if self.batch is not None else None
+        if sample is None or self.job is not None:
+            return
+        sample.status = batch.running
+        self.batchsample = sample
+        self.batch_row(sample)
+        self.session.stream.trace.clear()
+        self.run_job(batch_steps, sample, self.batch.recipes)
+        #plan the next sample while this one is measured, so a row that
+        #can't be run is skipped before the operator gets to it
+        upcoming = self.batch.upcoming
+        self.batch.prepare(upcoming)
+        text = "Measuring " + sample.sample_id
+        if upcoming is not None:
+            self.batch_row(upcoming)
+            text = text + ", next " + upcoming.sample_id + " (" + '%g' % upcoming.thickness + " mm)"
+        self.batchprompt.setText(text)
         return
 
+    def stop_batch(self):
+        if self.batch is None:
+            return
+        self.batch.stopped = True
+        if self.job is None:
+            self.batch_prompt()
+        else:
+            self.batchprompt.setText("Stopping after sample " + self.batchsample.sample_id)
+        return
 
+    def batch_result(self, key, value, note):
+        self.batchsample.result(key, value, note)
+        self.batch_row(self.batchsample)
+        return
+
+    def batch_curve(self, key, curve):
+        self.batchsample.curve(key, curve)
+        return
+
+    def batch_failed(self, title, text):
+        self.batchsample.status = batch.failed
+        self.batchsample.note = title + ' (' + text + ')'
+        if title == 'Test Aborted':
+            self.batch.stopped = True
+        return
+
+    def batch_finished(self):
+        """
+        Commits the sample that just came off the rig in the background and
+        moves the batch on to the next one
+        """
+        sample = self.batchsample
+        self.batchsample = None
+        if sample.status == batch.running:
+            sample.status = batch.done
+            sample.note = 'committing'
+            test_names = {}
+            for recipe in self.batch.recipes:
+                test_names.update(recipe.results())
+            commit = CommitJob(self.journal, self.curvestore, sample,
+                self.batch.operator, self.batch.test_date, test_names)
+            commit.signals.done.connect(self.batch_committed)
+            QtCore.QThreadPool.globalInstance().start(commit)
+        self.batch_row(sample)
+        self.batch.advance()
+        self.batch_prompt()
+        return
+
+    def batch_committed(self, sample, error):
+        sample.note = 'not committed (' + error + ')' if error else ''
+        self.batch_row(sample)
+        self.syncer.wake()
+        return
 
 ######################################################################################################################
 ######################################################################################################################
@@ -699,6 +841,67 @@ class MainWindow(qtw.QWidget):
 
 
 #################################################  PROGRAM HANDLING ################################
+    def run_job(self, steps, *args):
+        """
+        Starts a sequence of steps on the thread pool with the buttons locked
+        until it finishes
+        """
+        self.job = TestJob(steps, self.session, *args)
+        self.job.signals.progress.connect(self.pbar.setValue)
+        if self.batchsample is None:
+            self.job.signals.result.connect(self.show_result)
+            self.job.signals.curve.connect(self.keep_curve)
+            self.job.signals.failed.connect(self.job_failed)
+        else:
+            #batch results go to the sample, failures to its row
+            self.job.signals.result.connect(self.batch_result)
+            self.job.signals.curve.connect(self.batch_curve)
+            self.job.signals.failed.connect(self.batch_failed)
+        self.job.signals.finished.connect(self.job_finished)
+        self.click()
+        self.pbar.setValue(0)
+        self.rig.start(self.job)
+        return
+
+    def show_result(self, key, value, note):
+        if key == 'readings':
+            self.add_point(value)
+            return
+        if key == 'tare':
+            self.show_tare()
+            return
+        if key == 'force':
+            label = self.forcereading
+        else:
+            label = self.result_label(key, key)
+        if isinstance(value, str):
+            label.setText(value)
+        else:
+            label.setText(str(round(value, 1)))
+        label.setToolTip(note)
+        return
+
+    def keep_curve(self, key, curve):
+        self.curves[key] = curve
+        return
+
+    def job_failed(self, title, text):
+        noent = qtw.QMessageBox()
+        noent.setIcon(qtw.QMessageBox.Warning)
+        noent.setText(text)
+        noent.setWindowTitle(self.rig.name + ': ' + title)
+        noent.setStandardButtons(qtw.QMessageBox.Ok)
+        noent.exec()
+        return
+
+    def job_finished(self):
+        self.job = None
+        self.rig.job = None
+        if self.batchsample is not None:
+            self.batch_finished()
+        self.unclick()
+        return
+
     def thickness_check(self):
         noent = qtw.QMessageBox()
         noent.setIcon(qtw.QMessageBox.Warning)
@@ -708,14 +911,6 @@ class MainWindow(qtw.QWidget):
         noent.exec()
         return
 
-    def thread(self):
-        t1=threading.Thread(target = self.set_tare)
-        t1.start()
-
-    def thread2(self):
-        t1=threading.Thread(target = self.display_force)
-        t1.start()
-
     def click(self):
         self.tare_button.setEnabled(False)
         self.forcebutton.setEnabled(False)
@@ -723,7 +918,13 @@ class MainWindow(qtw.QWidget):
         self.movebutton.setEnabled(False) 
         self.homebutton.setEnabled(False)
         self.enterbutton.setEnabled(False)
-        self.calibrate.setEnabled(False)
+        self.capturebutton.setEnabled(False)
+        self.importbutton.setEnabled(False)
+        self.batchstart.setEnabled(False)
+        self.batchnext.setEnabled(False)
+        self.batchstop.setEnabled(self.batch is not None)
+        self.cancelbutton.setEnabled(self.job is not None)
+        self.abortbutton.setEnabled(self.job is not None)
         return
 
     def unclick(self):
@@ -733,9 +934,30 @@ class MainWindow(qtw.QWidget):
         self.movebutton.setEnabled(True) 
         self.homebutton.setEnabled(True)
         self.enterbutton.setEnabled(True)
-        self.calibrate.setEnabled(True)
+        self.capturebutton.setEnabled(True)
+        self.importbutton.setEnabled(self.batch is None)
+        self.batchstart.setEnabled(self.batch is None)
+        self.batchnext.setEnabled(self.batch is not None)
+        self.batchstop.setEnabled(self.batch is not None)
+        self.cancelbutton.setEnabled(False)
+        self.abortbutton.setEnabled(False)
         return 
 
+    def status(self):
+        """
+        One line for the station overview: state, live force and progress
+        """
+        force = self.session.stream.latest()
+        force = '' if force is None else str(round(force, 1))
+        state = self.rig.status()
+        if self.batchsample is not None:
+            state = state + ' ' + self.batchsample.sample_id
+        if self.session.tare.alert is not None:
+            state = state + ', zero drift'
+        if self.job is not None:
+            state = state + ' ' + str(self.pbar.value()) + '%'
+        return state, force
+
 
 ######################################################################################################################
 ######################################################################################################################
@@ -747,8 +969,6 @@ class MainWindow(qtw.QWidget):
 #################################################  COMMUNICATION WITH SQL DATABASE ################################
     def commit(self):
         self.click()
-        self.conn = mysql.connector.connect(host = 'localhost', user = 'root', passwd = 'password', database = 'foam')
-        c = self.conn.cursor()
         if not self.sampleID_entry.text() or not self.batchID_entry.text() or not self.date_entry.text() or not self.opID_entry.text() or not self.th_entry.text():
             self.thickness_check()
         else:
@@ -757,48 +977,254 @@ class MainWindow(qtw.QWidget):
             test_date = self.date_entry.text()
             operator = self.opID_entry.text()
             thickness = self.th_entry.text()
-            if self.firmness_calc.text():
-                test_name = 'firmness (N)'
-                entry = self.firmness_calc.text()
-                query = """INSERT INTO tests(sample_id,DOE_ID,test_name,
-                result,test_date, operator, thickness) 
-                VALUES(%s, %s, %s, %s, %s, %s, %s);"""
-                c.execute(query, (sample_id, doe_id, test_name, entry, test_date, operator, thickness))
-                self.conn.commit()
-                self.firmness_calc.setText('')
-
-            if self.firmness_l_calc.text():
-                test_name = 'firmness (N) (local)'
-                entry = self.firmness_l_calc.text()
-                query = """INSERT INTO tests(sample_id,DOE_ID,test_name,
-                result,test_date, operator, thickness) 
-                VALUES(%s, %s, %s, %s, %s, %s, %s);"""
-                c.execute(query, (sample_id, doe_id, test_name, entry, test_date, operator, thickness))
-                self.conn.commit()
-                self.firmness_l_calc.setText('')
-
-            if self.support_calc.text():
-                test_name = 'support factor (N/N)'
-                entry = self.support_calc.text()
-                query = """INSERT INTO tests(sample_id,DOE_ID,test_name,
-                result,test_date, operator, thickness) 
-                VALUES(%s, %s, %s, %s, %s, %s, %s);"""
-                c.execute(query, (sample_id, doe_id, test_name, entry, test_date, operator, thickness))
-                self.conn.commit()
-                self.support_calc.setText('')
-
-        query = """select * from tests order by test_date desc, test_id desc"""
-        df = pd.read_sql(query, self.conn)
-        self.table.setHorizontalHeaderLabels(df.columns)
-        for row in df.iterrows():
-            values = row[1]
-            for col_index, value in enumerate(values):
-                tableItem = qtw.QTableWidgetItem(str(value))
-                self.table.setItem(row[0], col_index, tableItem)
-        c.close()
+            committed = []
+            rows = []
+            for key, (label, test_name) in self.results.items():
+                if label.text():
+                    entry = label.text()
+                    curve_ref = self.save_curve(key, sample_id, doe_id, test_date, test_name)
+                    rows.append((sample_id, doe_id, test_name, entry, test_date, operator, thickness, curve_ref))
+                    committed.append(label)
+            #the journal is local so this never waits on the network, the
+            #sync thread uploads the rows and the table picks them up from it
+            self.journal.append(rows)
+            self.syncer.wake()
+            for label in committed:
+                label.setText('')
+
         self.unclick()
         return
 
+    def save_curve(self, key, sample_id, doe_id, test_date, test_name):
+        """
+        Writes the curve behind a result to the curve store and returns its
+        reference for the tests table, or None if the result has no curve
+        """
+        curve = self.curves.pop(key, None)
+        if curve is None:
+            return None
+        return self.curvestore.save(curve, sample_id, doe_id, test_date, test_name)
+
+
+
+######################################################################################################################
+######################################################################################################################
+######################################################################################################################
+######################################################################################################################
+######################################################################################################################
+
+
+#################################################  MAIN WINDOW ################################################
+class MainWindow(qtw.QWidget):
+    #results uploaded by the sync thread, and its pending count and last error
+    synced = QtCore.pyqtSignal(object)
+    syncstatus = QtCore.pyqtSignal(int, object)
+    #rigs plugged in or unplugged, from the discovery thread
+    rigfound = QtCore.pyqtSignal(str, str, object)
+    riglost = QtCore.pyqtSignal(str)
+    scanfailed = QtCore.pyqtSignal(str)
+
+    def __init__(self, registry=None):
+        """
+        A tab per rig, an overview of every station and the shared Test
+        Database tab. All rigs write through one journal and sync thread
+        """
+        super().__init__()
+        self.registry = registry if registry is not None else RigRegistry()
+        self.curvestore = CurveStore()
+        self.journal = Journal()
+        self.syncer = SyncWorker(self.journal, database.ResultWriter(), self.synced.emit, self.syncstatus.emit)
+        ######## Layout Management ########
+        mainlayout = qtw.QVBoxLayout()
+        self.setLayout(mainlayout)
+        self.setWindowTitle("Universal Foam Tester")
+
+        ##Station Overview
+        self.overview = qtw.QTableWidget(0, 4)
+        self.overview.setHorizontalHeaderLabels(["Rig", "Port", "Status", "Force (N)"])
+        self.overview.verticalHeader().hide()
+        self.overview.setEditTriggers(qtw.QAbstractItemView.NoEditTriggers)
+        self.overview.horizontalHeader().setStretchLastSection(True)
+        self.overview.cellDoubleClicked.connect(lambda row, column: self.stations.setCurrentIndex(row))
+        self.overviewtimer = QtCore.QTimer(self, timeout = self.update_overview)
+        self.overviewtimer.start(250)
+        self.rigstatus = qtw.QLabel("Looking for rigs...")
+        self.rigfound.connect(self.rig_found)
+        self.riglost.connect(self.rig_lost)
+        self.scanfailed.connect(self.scan_failed)
+
+        ##Stations
+        self.stations = qtw.QTabWidget()
+        self.panels = []
+        for rig in self.registry:
+            self.add_station(rig)
+
+        ## Test Database
+        dbtab = qtw.QWidget()
+        dbbox = qtw.QGridLayout()
+        dbtab.setLayout(dbbox)
+        self.table = qtw.QTableView()
+        self.table.setAlternatingRowColors(True)
+        self.model = TestsModel()
+        self.filtercolumn = qtw.QComboBox()
+        self.filtertext = qtw.QLineEdit()
+        self.filtertext.setPlaceholderText("Filter")
+        self.filtertext.returnPressed.connect(lambda: self.model.set_filter(self.filtercolumn.currentText(), self.filtertext.text()))
+        #define back end widgets
+        dbbox.setContentsMargins(5, 5, 5, 5)
+        self.dbstatus = qtw.QLabel("Loading test database...")
+        dbbox.addWidget(self.dbstatus, 0, 0, 1, 2)
+        self.syncpending = qtw.QLabel()
+        dbbox.addWidget(self.syncpending, 3, 0, 1, 2)
+        dbbox.addWidget(self.filtercolumn, 1, 0)
+        dbbox.addWidget(self.filtertext, 1, 1)
+        dbbox.addWidget(self.table, 2, 0, 1, 2)
+        self.table.setModel(self.model)
+        self.table.horizontalHeader().setSortIndicator(-1, QtCore.Qt.DescendingOrder)
+        #the first page is fetched off the GUI thread once the window is up
+        self.model.ready.connect(self.database_ready)
+        self.model.unavailable.connect(lambda error: self.dbstatus.setText("Test database unavailable: " + error))
+        #results are journaled locally and uploaded in the background
+        self.synced.connect(self.model.insert_new)
+        self.syncstatus.connect(self.sync_status)
+
+        self.stations.addTab(dbtab, "Test Database")
+
+        #write the timing metrics out every minute
+        self.metricstimer = QtCore.QTimer(self, timeout = self.export_metrics)
+        self.metricstimer.start(1000*metrics.export_interval)
+        self.metricsstatus = qtw.QLabel()
+        self.metricsstatus.hide()
+
+        mainlayout.addWidget(self.rigstatus)
+        mainlayout.addWidget(self.overview)
+        mainlayout.addWidget(self.stations, 1)
+        mainlayout.addWidget(self.metricsstatus)
+        self.rigstatus.setVisible(not self.panels)
+
+        self.show()
+        #the dark style sheet is slow to import and apply, so it waits until the window is up
+        QtCore.QTimer.singleShot(0, self.load_style)
+        QtCore.QTimer.singleShot(0, self.startup_finished)
+
+    def add_station(self, rig):
+        panel = StationPanel(rig, self.journal, self.syncer, self.curvestore)
+        self.panels.append(panel)
+        self.stations.insertTab(len(self.panels) - 1, panel, rig.name)
+        self.overview.setRowCount(len(self.panels))
+        for column, text in enumerate((rig.name, str(rig.serial_port), '', '')):
+            self.overview.setItem(len(self.panels) - 1, column, qtw.QTableWidgetItem(text))
+        self.fit_overview()
+        self.rigstatus.hide()
+        return panel
+
+    def remove_station(self, panel):
+        row = self.panels.index(panel)
+        self.panels.pop(row)
+        self.stations.removeTab(row)
+        self.overview.removeRow(row)
+        self.fit_overview()
+        panel.deleteLater()
+        return
+
+    def fit_overview(self):
+        self.overview.setMaximumHeight(self.overview.horizontalHeader().height()
+            + self.overview.verticalHeader().length() + 2*self.overview.frameWidth())
+        return
+
+    def rig_found(self, name, serial_port, arduino):
+        if name in self.registry.rigs:
+            rig = self.registry[name]
+            if rig.job is not None:
+                # still failing out of the test it was unplugged in
+                arduino.close()
+                self.registry.discovery.forget(serial_port)
+                return
+            rig.reattach(serial_port, arduino)
+            row = [panel.rig for panel in self.panels].index(rig)
+            self.overview.item(row, 1).setText(serial_port)
+        else:
+            self.add_station(self.registry.add(name, serial_port, arduino))
+        metrics.count('rig_connects', rig=name)
+        return
+
+    def rig_lost(self, name):
+        metrics.count('rig_unplugs', rig=name)
+        for panel in self.panels:
+            if panel.rig.name == name and panel.job is None:
+                # a rig that was mid test keeps its tab to show what happened
+                self.remove_station(panel)
+                self.registry.remove(name)
+        self.rigstatus.setText(name + " unplugged, looking for rigs...")
+        self.rigstatus.setVisible(not self.panels)
+        return
+
+    def scan_failed(self, error):
+        self.rigstatus.setText("Port scan failed (" + error + "), retrying...")
+        self.rigstatus.setVisible(not self.panels)
+        return
+
+    def update_overview(self):
+        for row, panel in enumerate(self.panels):
+            for column, text in zip((2, 3), panel.status()):
+                item = self.overview.item(row, column)
+                if item.text() != text:
+                    item.setText(text)
+        return
+
+    def load_style(self):
+        import qdarkstyle
+        self.setStyleSheet(qdarkstyle.load_stylesheet_pyqt5())
+        return
+
+    def startup_finished(self):
+        metrics.observe('startup', time.perf_counter() - startup_start, stage='window_shown')
+        self.model.reset_async()
+        self.syncer.start()
+        self.registry.watch(self.rigfound.emit, self.riglost.emit, self.scanfailed.emit)
+        return
+
+    def database_ready(self):
+        self.dbstatus.hide()
+        if not self.filtercolumn.count():
+            #the first load, later ones are sorts and filters
+            self.filtercolumn.addItems(self.model.names)
+            self.table.setSortingEnabled(True)
+            metrics.observe('startup', time.perf_counter() - startup_start, stage='database_loaded')
+        return
+
+    def export_metrics(self):
+        try:
+            metrics.export()
+        except OSError as error:
+            #on exit the window is already going, so it is logged too
+            logging.getLogger(__name__).warning('could not write metrics: %s', error)
+            self.metricsstatus.setText("Could not write metrics: " + str(error))
+            self.metricsstatus.show()
+            return
+        self.metricsstatus.hide()
+        return
+
+    def sync_status(self, pending, error):
+        if not pending:
+            self.syncpending.setText('')
+        elif error:
+            self.syncpending.setText(str(pending) + " result(s) saved locally, waiting for the database: " + error)
+        else:
+            self.syncpending.setText(str(pending) + " result(s) waiting to upload")
+        return
+
+    def closeEvent(self, event):
+        #aborts whatever each rig is running and closes its port
+        self.registry.close()
+        QtCore.QThreadPool.globalInstance().waitForDone(5000)
+        self.syncer.stop()
+        if self.syncer.is_alive():
+            self.syncer.join(5)
+        self.journal.close()
+        self.export_metrics()
+        super().closeEvent(event)
+
 
 
 ######################################################################################################################
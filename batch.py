@@ -0,0 +1,182 @@
+"""
+Batch testing
+
+A batch is a list of samples imported from a CSV file (sample_id, DOE_ID
+and thickness columns, in any order, with a header row) run through the
+same recipes one after the other. While a sample is measured the next one
+is prepared: its recipes are planned for its thickness, so a bad row shows
+up before the operator reaches it. The results of a finished sample are
+committed on a background thread, curve files and all, so the operator
+only has to swap the foam between samples.
+"""
+import csv
+
+import metrics
+
+columns = {
+    'sample_id': ('sample_id', 'sample id', 'sample'),
+    'DOE_ID': ('doe_id', 'doe', 'batch_id', 'batch id'),
+    'thickness': ('thickness', 'thickness (mm)', 'th'),
+}
+
+waiting = 'waiting'
+ready = 'ready'
+running = 'running'
+done = 'done'
+failed = 'failed'
+
+
+class BatchError(ValueError):
+    pass
+
+
+class BatchSample():
+    def __init__(self, sample_id, doe_id, thickness, row=None):
+        self.sample_id = sample_id
+        self.doe_id = doe_id
+        self.thickness = thickness
+        self.row = row
+        self.status = waiting
+        self.note = ''
+        self.plans = None
+        self.results = []
+
+    def result(self, key, value, note=''):
+        """
+        Keeps a result, replacing an earlier one of the same key as the
+        Test Results tab does
+        """
+        self.results = [entry for entry in self.results if entry[0] != key]
+        self.results.append([key, value, note, None])
+
+    def curve(self, key, curve):
+        """
+        Attaches a curve to the latest result of that key still without one
+        """
+        for entry in reversed(self.results):
+            if entry[0] == key and entry[3] is None:
+                entry[3] = curve
+                return
+
+
+def load_samples(path):
+    """
+    Reads a sample list. Raises BatchError naming the first bad row
+    """
+    with open(path, newline='') as file:
+        reader = csv.reader(file)
+        header = next(reader, None)
+        if header is None:
+            raise BatchError(path + ' is empty')
+        header = [name.strip().lower() for name in header]
+        index = {}
+        for field, aliases in columns.items():
+            for alias in aliases:
+                if alias in header:
+                    index[field] = header.index(alias)
+                    break
+            else:
+                raise BatchError(path + ' has no ' + field + ' column')
+        samples = []
+        for number, row in enumerate(reader, 2):
+            if not any(cell.strip() for cell in row):
+                continue
+            try:
+                values = {field: row[column].strip() for field, column in index.items()}
+                thickness = float(values['thickness'])
+            except (IndexError, ValueError):
+                raise BatchError(path + ' line ' + str(number) + ': needs a sample id, DOE_ID and thickness in mm')
+            if not values['sample_id'] or not values['DOE_ID'] or thickness <= 0:
+                raise BatchError(path + ' line ' + str(number) + ': needs a sample id, DOE_ID and thickness in mm')
+            samples.append(BatchSample(values['sample_id'], values['DOE_ID'], thickness, number))
+    if not samples:
+        raise BatchError(path + ' lists no samples')
+    return samples
+
+
+class Batch():
+    def __init__(self, samples, recipes, operator, test_date):
+        self.samples = samples
+        self.recipes = recipes
+        self.operator = operator
+        self.test_date = test_date
+        self.position = 0
+        self.stopped = False
+
+    @property
+    def current(self):
+        if self.stopped or self.position >= len(self.samples):
+            return None
+        return self.samples[self.position]
+
+    @property
+    def upcoming(self):
+        if self.position + 1 >= len(self.samples):
+            return None
+        return self.samples[self.position + 1]
+
+    def prepare(self, sample):
+        """
+        Plans every recipe for the sample's thickness, marking it failed if
+        one can't be planned
+        """
+        if sample is None or sample.plans is not None:
+            return
+        try:
+            sample.plans = [recipe.plan(sample.thickness) for recipe in self.recipes]
+            sample.status = ready
+        except ValueError as error:
+            sample.plans = []
+            sample.status = failed
+            sample.note = str(error)
+
+    def start(self):
+        """
+        Queues every sample not done yet and returns the first that can be
+        run, or None
+        """
+        for sample in self.samples:
+            if sample.status != done:
+                sample.status = waiting
+                sample.note = ''
+                sample.plans = None
+                sample.results = []
+        self.stopped = False
+        self.position = -1
+        return self.advance()
+
+    def advance(self):
+        """
+        Moves on to the next sample that can be run and returns it, or None
+        when the batch is over
+        """
+        self.position += 1
+        while self.current is not None:
+            self.prepare(self.current)
+            if self.current.status not in (done, failed):
+                return self.current
+            self.position += 1
+        return None
+
+    def counts(self):
+        totals = {}
+        for sample in self.samples:
+            totals[sample.status] = totals.get(sample.status, 0) + 1
+        return totals
+
+
+def commit_sample(journal, curvestore, sample, operator, test_date, test_names):
+    """
+    Saves a sample's curves and journals its results. `test_names` maps
+    result keys to the tests table's test_name. Returns the client ids
+    """
+    rows = []
+    with metrics.span('batch_commit'):
+        for key, value, note, curve in sample.results:
+            test_name = test_names.get(key, key)
+            curve_ref = None
+            if curve is not None:
+                curve_ref = curvestore.save(curve, sample.sample_id, sample.doe_id, test_date, test_name)
+            rows.append((sample.sample_id, sample.doe_id, test_name, str(round(value, 1)),
+                test_date, operator, '%g' % sample.thickness, curve_ref))
+        return journal.append(rows)
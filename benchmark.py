@@ -0,0 +1,379 @@
+"""
+End-to-end benchmarks for the tester
+
+Runs headless against the rig simulator and a SQLite stand-in for the MySQL
+tests table and writes the numbers to JSON so runs can be compared:
+
+    python benchmark.py --output bench.json
+    python benchmark.py --only serial,table --max-rows 100000
+
+serial      round trip of each Arduino command, ASCII and binary
+sequences   wall time of the firmness, firmness (local) and support
+            factor sequences, split into their phases
+commit      results per second through the local journal (what commit()
+            does) and through the upload to the tests table
+table       Test Database refresh times as the tests table grows from 1k
+            to --max-rows rows
+"""
+import argparse
+import json
+import os
+import platform
+import random
+import sqlite3
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+import core
+import database
+import metrics
+import recipes
+import simulator
+from journal import Journal
+from testsmodel import TestsModel
+
+table_sizes = (1000, 10000, 100000, 1000000)
+sections = ('serial', 'sequences', 'commit', 'table')
+
+schema = """CREATE TABLE tests(test_id INTEGER PRIMARY KEY AUTOINCREMENT,
+    sample_id TEXT, DOE_ID TEXT, test_name TEXT, result REAL, test_date TEXT,
+    operator TEXT, thickness REAL, curve_ref TEXT, client_id TEXT UNIQUE)"""
+
+
+######################################################### DATABASE STAND-IN ########
+class SqliteCursor():
+    def __init__(self, cursor):
+        self.cursor = cursor
+
+    def translate(self, query):
+        return query.replace('%s', '?').replace('ON DUPLICATE KEY UPDATE test_id=test_id',
+            'ON CONFLICT(client_id) DO NOTHING')
+
+    def execute(self, query, params=()):
+        self.cursor.execute(self.translate(query), params)
+
+    def executemany(self, query, rows):
+        self.cursor.executemany(self.translate(query), rows)
+
+    def fetchall(self):
+        return self.cursor.fetchall()
+
+    @property
+    def description(self):
+        return self.cursor.description
+
+    def close(self):
+        self.cursor.close()
+
+
+class SqliteConnection():
+    def __init__(self, database):
+        """
+        Hands out the stand-in's one SQLite connection the way the pool hands
+        out MySQL connections. close() gives it back rather than closing it
+        """
+        self.database = database
+
+    def cursor(self):
+        return SqliteCursor(self.database.conn.cursor())
+
+    def commit(self):
+        self.database.conn.commit()
+
+    def rollback(self):
+        self.database.conn.rollback()
+
+    def close(self):
+        pass
+
+
+class SqliteDatabase():
+    def __init__(self, path=':memory:'):
+        """
+        A tests table in SQLite. `connect` can be passed anywhere
+        database.connect is expected
+        """
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute(schema)
+        self.count = 0
+
+    def connect(self):
+        return SqliteConnection(self)
+
+    def grow(self, rows):
+        """
+        Adds made up results until the table holds `rows` rows
+        """
+        batch = []
+        for index in range(self.count, rows):
+            batch.append(('S' + str(index), 'DOE' + str(index % 97), 'firmness (N)',
+                round(random.uniform(20, 200), 2),
+                '2026-%02d-%02d' % (1 + index % 12, 1 + index % 28), 'bench', 100.0))
+            if len(batch) == 10000:
+                self._insert(batch)
+                batch = []
+        if batch:
+            self._insert(batch)
+        self.count = max(self.count, rows)
+
+    def _insert(self, batch):
+        self.conn.executemany("""INSERT INTO tests(sample_id, DOE_ID, test_name,
+            result, test_date, operator, thickness) VALUES(?, ?, ?, ?, ?, ?, ?)""", batch)
+        self.conn.commit()
+
+
+######################################################### HELPERS ########
+def summarize(samples):
+    """
+    Timing statistics in ms for a list of durations in s
+    """
+    if not samples:
+        return {'n': 0}
+    ordered = sorted(samples)
+    def percentile(fraction):
+        return 1000*ordered[min(int(fraction*len(ordered)), len(ordered) - 1)]
+    return {'n': len(samples), 'mean_ms': 1000*statistics.mean(samples),
+        'p50_ms': percentile(0.5), 'p90_ms': percentile(0.9),
+        'p99_ms': percentile(0.99), 'max_ms': 1000*ordered[-1]}
+
+
+def timed(function, *args, **kwargs):
+    start = time.perf_counter()
+    function(*args, **kwargs)
+    return time.perf_counter() - start
+
+
+def revision():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'],
+            capture_output=True, text=True, cwd=os.path.dirname(os.path.abspath(__file__)),
+            timeout=10).stdout.strip() or None
+    except (OSError, subprocess.SubprocessError):
+        return None
+
+
+def report(line):
+    print(line)
+    sys.stdout.flush()
+
+
+def reload(model, **query):
+    """
+    Sets the model's sort or filter and reloads it on this thread
+    """
+    model.__dict__.update(query)
+    model.reset()
+
+
+def insert(model, test_ids):
+    """
+    Slots freshly written rows into the model on this thread
+    """
+    model.new_ids.update(test_ids)
+    model.inserted(None, *model.fetch(newer=model.max_id))
+
+
+######################################################### BENCHMARKS ########
+def bench_serial(args):
+    """
+    Round trip of every Arduino method, once per protocol
+    """
+    results = {}
+    for mode in ('binary', 'ascii'):
+        sim = simulator.Simulator(baud_rate=args.baud, boot_time=0.2)
+        port = sim.start()
+        try:
+            connect = time.perf_counter()
+            a = core.Arduino(port, reset_delay=0.3, binary=mode == 'binary')
+            connect = time.perf_counter() - connect
+            tare = a.tare()
+            commands = {
+                'read': lambda: a.read(tare),
+                'tare': a.tare,
+                'force_stop': lambda: a.force_stop(10000, tare),
+                'stop': a.stop,
+                'stream_toggle': lambda: (a.stream(tare), a.stream(0, on=False)),
+                'short_move': lambda: a.finish(a.go_the_distance(core.extend, 0.05, core.fullspeed)),
+            }
+            timings = {'connect_ms': 1000*connect}
+            for name, command in commands.items():
+                samples = [timed(command) for repeat in range(args.repeat)]
+                timings[name] = summarize(samples)
+            a.finish(a.gohome())
+            a.close()
+        finally:
+            sim.stop()
+        results[mode] = timings
+        report('serial ' + mode + ': read p50 ' + '%.1f' % timings['read']['p50_ms']
+            + ' ms, short move p50 ' + '%.1f' % timings['short_move']['p50_ms'] + ' ms')
+    return results
+
+
+class HeadlessRun():
+    def __init__(self):
+        self.results = {}
+        self.curves = {}
+        self.failure = None
+
+    def result(self, key, value, note):
+        self.results[key] = {'value': float(value), 'note': note}
+
+    def curve(self, key, curve):
+        self.curves[key] = curve
+
+    def failed(self, title, text):
+        self.failure = title + ': ' + text
+
+
+def bench_sequences(args):
+    """
+    Runs each test sequence the way the GUI does, on a core.Run of
+    test_steps from home with the force stop set, and splits its wall time
+    into the phases its curve recorded
+    """
+    results = {}
+    sim = simulator.Simulator(simulator.Foam(args.thickness), version=args.firmware,
+        baud_rate=args.baud, boot_time=0.2)
+    port = sim.start()
+    session = core.ArduinoSession(port)
+    try:
+        session.retare()
+        tests = {recipe.name: recipe for recipe in recipes.load_all()}
+        for name, recipe in (('firmness', tests['Firmness']),
+                ('firmness_local', tests['Firmness (local)']),
+                ('support', tests['Support Factor'])):
+            runs = []
+            for repeat in range(args.sequence_repeat):
+                session.settle.dwells = []
+                run = HeadlessRun()
+                job = core.Run(core.test_steps, session, recipe, args.thickness,
+                    result=run.result, record=run.curve)
+                wall = time.perf_counter()
+                failure = job.execute()
+                wall = time.perf_counter() - wall
+                if failure is not None:
+                    run.failed(*failure)
+                curve = next(iter(run.curves.values()), None)
+                phases = {}
+                if curve is not None:
+                    for phase, start, end in curve.phases:
+                        phases[phase] = end - start
+                runs.append({'wall_s': wall, 'phases_s': phases, 'results': run.results,
+                    'dwells': [{'label': label, 'elapsed_s': elapsed, 'settled': settled}
+                        for label, elapsed, settled in session.settle.dwells],
+                    'samples': curve.count if curve is not None else 0,
+                    'failure': run.failure})
+                report('sequence ' + name + ': ' + '%.1f' % wall + ' s '
+                    + ', '.join(phase + ' ' + '%.1f' % span for phase, span in phases.items()))
+            results[name] = runs
+    finally:
+        session.close()
+        sim.stop()
+    return results
+
+
+def bench_commit(args):
+    """
+    Throughput of the two halves of a commit: appending a sample's three
+    results to the local journal, and uploading them to the tests table
+    """
+    results = {}
+    stand_in = SqliteDatabase()
+    folder = tempfile.mkdtemp()
+    journal = Journal(os.path.join(folder, 'results.db'))
+    sample = [('S1', 'DOE1', test_name, '12.3', '2026-01-01', 'bench', '100', None)
+        for test_name in ('firmness (N)', 'firmness (N) (local)', 'support factor (N/N)')]
+    samples = [timed(journal.append, sample) for repeat in range(args.commits)]
+    results['journal_append'] = summarize(samples)
+    results['journal_commits_per_s'] = len(samples)/sum(samples)
+
+    writer = database.ResultWriter(stand_in.connect)
+    rows = journal.pending(limit=len(samples)*len(sample))
+    samples = [timed(writer.write, rows[index:index + 3]) for index in range(0, len(rows), 3)]
+    results['upload_per_commit'] = summarize(samples)
+    results['upload_commits_per_s'] = len(samples)/sum(samples)
+    journal.mark_synced([row[-1] for row in rows])
+
+    journal.append(sample*args.commits)
+    rows = journal.pending(limit=len(sample)*args.commits)
+    elapsed = sum(timed(writer.write, rows[index:index + 500]) for index in range(0, len(rows), 500))
+    results['upload_batched_rows_per_s'] = len(rows)/elapsed
+    journal.close()
+    report('commit: ' + '%.0f' % results['journal_commits_per_s'] + ' commits/s journaled, '
+        + '%.0f' % results['upload_batched_rows_per_s'] + ' rows/s uploaded in batches')
+    return results
+
+
+def bench_table(args):
+    """
+    Test Database tab operations against a growing tests table
+    """
+    results = []
+    stand_in = SqliteDatabase()
+    writer = database.ResultWriter(stand_in.connect)
+    for size in table_sizes:
+        if size > args.max_rows:
+            break
+        grow = timed(stand_in.grow, size)
+        model = TestsModel(stand_in.connect)
+        timings = {'rows': size, 'populate_s': grow}
+        timings['first_page'] = summarize([timed(model.reset) for repeat in range(args.repeat)])
+        timings['scroll_page'] = summarize([timed(model.fetchMore) for repeat in range(args.repeat)])
+        # the view sorts and filters with reset_async, timed here is the reload it runs
+        timings['sort_result'] = summarize([timed(reload, model, sort_name='result')
+            for repeat in range(args.repeat)])
+        timings['filter_sample'] = summarize([timed(reload, model, sort_name='test_id',
+            filter_name='sample_id', filter_text='S1' + str(repeat)) for repeat in range(args.repeat)])
+        reload(model, filter_name=None, filter_text='')
+        samples = []
+        for repeat in range(args.repeat):
+            test_ids = writer.write([('B' + str(repeat), 'DOE0', 'firmness (N)', '50.0',
+                '2026-01-01', 'bench', '100', None, os.urandom(16).hex())])
+            samples.append(timed(insert, model, test_ids))
+        stand_in.count += args.repeat
+        timings['insert_new'] = summarize(samples)
+        results.append(timings)
+        report('table ' + str(size) + ' rows: first page p50 ' + '%.1f' % timings['first_page']['p50_ms']
+            + ' ms, sort p50 ' + '%.1f' % timings['sort_result']['p50_ms']
+            + ' ms, insert p50 ' + '%.1f' % timings['insert_new']['p50_ms'] + ' ms')
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='End-to-end benchmarks for the tester')
+    parser.add_argument('--output', default='benchmark.json', help='JSON file to write')
+    parser.add_argument('--only', default=','.join(sections),
+        help='comma separated subset of ' + ', '.join(sections))
+    parser.add_argument('--repeat', type=int, default=50, help='samples per timed operation')
+    parser.add_argument('--sequence-repeat', type=int, default=1, help='runs of each test sequence')
+    parser.add_argument('--commits', type=int, default=1000, help='commits for the throughput runs')
+    parser.add_argument('--max-rows', type=int, default=table_sizes[-1], help='largest tests table')
+    parser.add_argument('--thickness', type=float, default=50.0, help='simulated sample thickness in mm')
+    parser.add_argument('--firmware', type=int, default=simulator.firmware_version,
+        help='firmware version the sequences run against, 1 to drive them a step at a time')
+    parser.add_argument('--baud', type=int, default=simulator.baud_rate,
+        help='UART speed the simulator emulates, 0 for none')
+    args = parser.parse_args(argv)
+    chosen = [section.strip() for section in args.only.split(',') if section.strip()]
+    unknown = set(chosen) - set(sections)
+    if unknown:
+        parser.error('unknown section ' + ', '.join(sorted(unknown)))
+    output = {'meta': {'started': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'revision': revision(), 'python': platform.python_version(),
+        'platform': platform.platform(), 'args': vars(args)}}
+    for section in sections:
+        if section in chosen:
+            output[section] = globals()['bench_' + section](args)
+    output['meta']['finished'] = time.strftime('%Y-%m-%dT%H:%M:%S')
+    # what the built-in instrumentation saw over the same run
+    output['metrics'] = metrics.snapshot()
+    with open(args.output, 'w') as file:
+        json.dump(output, file, indent=1)
+    report('wrote ' + args.output)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,185 @@
+"""
+Load cell calibration
+
+A calibration maps the force the firmware reports (tared counts over its
+nominal scale) to newtons with a polynomial, a straight line by default.
+It is fitted by least squares to every streamed reading taken at several
+known loads, put on and then taken off again, and reports how far the
+cell is from that line (linearity) and how far apart the readings on the
+way up and the way down are (hysteresis), both in % of the calibrated
+span. Each rig's calibrations are appended to calibrations.jsonl next to
+this file, whatever folder the program is started from, and numbered,
+and a rig uses its newest one, so every curve can be traced to the
+calibration it was measured with. Readings are kept as reported and
+converted in bulk by apply() when they are read out. A rig that was never
+calibrated gets the fixed offset the host used to subtract from every
+reading.
+"""
+import json
+import os
+import threading
+import time
+
+import numpy as np
+
+history_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'calibrations.jsonl')
+default_degree = 1
+point_seconds = 3.0
+min_readings = 5
+
+
+class CalibrationError(ValueError):
+    pass
+
+
+class Calibration():
+    def __init__(self, rig, version, coefficients, created=None, operator='',
+            points=(), linearity=None, hysteresis=None, noise=None):
+        """
+        `coefficients` of the polynomial in the reported force, highest
+        power first. `points` holds (load N, readings, mean, standard
+        deviation) for each point it was fitted to
+        """
+        self.rig = rig
+        self.version = version
+        self.coefficients = np.asarray(coefficients, dtype=float)
+        self.created = created
+        self.operator = operator
+        self.points = [list(point) for point in points]
+        self.linearity = linearity
+        self.hysteresis = hysteresis
+        self.noise = noise
+
+    @property
+    def label(self):
+        if not self.version:
+            return 'uncalibrated'
+        return str(self.rig) + ' v' + str(self.version)
+
+    def apply(self, values):
+        """
+        Converts reported forces to N, a whole array at a time
+        """
+        return np.polyval(self.coefficients, values)
+
+    def convert(self, rows, column, zero=0.0):
+        """
+        Returns a copy of `rows` with one column, less `zero`, converted to N
+        """
+        rows = np.array(rows, dtype=float)
+        rows[:, column] = self.apply(rows[:, column] - zero)
+        return rows
+
+    def describe(self):
+        terms = []
+        for power, coefficient in zip(range(len(self.coefficients) - 1, -1, -1), self.coefficients):
+            terms.append('%+.5g' % coefficient + ('' if not power else ' x' if power == 1 else ' x^' + str(power)))
+        text = 'F = ' + ' '.join(terms).lstrip('+') + ' N'
+        if self.linearity is not None:
+            text = text + ', linearity ' + '%.2f' % self.linearity + ' %'
+        if self.hysteresis is not None:
+            text = text + ', hysteresis ' + '%.2f' % self.hysteresis + ' %'
+        if self.noise is not None:
+            text = text + ', noise ' + '%.3f' % self.noise + ' N'
+        return text
+
+    def to_dict(self):
+        return {'rig': self.rig, 'version': self.version, 'created': self.created,
+            'operator': self.operator, 'coefficients': self.coefficients.tolist(),
+            'points': self.points, 'linearity': self.linearity,
+            'hysteresis': self.hysteresis, 'noise': self.noise}
+
+    @classmethod
+    def from_dict(cls, entry):
+        return cls(entry['rig'], entry['version'], entry['coefficients'],
+            entry.get('created'), entry.get('operator', ''), entry.get('points', ()),
+            entry.get('linearity'), entry.get('hysteresis'), entry.get('noise'))
+
+
+# the firmware's constant bias, which the host used to subtract from every
+# reading before rigs were calibrated
+uncalibrated = Calibration(None, 0, (1.0, -14.76))
+
+
+class Capture():
+    def __init__(self, rig, degree=default_degree):
+        """
+        The readings taken so far for one calibration
+        """
+        self.rig = rig
+        self.degree = degree
+        self.points = []
+
+    def add(self, load, readings):
+        readings = np.asarray(readings, dtype=float)
+        if len(readings) < min_readings:
+            raise CalibrationError('only ' + str(len(readings)) + ' readings at ' + str(load) + ' N')
+        self.points.append((float(load), readings))
+
+    def fit(self, operator=''):
+        """
+        Fits every reading at once and returns the unsaved Calibration
+        """
+        loads = np.array([load for load, readings in self.points])
+        if len(set(loads)) < self.degree + 1:
+            raise CalibrationError('need readings at ' + str(self.degree + 1) + ' different loads at least')
+        readings = np.concatenate([readings for load, readings in self.points])
+        targets = np.repeat(loads, [len(readings) for load, readings in self.points])
+        coefficients = np.linalg.lstsq(np.vander(readings, self.degree + 1), targets, rcond=None)[0]
+        means = np.array([readings.mean() for load, readings in self.points])
+        fitted = np.polyval(coefficients, means)
+        span = loads.max() - loads.min()
+        linearity = 100*np.abs(fitted - loads).max()/span
+        # a point is on the way down once a higher load has been applied
+        down = loads < np.maximum.accumulate(loads)
+        gaps = [abs(fitted[(loads == load) & down].mean() - fitted[(loads == load) & ~down].mean())
+            for load in set(loads[down]) & set(loads[~down])]
+        hysteresis = 100*max(gaps)/span if gaps else None
+        noise = max(np.polyval(coefficients, readings).std() for load, readings in self.points)
+        points = [(load, len(readings), float(readings.mean()), float(readings.std()))
+            for load, readings in self.points]
+        return Calibration(self.rig, None, coefficients, None, operator, points,
+            float(linearity), None if hysteresis is None else float(hysteresis), float(noise))
+
+
+class History():
+    def __init__(self, path=history_path):
+        """
+        Every calibration saved on this station, by rig, oldest first
+        """
+        self.path = path
+        self.lock = threading.Lock()
+        self.rigs = {}
+        if os.path.exists(path):
+            with open(path) as file:
+                for line in file:
+                    try:
+                        entry = Calibration.from_dict(json.loads(line))
+                    except (ValueError, KeyError, TypeError):
+                        # a line cut short by a crash, the rest still count
+                        continue
+                    self.rigs.setdefault(entry.rig, []).append(entry)
+
+    def versions(self, rig):
+        with self.lock:
+            return list(self.rigs.get(rig, []))
+
+    def current(self, rig):
+        with self.lock:
+            entries = self.rigs.get(rig)
+            return entries[-1] if entries else uncalibrated
+
+    def save(self, calibration):
+        """
+        Numbers the calibration as the rig's next version and appends it
+        """
+        with self.lock:
+            entries = self.rigs.setdefault(calibration.rig, [])
+            calibration.version = (entries[-1].version if entries else 0) + 1
+            calibration.created = time.strftime('%Y-%m-%dT%H:%M:%S')
+            with open(self.path, 'a') as file:
+                file.write(json.dumps(calibration.to_dict()) + '\n')
+                file.flush()
+                os.fsync(file.fileno())
+            entries.append(calibration)
+        return calibration
@@ -0,0 +1,374 @@
+"""
+Command line test runner
+
+Runs tests on a rig without the GUI, for scripted and overnight runs and
+for the line controller. Nothing here imports Qt or needs a display:
+
+    python cli.py tests
+    python cli.py rigs
+    python cli.py tare
+    python cli.py home
+    python cli.py force --offset -8423
+    python cli.py calibrate --loads 0,20,50,100,50,20,0 --operator AB
+    python cli.py run --test support --thickness 100 --sample S1 --doe D7 --operator AB
+    python cli.py run --test firmness --test support --samples samples.csv --operator AB
+
+The rig is the one given with --port, else the one named with --rig (or
+the only one) in uft.ini's [rigs] section or UFT_SERIAL_PORT, else the
+only one port discovery finds. A run tares first, with the platen clear
+of the sample, unless --offset is given. Each sample tested is printed as
+one JSON line. Samples with a sample id, DOE_ID and operator are committed
+the way the GUI commits them, curves and all, through the local journal,
+which is then uploaded once; rows that can't be uploaded yet go up with
+the next run or from the GUI. A sample list runs like the Batch tab: a
+line is read from stdin before each sample, so the operator presses Enter
+(or the line controller writes a line) once the foam is loaded, unless
+--no-wait is given. Ctrl+C cancels the test and retracts the platen, a
+second Ctrl+C stops the motor where it is. Every reading uses the rig's
+newest calibration; calibrate asks for each known load in turn, fits them
+and saves the result as the rig's next calibration.
+
+Exit status: 0 when every test passed, 1 when one didn't, 2 for bad usage.
+"""
+import argparse
+import json
+import os
+import sys
+import threading
+import time
+
+import batch
+import calibration
+import core
+import discovery
+import metrics
+import recipes
+from curvestore import CurveStore
+from journal import Journal, SyncWorker
+
+
+class UsageError(Exception):
+    pass
+
+
+def emit(fields):
+    print(json.dumps(fields))
+    sys.stdout.flush()
+
+
+def note(text):
+    print(text, file=sys.stderr)
+    sys.stderr.flush()
+
+
+def find_rig(args):
+    """
+    Returns the (name, port, arduino) of the rig to use. The arduino is
+    already connected when discovery had to probe for it, else None
+    """
+    if args.port:
+        return (args.rig or 'Rig', args.port, None)
+    rigs = core.load_rigs()
+    if rigs is not None:
+        rigs = [(name, port, None) for name, port in rigs]
+    else:
+        finder = discovery.Discovery(core.Arduino)
+        rigs = [(name, port, None) for name, port in finder.known()]
+        if not rigs:
+            rigs = finder.scan()[0]
+    chosen = [rig for rig in rigs if args.rig is None or rig[0] == args.rig]
+    for rig in rigs:
+        if rig[2] is not None and (len(chosen) != 1 or rig is not chosen[0]):
+            rig[2].close()
+    if not chosen:
+        raise UsageError('no rig found' if args.rig is None else 'no rig named ' + args.rig)
+    if len(chosen) > 1:
+        raise UsageError('several rigs found, pick one with --rig: '
+            + ', '.join(name for name, port, a in chosen))
+    return chosen[0]
+
+
+def find_recipes(names, available):
+    """
+    Returns the recipes asked for, by name (in any case) or file name
+    """
+    chosen = []
+    for wanted in names:
+        for recipe in available:
+            stem = os.path.splitext(os.path.basename(recipe.path or ''))[0]
+            if wanted.lower() in (recipe.name.lower(), stem.lower()):
+                chosen.append(recipe)
+                break
+        else:
+            raise UsageError('no test ' + repr(wanted) + ', see: python cli.py tests')
+    return chosen
+
+
+def report(sample):
+    emit({'sample_id': sample.sample_id, 'DOE_ID': sample.doe_id,
+        'thickness': sample.thickness, 'status': sample.status, 'note': sample.note,
+        'results': {key: value for key, value, text, curve in sample.results},
+        'notes': {key: text for key, value, text, curve in sample.results if text}})
+
+
+def execute(test):
+    """
+    Runs a core.Run on a worker thread, so Ctrl+C can cancel it cleanly.
+    Returns None or a (title, text) failure
+    """
+    outcome = []
+    finished = threading.Event()
+    def run():
+        try:
+            outcome.append(test.execute())
+        finally:
+            finished.set()
+    threading.Thread(target=run, daemon=True).start()
+    # an interrupted Thread.join() can report the thread finished early,
+    # an Event doesn't
+    while not finished.is_set():
+        try:
+            finished.wait(0.1)
+        except KeyboardInterrupt:
+            if test.cancelled.is_set():
+                test.abort()
+            else:
+                note('cancelling, Ctrl+C again to stop the motor where it is')
+                test.cancel()
+    if not outcome:
+        return ('Test Failed', 'the run ended with an error')
+    return outcome[0]
+
+
+######################################################### COMMANDS ########
+def load_recipes(args):
+    skipped = []
+    loaded = recipes.load_all(args.recipes, skipped)
+    for path, error in skipped:
+        note('skipping recipe ' + path + ': ' + error)
+    return loaded
+
+
+def command_tests(args):
+    for recipe in load_recipes(args):
+        emit({'test': recipe.name, 'path': recipe.path, 'results': recipe.results()})
+    return 0
+
+
+def command_rigs(args):
+    rigs = core.load_rigs()
+    if rigs is not None:
+        for name, port in rigs:
+            emit({'rig': name, 'port': port})
+        return 0
+    finder = discovery.Discovery(core.Arduino)
+    for name, port in finder.known():
+        emit({'rig': name, 'port': port})
+    for name, port, a in finder.scan()[0]:
+        emit({'rig': name, 'port': port, 'version': a.version})
+        a.close()
+    return 0
+
+
+def single(args, steps, *step_args, offset=None):
+    """
+    Runs one short sequence, like the tare or home buttons do
+    """
+    name, port, a = find_rig(args)
+    session = core.ArduinoSession(port, arduino=a, calibration=calibration.History().current(name))
+    if offset is not None:
+        session.tare.set(offset)
+    readings = {}
+    try:
+        failure = execute(core.Run(steps, session, *step_args,
+            result=lambda key, value, text: readings.__setitem__(key, value)))
+    finally:
+        session.close()
+    if failure is not None:
+        emit({'rig': name, 'error': failure[0] + ': ' + failure[1]})
+        return 1
+    emit(dict(readings, rig=name))
+    return 0
+
+
+def command_tare(args):
+    return single(args, core.tare_steps)
+
+
+def command_force(args):
+    return single(args, core.force_steps, offset=args.offset)
+
+
+def command_home(args):
+    return single(args, core.home_steps)
+
+
+def command_run(args):
+    chosen = find_recipes(args.test, load_recipes(args))
+    if args.samples:
+        samples = batch.load_samples(args.samples)
+    elif args.thickness is None:
+        raise UsageError('give the sample --thickness in mm, or a --samples list')
+    else:
+        samples = [batch.BatchSample(args.sample or '', args.doe or '', args.thickness)]
+    commit = not args.no_commit and bool(args.operator)
+    if not args.no_commit:
+        if not args.operator:
+            note('not committing: no --operator')
+        elif not all(sample.sample_id and sample.doe_id for sample in samples):
+            note('not committing samples without a sample id and DOE_ID')
+    run = batch.Batch(samples, chosen, args.operator or '', args.date)
+    journal = Journal() if commit else None
+    curvestore = CurveStore() if commit else None
+    name, port, a = find_rig(args)
+    session = core.ArduinoSession(port, arduino=a, calibration=calibration.History().current(name))
+    committed = 0
+    try:
+        a = session.connect()
+        if a.failout != 'good conn':
+            emit({'rig': name, 'error': 'No Serial Connect: could not open ' + str(port)})
+            return 1
+        if args.offset is None:
+            note(name + ' tared at ' + '%.7g' % session.retare())
+        else:
+            session.tare.set(args.offset)
+        sample = run.start()
+        while sample is not None:
+            if args.samples and not args.no_wait:
+                note('load sample ' + sample.sample_id + ' (' + '%g' % sample.thickness + ' mm) and press Enter')
+                if not sys.stdin.readline():
+                    run.stopped = True
+                    break
+            sample.status = batch.running
+            progress = None
+            if sys.stderr.isatty():
+                progress = lambda percent: print('\r' + sample.sample_id + ' ' + str(percent) + '%',
+                    end='', file=sys.stderr)
+            failure = execute(core.Run(core.batch_steps, session, sample, chosen,
+                progress=progress, result=sample.result, record=sample.curve))
+            if progress is not None:
+                print(file=sys.stderr)
+            if failure is None:
+                sample.status = batch.done
+                if commit and sample.sample_id and sample.doe_id:
+                    test_names = {}
+                    for recipe in chosen:
+                        test_names.update(recipe.results())
+                    committed += len(batch.commit_sample(journal, curvestore, sample,
+                        run.operator, run.test_date, test_names))
+            else:
+                sample.status = batch.failed
+                sample.note = failure[0] + ' (' + failure[1] + ')'
+                if failure[0] in ('Test Cancelled', 'Test Aborted', 'No Serial Connect'):
+                    run.stopped = True
+            report(sample)
+            if session.tare.alert is not None:
+                note(name + ': ' + session.tare.alert + ', clear the load cell and tare')
+            sample = run.advance()
+    finally:
+        session.close()
+    for sample in samples:
+        if sample.status == batch.failed and sample.plans == []:
+            # rows whose thickness the tests can't use were skipped
+            report(sample)
+    if committed:
+        try:
+            SyncWorker(journal).sync()
+            note(str(committed) + ' results committed')
+        except Exception as error:
+            note(str(committed) + ' results saved to the journal, the upload failed (' + str(error)
+                + ') and will be retried')
+        journal.close()
+    metrics.export()
+    counts = run.counts()
+    return 0 if counts.get(batch.done, 0) == len(samples) else 1
+
+
+def command_calibrate(args):
+    try:
+        loads = [float(load) for load in args.loads.split(',')]
+    except ValueError:
+        raise UsageError('--loads takes known loads in N separated by commas')
+    history = calibration.History()
+    name, port, a = find_rig(args)
+    session = core.ArduinoSession(port, arduino=a)
+    capture = calibration.Capture(name, args.degree)
+    try:
+        a = session.connect()
+        if a.failout != 'good conn':
+            emit({'rig': name, 'error': 'No Serial Connect: could not open ' + str(port)})
+            return 1
+        if args.offset is None:
+            note('clear the load cell and press Enter to tare')
+            if not sys.stdin.readline():
+                return 1
+            session.retare()
+        else:
+            session.tare.set(args.offset)
+        for load in loads:
+            note('put ' + '%g' % load + ' N on the load cell and press Enter')
+            if not sys.stdin.readline():
+                return 1
+            readings = {}
+            failure = execute(core.Run(core.calibration_steps, session, args.seconds,
+                result=lambda key, value, text: readings.__setitem__(key, value)))
+            if failure is not None:
+                emit({'rig': name, 'error': failure[0] + ': ' + failure[1]})
+                return 1
+            capture.add(load, readings['readings'])
+    finally:
+        session.close()
+    fitted = capture.fit(args.operator or '')
+    if not args.dry_run:
+        history.save(fitted)
+    emit(fitted.to_dict())
+    note(fitted.label + ': ' + fitted.describe() if fitted.version else fitted.describe())
+    return 0
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Run tests on a rig from the command line')
+    parser.add_argument('--port', help='serial port of the rig')
+    parser.add_argument('--rig', help='name of the rig in uft.ini or rigs.json')
+    parser.add_argument('--recipes', default=recipes.recipe_root, help='folder of test recipes')
+    commands = parser.add_subparsers(dest='command', required=True)
+    commands.add_parser('tests', help='list the tests')
+    commands.add_parser('rigs', help='list the rigs attached')
+    commands.add_parser('tare', help='tare the load cell')
+    commands.add_parser('home', help='retract the platen home')
+    force = commands.add_parser('force', help='read the force')
+    force.add_argument('--offset', type=float, required=True, help='tare offset to read against')
+    calibrate = commands.add_parser('calibrate', help='calibrate the load cell with known loads')
+    calibrate.add_argument('--loads', required=True,
+        help='known loads in N in the order they go on and off, e.g. 0,20,50,100,50,20,0')
+    calibrate.add_argument('--seconds', type=float, default=calibration.point_seconds,
+        help='s of readings per load')
+    calibrate.add_argument('--degree', type=int, default=calibration.default_degree,
+        help='degree of the fitted polynomial')
+    calibrate.add_argument('--operator', default=os.environ.get('UFT_OPERATOR'),
+        help='operator ID, UFT_OPERATOR by default')
+    calibrate.add_argument('--offset', type=float, help='tare offset, instead of taring first')
+    calibrate.add_argument('--dry-run', action='store_true', help="fit but don't save")
+    run = commands.add_parser('run', help='run tests on a sample or a list of samples')
+    run.add_argument('--test', action='append', required=True,
+        help='test to run, by name or recipe file name; repeat for several')
+    run.add_argument('--thickness', type=float, help='sample thickness in mm')
+    run.add_argument('--sample', help='sample id')
+    run.add_argument('--doe', help='DOE_ID')
+    run.add_argument('--samples', help='CSV sample list (sample_id, DOE_ID and thickness columns)')
+    run.add_argument('--operator', default=os.environ.get('UFT_OPERATOR'),
+        help='operator ID, UFT_OPERATOR by default')
+    run.add_argument('--date', default=time.strftime('%Y-%m-%d'), help='test date, today by default')
+    run.add_argument('--offset', type=float, help='tare offset, instead of taring first')
+    run.add_argument('--no-wait', action='store_true', help="don't wait for a line on stdin between samples")
+    run.add_argument('--no-commit', action='store_true', help='only print the results')
+    args = parser.parse_args(argv)
+    try:
+        return globals()['command_' + args.command](args)
+    except (UsageError, batch.BatchError, calibration.CalibrationError) as error:
+        note('error: ' + str(error))
+        return 2
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,1420 @@
+"""
+Rig control and test sequences, without Qt
+
+Everything needed to run a test: the serial client for the rig's Arduino,
+the force stream and settle detection, test curves, and the step functions
+that run recipes. Steps run inside a Run, which reports progress, results
+and curves through plain callbacks, so the GUI (UFT.py), the command line
+runner (cli.py) and the benchmarks drive the same code. Nothing here
+imports Qt or opens a dialog.
+"""
+import time
+import configparser
+import importlib.util
+import os
+import sys
+import threading
+import queue
+import concurrent.futures
+import collections
+
+
+def lazy_import(name):
+    """
+    Registers a module that is only really imported the first time one of its
+    attributes is used, so startup doesn't wait on imports it doesn't need yet
+    """
+    if name in sys.modules:
+        return sys.modules[name]
+    spec = importlib.util.find_spec(name)
+    spec.loader = importlib.util.LazyLoader(spec.loader)
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[name] = module
+    spec.loader.exec_module(module)
+    return module
+
+serial = lazy_import('serial')
+import numpy as np
+import calibration
+import estimators
+import database
+import metrics
+import protocol
+import recipes
+
+
+######################################################################################################################
+######################################################################################################################
+######################################################################################################################
+######################################################################################################################
+######################################################################################################################
+
+extend = 11
+retract = 10
+fullspeed = 255.0
+halfspeed = 127.0
+quarterspeed = 63.75
+default_pausetime = 5
+default_forcestop = 2
+approach_travel = 100
+approach_speed = quarterspeed
+stream_buffer_size = 8192
+stream_max_age = 0.5
+handshake_timeout = 0.5
+support_holdtime = 60
+settle_window = 1.0
+settle_rate = 0.05
+settle_tolerance = 0.002
+settle_poll = 0.05
+move_timeout = 60
+curve_capacity = 16384
+tare_window = 2.0
+tare_interval = 5.0
+tare_min_samples = 10
+tare_noise = 0.5
+tare_drift_limit = 2.0
+tare_history = 720
+measure_window = 0.5
+trace_size = 4096
+trace_resolution = 0.01
+
+######################################################################################################################
+######################################################################################################################
+######################################################################################################################
+######################################################################################################################
+######################################################################################################################
+
+#################################################  SERIAL COMMUNICATION CLASS ########################################
+MoveResult = collections.namedtuple('MoveResult', 'position elapsed speed')
+
+
+class MoveFault(Exception):
+    pass
+
+
+class Arduino():
+    def __init__(self, serial_port='COM3', baud_rate=9600,
+            read_timeout=5, reset_delay=2, binary=True):
+        """
+        Initializes the serial connection to the Arduino board
+        """
+        self.serial_port = serial_port
+        self.baud_rate = baud_rate
+        self.read_timeout = read_timeout
+        self.reset_delay = reset_delay
+        self.binary = binary
+        self.lock = threading.RLock()
+        #pairs an ASCII request with its reply line, without holding up the
+        #reader thread, which needs self.lock to report moves done
+        self.request_lock = threading.Lock()
+        self.conn = None
+        self.mode = 'ascii'
+        self.version = 0
+        self.seq = 0
+        self.pending = {}
+        self.replies = queue.Queue()
+        self.listeners = []
+        self.reader = None
+        self.reader_conn = None
+        self.streaming = False
+        self.stream_offset = 0
+        self.move = None
+        self.move_distance = None
+        #where the firmware last said the platen was, in mm
+        self.position = None
+        #the move under way as (monotonic start, from mm, to mm, speed setting)
+        self.motion = None
+        #mm/s the platen was last measured to move at, per speed setting
+        self.speeds = {}
+        self.program = None
+        self.program_ops = None
+        self.open()
+
+    def open(self):
+        """
+        Opens the port, waits out the board reset that opening it triggers and
+        then agrees on a protocol with the firmware
+        """
+        try:
+            self.conn = serial.Serial(self.serial_port, self.baud_rate)
+            self.conn.timeout = self.read_timeout # Timeout for readline()
+            time.sleep(self.reset_delay)
+            self.failout = 'good conn'
+            self.handshake()
+        except (serial.SerialException, OSError):
+            self.failout = 'failed out of arduino'
+            # a handle left open keeps the replugged port busy on Windows
+            if self.conn is not None:
+                try:
+                    self.conn.close()
+                except (serial.SerialException, OSError):
+                    pass
+                self.conn = None
+        if self.failout == 'good conn' and self.streaming:
+            # the board forgot it was streaming when it reset
+            self.stream(self.stream_offset)
+        return self.failout
+
+    def handshake(self):
+        """
+        Asks the firmware for its protocol version ('RV0:0' -> 'V:<n>'). Boards
+        that speak the binary framing in protocol.py are switched over to it,
+        anything else (including firmware too old to answer) stays on ASCII
+        """
+        self.mode = 'ascii'
+        self.version = 0
+        self.conn.timeout = handshake_timeout
+        try:
+            self.conn.reset_input_buffer()
+            self.conn.write(b'RV0:0')
+            line = self.conn.readline().decode(errors='replace').strip()
+            if line.startswith('V:'):
+                self.version = int(line.split(':')[1])
+            if self.binary and self.version >= protocol.VERSION:
+                self.conn.write((''.join(('WB', str(protocol.VERSION), ':', str(0)))).encode())
+                if self.conn.readline().decode(errors='replace').strip() == 'OK':
+                    self.mode = 'binary'
+        except (ValueError, IndexError):
+            pass
+        finally:
+            self.conn.timeout = self.read_timeout
+        if self.version >= 1:
+            # binary replies and move done messages are picked up by the reader
+            self._start_reader()
+
+    def _start_reader(self):
+        if not self._reading():
+            self.reader_conn = self.conn
+            self.reader = threading.Thread(target=self._read_loop,
+                args=(self.conn,), daemon=True)
+            self.reader.start()
+
+    def _reading(self):
+        return (self.reader is not None and self.reader.is_alive()
+            and self.reader_conn is self.conn)
+
+    def _readline(self):
+        if self._reading():
+            try:
+                return self.replies.get(timeout=self.read_timeout)
+            except queue.Empty:
+                return ''
+        return self.conn.readline().decode().strip()
+
+    def _read_loop(self, conn):
+        """
+        Runs on the reader thread. Force samples go to the listeners, binary
+        replies to the Future waiting on their sequence id and everything else
+        is queued as a reply line
+        """
+        frames = protocol.FrameReader()
+        while conn is self.conn and self.failout == 'good conn':
+            try:
+                if self.mode == 'binary':
+                    data = conn.read(conn.in_waiting or 1)
+                else:
+                    line = conn.readline().decode(errors='replace').strip()
+            except (serial.SerialException, OSError, TypeError):
+                break
+            if self.mode == 'binary':
+                for frame in frames.feed(data):
+                    self._frame(*frame)
+            elif line.startswith('S:'):
+                try:
+                    self._sample(float(line.split(':')[2]))
+                except (IndexError, ValueError):
+                    continue
+            elif line.startswith('MD:') or line.startswith('MF:'):
+                # 'MD:<position>:<elapsed ms>' or 'MF:<fault code>:<position>'
+                fields = (line.split(':') + ['', ''])[1:3]
+                if line.startswith('MD:'):
+                    self._move_done(0, *fields)
+                else:
+                    self._move_done(fields[0] or 'fault', fields[1], 0)
+            elif line.startswith('QD:') or line.startswith('QF:'):
+                # 'QD:<step>:<position>:<elapsed ms>' or 'QF:<step>:<fault code>:<position>'
+                fields = (line.split(':') + ['', '', ''])[1:4]
+                if line.startswith('QD:'):
+                    self._step_done(fields[0], 0, fields[1], fields[2])
+                else:
+                    self._step_done(fields[0], fields[1] or 'fault', fields[2], 0)
+            elif line:
+                self.replies.put(line)
+
+    def _sample(self, force):
+        stamp = time.monotonic()
+        for listener in self.listeners:
+            listener(stamp, force)
+
+    def _frame(self, seq, code, pin, a, b):
+        if code == 'SF':
+            self._sample(b)
+        elif code == 'MD':
+            self._move_done(pin, a, b)
+        elif code == 'QD' and not seq:
+            self._step_done(pin, 0, a, b)
+        elif code == 'QF' and not seq:
+            self._step_done(pin, int(b) or 'fault', a, 0)
+        elif seq:
+            future = self.pending.pop(seq, None)
+            if future is not None and not future.done():
+                future.set_result((pin, a, b))
+        else:
+            # unsolicited text from the firmware, e.g. calibration progress
+            self.replies.put(':'.join((code, '%.7g' % a, '%.7g' % b)))
+
+    def _move_done(self, fault, position, elapsed):
+        with self.lock:
+            move, distance = self.move, self.move_distance
+            self.move = None
+        if move is None or move.done():
+            return
+        try:
+            position = float(position)
+        except ValueError:
+            position = None
+        try:
+            elapsed = float(elapsed)/1000
+        except ValueError:
+            elapsed = None
+        self._arrive(position, elapsed)
+        if fault:
+            move.set_exception(MoveFault('move failed (' + str(fault) + ') at ' + str(position)))
+            return
+        speed = None
+        if distance is not None and elapsed:
+            speed = float(distance)/elapsed
+        move.set_result(MoveResult(position, elapsed, speed))
+
+    def _step_done(self, index, fault, position, elapsed):
+        """
+        Resolves the Future of an uploaded program step. A failed step fails
+        every step after it too, since the firmware drops the rest
+        """
+        try:
+            index = int(index)
+            position = float(position)
+            elapsed = float(elapsed)/1000
+        except ValueError:
+            return
+        with self.lock:
+            program, ops = self.program, self.program_ops
+            if program is None or not 0 <= index < len(program):
+                return
+            if fault or index == len(program) - 1:
+                self.program = None
+        self._arrive(position, elapsed)
+        if not fault and index + 1 < len(ops):
+            self._plan(*ops[index + 1])
+        if not fault:
+            if not program[index].done():
+                program[index].set_result(MoveResult(position, elapsed, None))
+            return
+        for step in program[index:]:
+            if not step.done():
+                step.set_exception(MoveFault('step ' + str(index) + ' failed ('
+                    + str(fault) + ') at ' + str(position)))
+
+    def _plan(self, op, distance, speedvalue):
+        """
+        Notes a move as it starts, so position_at() can place force samples
+        along it. `op` is a program op (see recipes.py); dwells don't move
+        """
+        if op == recipes.op_extend:
+            target = None if self.position is None else self.position + float(distance)
+        elif op == recipes.op_retract:
+            target = None if self.position is None else max(self.position - float(distance), 0.0)
+        elif op == 'home':
+            target = 0.0
+            # the firmware homes at full speed
+            speedvalue = fullspeed
+        else:
+            target = None
+        self.motion = None if target is None else (time.monotonic(), self.position, target, speedvalue)
+
+    def _arrive(self, position, elapsed):
+        """
+        Takes the position the firmware reports a move ended at, and how
+        fast it got there from where it started for moves at that speed
+        """
+        motion, self.motion = self.motion, None
+        if position is None:
+            return
+        self.position = position
+        if motion is not None and motion[1] is not None and elapsed and position != motion[1]:
+            self.speeds[motion[3]] = abs(position - motion[1])/elapsed
+
+    def position_at(self, stamp):
+        """
+        Where the platen is at monotonic time `stamp`: interpolated along
+        the move under way at the speed last measured for its setting, or
+        scaled from the nearest setting that was measured. Between moves,
+        and before any move has been timed, it is where the firmware last
+        reported it, as a commanded end that a force stop cuts short would
+        throw the plot's scale
+        """
+        motion = self.motion
+        if motion is None or motion[1] is None:
+            return self.position
+        start, origin, target, speedvalue = motion
+        speeds = dict(self.speeds)
+        if speedvalue in speeds:
+            speed = speeds[speedvalue]
+        elif speeds:
+            nearest = min(speeds, key=lambda setting: abs(setting - speedvalue))
+            speed = speeds[nearest]*speedvalue/nearest
+        else:
+            return origin
+        travel = speed*max(stamp - start, 0.0)
+        if travel >= abs(target - origin):
+            return target
+        return origin + travel if target > origin else origin - travel
+
+    def _begin_move(self, distance=None):
+        """
+        Returns the Future for the move about to be commanded. It resolves to a
+        MoveResult when the firmware reports the move done, or raises MoveFault.
+        Firmware that never reports moves gets an already resolved Future
+        """
+        move = concurrent.futures.Future()
+        if self.version < 1:
+            move.set_result(MoveResult(None, None, None))
+            return move
+        with self.lock:
+            if self.move is not None and not self.move.done():
+                self.move.set_exception(MoveFault('superseded by a new move'))
+            self.move = move
+            self.move_distance = distance
+        return move
+
+    def finish(self, move, timeout=move_timeout):
+        """
+        Waits for a move to complete. A move that overruns the timeout is
+        stopped and reported as a MoveFault
+        """
+        try:
+            return move.result(timeout)
+        except concurrent.futures.TimeoutError:
+            self.stop()
+            raise MoveFault('move did not finish within ' + str(timeout) + ' s')
+        except concurrent.futures.CancelledError:
+            raise MoveFault('connection closed during move')
+
+    def _write(self, data):
+        """
+        Writes to the port. If the board dropped off the USB bus the port is
+        reopened once before giving up
+        """
+        with self.lock:
+            for attempt in range(2):
+                if self.failout != 'good conn':
+                    metrics.count('serial_reconnects', port=self.serial_port)
+                    with metrics.span('serial_open', port=self.serial_port):
+                        reconnected = self.open()
+                    if reconnected != 'good conn':
+                        break
+                try:
+                    self.conn.write(data)
+                    return
+                except (serial.SerialException, OSError):
+                    # nothing reached the board, safe to reopen and resend
+                    self.close()
+            raise serial.SerialException('lost connection to ' + str(self.serial_port))
+
+    def _send(self, command, reply=False):
+        """
+        Writes one ASCII command and optionally waits for its reply line.
+        Replies that came in after their request timed out are dropped first
+        """
+        with self.request_lock:
+            if reply:
+                self._drain()
+            self._write(command)
+            if not reply:
+                return
+            try:
+                return self._readline()
+            except (serial.SerialException, OSError):
+                # the command may have run, so don't send it again
+                self.close()
+                raise serial.SerialException('lost connection to ' + str(self.serial_port))
+
+    def submit(self, code, pin=0, a=0.0, b=0.0):
+        """
+        Sends one binary frame without waiting and returns a Future that
+        resolves to the (status, a, b) reply, so commands can be pipelined
+        """
+        future = concurrent.futures.Future()
+        with self.lock:
+            self.seq = self.seq % 255 + 1
+            stale = self.pending.pop(self.seq, None)
+            if stale is not None:
+                stale.cancel()
+            self.pending[self.seq] = future
+            self._write(protocol.pack(self.seq, code, pin, a, b))
+        return future
+
+    def upload(self, ops):
+        """
+        Sends a program of (op, a, b) steps (see recipes.py) to firmware that
+        runs sequences, all in one write: 'QC' clears the program, a 'QA' per
+        op appends it and 'QR' starts it. Returns a Future per step that
+        resolves to a MoveResult when the firmware reports the step done, or
+        raises MoveFault if it fails or the program is stopped
+        """
+        steps = [concurrent.futures.Future() for op in ops]
+        commands = ([('QC', 0, 0.0, 0.0)] + [('QA', op, a, b) for op, a, b in ops]
+            + [('QR', len(ops), 0.0, 0.0)])
+        with self.lock:
+            if self.program is not None:
+                for step in self.program:
+                    if not step.done():
+                        step.set_exception(MoveFault('superseded by a new program'))
+            self.program = steps
+            self.program_ops = list(ops)
+            if ops:
+                self._plan(*ops[0])
+            if self.mode == 'binary':
+                data = bytearray()
+                for code, pin, a, b in commands:
+                    # the acknowledgements are not waited for
+                    self.seq = self.seq % 255 + 1
+                    stale = self.pending.pop(self.seq, None)
+                    if stale is not None:
+                        stale.cancel()
+                    data += protocol.pack(self.seq, code, pin, a, b)
+            else:
+                data = b''.join((''.join((code, str(pin), ':', str(a), ':', str(b)))).encode()
+                    for code, pin, a, b in commands)
+            with metrics.span('serial_command', command='QR', port=self.serial_port):
+                self._write(bytes(data))
+        return steps
+
+    def command(self, code, pin, *args, reply=False):
+        """
+        Sends a command in whichever protocol the handshake settled on and
+        returns the reply as text, the same way for both protocols. The time
+        from write to reply is recorded, and a reply that never came is
+        counted as a timeout
+        """
+        with metrics.span('serial_command', command=code, port=self.serial_port):
+            if self.mode == 'binary':
+                future = self.submit(code, pin, *[float(arg) for arg in args])
+                if not reply:
+                    return
+                try:
+                    status, a, b = future.result(self.read_timeout)
+                    line = '%.7g' % a
+                except (concurrent.futures.TimeoutError, concurrent.futures.CancelledError):
+                    line = ''
+            else:
+                command = (''.join((code, str(pin), ':', ':'.join(str(arg) for arg in args)))).encode()
+                line = self._send(command, reply)
+        if reply and not line:
+            metrics.count('serial_timeouts', command=code, port=self.serial_port)
+        return line
+
+    def gohome(self):
+        move = self._begin_move()
+        self._plan('home', 0.0, fullspeed)
+        self.command('WH', 0, 0)
+        return move
+
+    def go_the_distance(self, pin_number, distance, speedvalue):
+        move = self._begin_move(distance)
+        self._plan(recipes.op_extend if pin_number == extend else recipes.op_retract, distance, speedvalue)
+        self.command('WG', pin_number, distance, speedvalue)
+        return move
+
+    def force_stop(self, force, offset):
+        return self.command('WF', 0, force, offset, reply=True)
+
+    def stop(self):
+        self.command('WS', 0, 0)
+
+    def close(self):
+        self.failout = 'failed out of arduino'
+        for future in list(self.pending.values()):
+            future.cancel()
+        self.pending.clear()
+        if self.move is not None:
+            self.move.cancel()
+        for step in self.program or []:
+            step.cancel()
+        self.program = None
+        self.motion = None
+        try:
+            if self.conn is not None:
+                self.conn.close()
+        except (serial.SerialException, OSError):
+            pass
+
+    def _drain(self):
+        while True:
+            try:
+                self.replies.get_nowait()
+            except queue.Empty:
+                return
+
+    def readline(self):
+        with self.request_lock:
+            return self._readline()
+
+    def read(self, offset):
+        return self.command('RF', 0, offset, reply=True)
+
+    def tare(self):
+        return self.command('RT', 0, 0, reply=True)
+
+    def calib(self, spring):
+        self.command('WC', 0, spring, 0)
+        return
+
+    def stream(self, offset, on=True):
+        """
+        Asks the firmware to push force samples continuously ('RS1:<offset>')
+        or to stop ('RS0:0'). Once started, a reader thread owns the port and
+        hands replies back to _send through a queue
+        """
+        with self.lock:
+            self.streaming = on
+            self.stream_offset = offset
+            if on:
+                self._start_reader()
+                self.command('RS', 1, offset)
+            else:
+                self.command('RS', 0, 0)
+
+class RingBuffer():
+    def __init__(self, size=stream_buffer_size, columns=2):
+        """
+        Fixed size buffer of (time, value, ...) rows. Appending never allocates,
+        the oldest rows are overwritten once it is full
+        """
+        self.size = size
+        self.data = np.zeros((size, columns))
+        self.count = 0
+        self.lock = threading.Lock()
+
+    def append(self, row):
+        with self.lock:
+            self.data[self.count % self.size] = row
+            self.count += 1
+
+    def clear(self):
+        with self.lock:
+            self.count = 0
+
+    def latest(self, n=1):
+        """
+        Returns a copy of the last n rows, oldest first
+        """
+        with self.lock:
+            n = min(n, self.count, self.size)
+            index = np.arange(self.count - n, self.count) % self.size
+            return self.data[index]
+
+    def since(self, start):
+        rows = self.latest(self.size)
+        return rows[rows[:, 0] >= start]
+
+    def window(self, seconds):
+        rows = self.latest(self.size)
+        if not len(rows):
+            return rows
+        return rows[rows[:, 0] >= rows[-1, 0] - seconds]
+
+
+class Tare():
+    def __init__(self, drift_limit=tare_drift_limit):
+        """
+        The rig's zero. `offset` is the raw count the firmware subtracts,
+        from the last tare with the load cell clear, and `zero` is how far
+        the force it reports with nothing on the cell has wandered since,
+        which is taken off every reading. While the platen is retracted the
+        zero follows the unloaded stream, so drift is corrected without
+        taring again, and `alert` says so once it passes `drift_limit` N
+        """
+        self.drift_limit = drift_limit
+        self.offset = None
+        self.reference = None
+        self.zero = 0.0
+        self.drift = 0.0
+        self.retracted = False
+        self.since = 0.0
+        self.tracked = 0.0
+        self.history = collections.deque(maxlen=tare_history)
+        self.alert = None
+        self.lock = threading.Lock()
+
+    def set(self, offset):
+        """
+        Starts over from a new tare, the firmware's reply or a known offset
+        """
+        try:
+            offset = float(offset)
+        except ValueError:
+            raise ValueError('no reply to the tare')
+        with self.lock:
+            self.offset = offset
+            self.reference = None
+            self.zero = 0.0
+            self.drift = 0.0
+            self.alert = None
+            self.since = time.monotonic()
+            self.history.clear()
+        return offset
+
+    def require(self):
+        if self.offset is None:
+            raise ValueError('tare the load cell first')
+        return self.offset
+
+    def track(self, rows, calibration):
+        """
+        Moves the zero to the mean of `rows`, (time, reported force) taken
+        with nothing on the load cell since the last tare, unless they are
+        too few or too noisy to be a clear cell
+        """
+        with self.lock:
+            rows = rows[rows[:, 0] >= self.since]
+            if self.offset is None or len(rows) < tare_min_samples:
+                return
+            self.tracked = time.monotonic()
+            if calibration.apply(rows[:, 1]).std() > tare_noise:
+                return
+            level = rows[:, 1].mean()
+            if self.reference is None:
+                # the first clear reading after a tare is what zero looks like
+                self.reference = level
+            self.zero = level - self.reference
+            self.drift = float(calibration.apply(level) - calibration.apply(self.reference))
+            self.history.append((time.time(), self.drift))
+            if abs(self.drift) > self.drift_limit:
+                self.alert = 'zero drifted ' + '%+.1f' % self.drift + ' N since the tare'
+            else:
+                self.alert = None
+
+    def rate(self):
+        """
+        Drift over the tracked history in N/h, or None until it spans a minute
+        """
+        with self.lock:
+            history = np.array(self.history)
+        if len(history) < 2 or history[-1, 0] - history[0, 0] < 60:
+            return None
+        return 3600*np.polyfit(history[:, 0] - history[0, 0], history[:, 1], 1)[0]
+
+    def describe(self):
+        if self.offset is None:
+            return 'not tared'
+        text = '%.7g' % self.offset
+        if self.reference is not None:
+            text = text + ', drift ' + '%+.2f' % self.drift + ' N'
+            rate = self.rate()
+            if rate is not None:
+                text = text + ' (' + '%+.2f' % rate + ' N/h)'
+        return text
+
+
+class Trace():
+    def __init__(self, size=trace_size, resolution=trace_resolution):
+        """
+        A whole run of (time, position, force) samples in bounded memory, for
+        live plots. Samples go into buckets `resolution` s long that keep the
+        first time, last position and lowest and highest force. Once `size`
+        buckets are used neighbouring pairs are merged into buckets twice as
+        long, so a run of any length fits at the best resolution it allows
+        """
+        self.size = size
+        self.resolution = resolution
+        # bucket number, time, position, lowest force, highest force
+        self.data = np.zeros((size, 5))
+        self.lock = threading.Lock()
+        self.version = 0
+        self.clear()
+
+    def clear(self):
+        with self.lock:
+            self.count = 0
+            self.width = self.resolution
+            self.start = None
+            self.version += 1
+
+    def add(self, stamp, position, force):
+        with self.lock:
+            if self.start is None:
+                self.start = stamp
+            key = (stamp - self.start)//self.width
+            if self.count and self.data[self.count - 1, 0] == key:
+                row = self.data[self.count - 1]
+                row[2] = position
+                row[3] = min(row[3], force)
+                row[4] = max(row[4], force)
+            else:
+                while self.count == self.size:
+                    self._merge()
+                    key = (stamp - self.start)//self.width
+                self.data[self.count] = (key, stamp - self.start, position, force, force)
+                self.count += 1
+            self.version += 1
+
+    def _merge(self):
+        rows = self.data[:self.count]
+        keys = rows[:, 0]//2
+        starts = np.flatnonzero(np.concatenate(([True], keys[1:] != keys[:-1])))
+        ends = np.append(starts[1:], len(rows)) - 1
+        merged = np.column_stack((keys[starts], rows[starts, 1], rows[ends, 2],
+            np.minimum.reduceat(rows[:, 3], starts), np.maximum.reduceat(rows[:, 4], starts)))
+        self.count = len(merged)
+        self.data[:self.count] = merged
+        self.width *= 2
+
+    def rows(self):
+        """
+        Returns a copy of the (time, position, lowest, highest force) buckets
+        and the version they are at
+        """
+        with self.lock:
+            return self.data[:self.count, 1:].copy(), self.version
+
+
+class ForceStream():
+    def __init__(self, size=stream_buffer_size, calibration=calibration.uncalibrated, tare=None):
+        """
+        Collects the samples an Arduino streams into a RingBuffer of
+        (monotonic time, force) rows so readers never need a serial round
+        trip. Forces are buffered as the firmware reports them and converted
+        with `calibration`, less the `tare`'s zero, as they are read out.
+        While the platen is retracted the tare follows the buffered zero
+        every tare_interval s. The whole run also goes into a Trace for
+        the live plot
+        """
+        self.buffer = RingBuffer(size)
+        self.trace = Trace()
+        self.calibration = calibration
+        self.tare = Tare() if tare is None else tare
+        self.arduino = None
+        self.offset = None
+
+    def _sample(self, stamp, force):
+        self.buffer.append((stamp, force))
+        position = self.arduino.position_at(stamp) if self.arduino is not None else None
+        self.trace.add(stamp, np.nan if position is None else position, force)
+        if self.tare.retracted and stamp - self.tare.tracked >= tare_interval:
+            self.track()
+
+    def track(self):
+        if self.tare.retracted:
+            self.tare.track(self.buffer.window(tare_window), self.calibration)
+
+    def start(self, arduino, offset):
+        if arduino is self.arduino and str(offset) == str(self.offset) and arduino.streaming:
+            return
+        if self.arduino is not None and self._sample in self.arduino.listeners:
+            self.arduino.listeners.remove(self._sample)
+        self.buffer.clear()
+        self.arduino = arduino
+        self.offset = offset
+        arduino.listeners.append(self._sample)
+        arduino.stream(offset)
+
+    def stop(self):
+        if self.arduino is not None:
+            if self._sample in self.arduino.listeners:
+                self.arduino.listeners.remove(self._sample)
+            if self.arduino.failout == 'good conn':
+                self.arduino.stream(0, on=False)
+        self.arduino = None
+        self.offset = None
+
+    def latest(self, max_age=stream_max_age, raw=False):
+        """
+        Returns the newest force, or None if nothing arrived in the last
+        max_age s. `raw` leaves it as the firmware reported it
+        """
+        rows = self.buffer.latest()
+        if not len(rows) or time.monotonic() - rows[-1, 0] > max_age:
+            return None
+        if raw:
+            return rows[-1, 1]
+        return float(self.calibration.apply(rows[-1, 1] - self.tare.zero))
+
+    def window(self, seconds):
+        return self.calibration.convert(self.buffer.window(seconds), 1, self.tare.zero)
+
+    def traced(self):
+        """
+        Returns the trace's buckets with their forces in N, and its version
+        """
+        rows, version = self.trace.rows()
+        rows[:, 2:] = self.calibration.apply(rows[:, 2:] - self.tare.zero)
+        return rows, version
+
+    def rate(self):
+        """
+        Returns the sample rate over what is currently buffered, in Hz
+        """
+        rows = self.buffer.latest(self.buffer.size)
+        if len(rows) < 2 or rows[-1, 0] == rows[0, 0]:
+            return 0.0
+        return (len(rows) - 1)/(rows[-1, 0] - rows[0, 0])
+
+
+class SettleDetector():
+    def __init__(self, stream, window=settle_window, rate=settle_rate,
+            tolerance=settle_tolerance, contact=default_forcestop):
+        """
+        Ends a dwell as soon as the foam has stopped relaxing. The force trend
+        over the last `window` s is fitted to a line, and the dwell is settled
+        once its slope is below `rate` N/s or below `tolerance` of the force per
+        second. Forces under `contact` N are never treated as settled so a
+        platen that is still travelling towards the foam can't end it early
+        """
+        self.stream = stream
+        self.window = window
+        self.rate = rate
+        self.tolerance = tolerance
+        self.contact = contact
+        self.dwells = []
+
+    def settled(self, rows):
+        if len(rows) < 3 or rows[-1, 0] - rows[0, 0] < 0.9*self.window:
+            return False
+        force = rows[:, 1]
+        level = abs(force.mean())
+        if level < self.contact:
+            return False
+        slope = abs(np.polyfit(rows[:, 0] - rows[0, 0], force, 1)[0])
+        return bool(slope <= self.rate or slope <= self.tolerance*level)
+
+    def wait(self, maxtime, label='', cancel=None, progress=None):
+        """
+        Blocks until the force settles or maxtime s pass, whichever is first.
+        Without a live stream this is the old fixed sleep. Returns and records
+        how long the dwell actually took. Setting the `cancel` event ends the
+        dwell early and `progress` is called with the fraction of maxtime used
+        """
+        start = time.monotonic()
+        settled = False
+        while time.monotonic() - start < maxtime:
+            if cancel is not None and cancel.is_set():
+                break
+            if progress is not None:
+                progress((time.monotonic() - start)/maxtime)
+            if self.stream.latest() is not None and time.monotonic() - start >= self.window:
+                settled = self.settled(self.stream.window(self.window))
+                if settled:
+                    break
+            time.sleep(settle_poll)
+        elapsed = time.monotonic() - start
+        self.dwells.append((label, elapsed, settled))
+        return elapsed
+
+
+class TestCurve():
+    def __init__(self, capacity=curve_capacity, calibration=calibration.uncalibrated, zero=0.0):
+        """
+        Force-displacement-time record of one test run. Rows are (s since the
+        run started, commanded indentation in mm, force in N) and named phases
+        ('approach 25%', 'dwell 25%', 'retract' ...) mark spans of the time
+        axis. Forces are added as the firmware reports them and converted
+        with `calibration`, less the tare's `zero` when the run started, when
+        the rows are read
+        """
+        self.calibration = calibration
+        self.zero = zero
+        self.data = np.zeros((capacity, 3))
+        self.count = 0
+        self.position = 0.0
+        self.phases = []
+        self.start = time.monotonic()
+        self.lock = threading.Lock()
+
+    def _sample(self, stamp, force):
+        self.add(stamp, force)
+
+    def add(self, stamp, force):
+        with self.lock:
+            if self.count == len(self.data):
+                self.data = np.concatenate((self.data, np.zeros_like(self.data)))
+            self.data[self.count] = (stamp - self.start, self.position, force)
+            self.count += 1
+
+    def command(self, position):
+        self.position = position
+
+    def mark(self, name):
+        """
+        Ends the current phase and starts `name`. Each phase's duration is
+        recorded in the test_phase metric as it ends
+        """
+        self.end()
+        self.phases.append([name, time.monotonic() - self.start, None])
+
+    def end(self):
+        if self.phases and self.phases[-1][2] is None:
+            self.phases[-1][2] = time.monotonic() - self.start
+            name, start, end = self.phases[-1]
+            metrics.observe('test_phase', end - start, phase=name)
+
+    @property
+    def rows(self):
+        return self.calibration.convert(self.data[:self.count], 2, self.zero)
+
+    def phase(self, name):
+        """
+        Returns the rows recorded during phase `name`
+        """
+        rows = self.rows
+        for phase, start, end in self.phases:
+            if phase == name:
+                if end is None:
+                    end = np.inf
+                return rows[(rows[:, 0] >= start) & (rows[:, 0] <= end)]
+        return rows[:0]
+
+    def settled_force(self, name, tail=settle_window, estimator=estimators.default_estimator):
+        """
+        Estimate of the force over the last `tail` s of a phase, or None if
+        it has no samples
+        """
+        rows = self.phase(name)
+        if not len(rows):
+            return None
+        return estimators.estimate(rows[rows[:, 0] >= rows[-1, 0] - tail, 2], estimator)
+
+
+class ArduinoSession():
+    def __init__(self, serial_port='COM3', baud_rate=9600,
+            read_timeout=5, arduino=None, calibration=calibration.uncalibrated):
+        """
+        Owns the one Arduino connection shared by every handler. The port is
+        opened (and the 2 s board reset waited out) the first time it is
+        needed and then kept open until the session is closed. An Arduino
+        that is already connected, e.g. by port discovery, can be handed in
+        """
+        self.serial_port = serial_port
+        self.baud_rate = baud_rate
+        self.read_timeout = read_timeout
+        self.lock = threading.Lock()
+        self.arduino = arduino
+        self.tare = Tare()
+        self.stream = ForceStream(calibration=calibration, tare=self.tare)
+        self.settle = SettleDetector(self.stream)
+
+    @property
+    def calibration(self):
+        return self.stream.calibration
+
+    @calibration.setter
+    def calibration(self, calibration):
+        self.stream.calibration = calibration
+
+    def connect(self):
+        with self.lock:
+            if self.arduino is None:
+                self.arduino = Arduino(self.serial_port, self.baud_rate,
+                    self.read_timeout)
+            elif self.arduino.failout != 'good conn':
+                with self.arduino.lock:
+                    self.arduino.open()
+            return self.arduino
+
+    def require(self):
+        """
+        Like connect() but raises SerialException when the board can't be reached
+        """
+        a = self.connect()
+        if a.failout != 'good conn':
+            raise serial.SerialException('could not open ' + str(self.serial_port))
+        return a
+
+    def read_force(self):
+        """
+        Returns the current force in N, from the stream when it is live and
+        from a single RF round trip otherwise
+        """
+        return float(self.calibration.apply(self.read_raw() - self.tare.zero))
+
+    def measure(self, seconds=measure_window, estimator=estimators.default_estimator):
+        """
+        Estimate of the force in N over the last `seconds` of the stream, or
+        over a burst of RF reads from firmware that doesn't stream
+        """
+        self.read_raw()
+        if self.stream.latest() is not None:
+            rows = self.stream.buffer.window(seconds)
+            # a stream that only just started fills the window first
+            time.sleep(max(seconds - (rows[-1, 0] - rows[0, 0]), 0))
+            return estimators.estimate(self.stream.window(seconds)[:, 1], estimator)
+        return estimators.estimate([self.read_force() for read in range(estimators.burst_size)], estimator)
+
+    def read_raw(self):
+        """
+        Like read_force(), but as the firmware reports it
+        """
+        offset = self.tare.require()
+        a = self.connect()
+        self.stream.start(a, offset)
+        force = self.stream.latest(raw=True)
+        if force is None:
+            force = float(a.read(offset))
+        return force
+
+    def retare(self):
+        """
+        Tares with the load cell clear and streams against the new offset
+        """
+        a = self.require()
+        offset = self.tare.set(a.tare())
+        self.stream.start(a, offset)
+        return offset
+
+    def force_stop(self, force=default_forcestop):
+        """
+        Sets the force the firmware stops a move at, allowing for the drift
+        """
+        a = self.require()
+        return a.force_stop(force + self.tare.zero, self.tare.require())
+
+    def close(self):
+        with self.lock:
+            self.stream.stop()
+            if self.arduino is not None:
+                self.arduino.close()
+                self.arduino = None
+
+
+def load_rigs(path=database.config_path):
+    """
+    Returns (name, serial port) for every rig in the [rigs] section of
+    uft.ini. Without one, UFT_SERIAL_PORT names the port, or several ports
+    separated by commas. With neither, returns None and the rigs are found
+    by port discovery
+    """
+    parser = configparser.ConfigParser()
+    parser.optionxform = str
+    parser.read(path)
+    if parser.has_section('rigs') and parser.items('rigs'):
+        return parser.items('rigs')
+    ports = [port.strip() for port in os.environ.get('UFT_SERIAL_PORT', '').split(',') if port.strip()]
+    if not ports:
+        return None
+    if len(ports) == 1:
+        return [('Rig', ports[0])]
+    return [('Rig ' + str(number), port) for number, port in enumerate(ports, 1)]
+
+
+######################################################################################################################
+######################################################################################################################
+######################################################################################################################
+######################################################################################################################
+######################################################################################################################
+
+
+#################################################  TEST SEQUENCES ##################################################
+class TestCancelled(Exception):
+    pass
+
+
+class Run():
+    def __init__(self, steps, *args, progress=None, result=None, record=None):
+        """
+        One sequence of steps, called as steps(run, *args). The steps report
+        through the progress(percent), result(key, value, note) and
+        record(key, curve) callbacks and call check() between steps so the
+        operator can cancel (finish the current step and retract) or abort
+        (stop the motor where it is) from another thread
+        """
+        self.steps = steps
+        self.args = args
+        self.on_progress = progress
+        self.on_result = result
+        self.on_record = record
+        self.cancelled = threading.Event()
+        self.aborted = False
+        self.arduino = None
+        #the (start, width) of the progress bar the running steps fill
+        self.share = (0, 1)
+
+    def execute(self):
+        """
+        Runs the steps. Returns None, or a (title, text) failure
+        """
+        try:
+            self.steps(self, *self.args)
+        except (TestCancelled, MoveFault) as error:
+            if self.aborted:
+                return ('Test Aborted', 'Motor stopped')
+            elif self.cancelled.is_set():
+                return ('Test Cancelled', 'Platen retracted')
+            return ('Motion Fault', str(error))
+        except (serial.SerialException, OSError):
+            return ('No Serial Connect', 'Check USB Connections')
+        except ValueError as error:
+            return ('Bad Reading', str(error))
+        return None
+
+    def cancel(self):
+        self.cancelled.set()
+
+    def abort(self):
+        self.aborted = True
+        self.cancelled.set()
+        if self.arduino is not None and self.arduino.failout == 'good conn':
+            self.arduino.stop()
+
+    def check(self):
+        if self.cancelled.is_set():
+            raise TestCancelled()
+
+    def progress(self, fraction):
+        if self.on_progress is not None:
+            fraction = min(max(fraction, 0), 1)
+            self.on_progress(int(100*(self.share[0] + self.share[1]*fraction)))
+
+    def result(self, key, value, note=''):
+        if self.on_result is not None:
+            self.on_result(key, value, note)
+
+    def record(self, key, curve):
+        if self.on_record is not None:
+            self.on_record(key, curve)
+
+
+def tare_steps(job, session):
+    job.result('tare', session.retare())
+
+def force_steps(job, session):
+    session.require()
+    force = session.measure()
+    job.result('force', force.value, estimators.describe(force))
+
+def home_steps(job, session):
+    """
+    Homes the platen, where nothing touches the load cell, so it tares
+    there the first time and keeps its zero up to date from then on. Only
+    a move done from the firmware says the platen got there; firmware that
+    doesn't report moves leaves the tare to Set Tare
+    """
+    a = session.require()
+    job.arduino = a
+    session.tare.retracted = False
+    home = a.finish(a.gohome()).position is not None
+    if session.tare.offset is None:
+        if home:
+            job.result('tare', session.retare())
+    else:
+        session.stream.start(a, session.tare.offset)
+    session.tare.retracted = home
+    job.progress(1)
+
+def move_steps(job, session, pin_number, travel, speedvalue):
+    a = session.require()
+    job.arduino = a
+    session.tare.retracted = False
+    a.finish(a.go_the_distance(pin_number, travel, speedvalue))
+    job.progress(1)
+
+def calibration_steps(job, session, seconds=calibration.point_seconds):
+    """
+    Captures one calibration point: `seconds` of forces as the firmware
+    reports them, less the zero drift, streamed or, from firmware without
+    a stream, polled
+    """
+    a = session.require()
+    job.arduino = a
+    offset = session.tare.require()
+    # there are weights on the cell until the platen is homed again
+    session.tare.retracted = False
+    session.stream.start(a, offset)
+    start = time.monotonic()
+    polled = []
+    while time.monotonic() - start < seconds:
+        job.check()
+        if session.stream.latest() is None and time.monotonic() - start > stream_max_age:
+            polled.append(float(a.read(offset)))
+        else:
+            time.sleep(settle_poll)
+        job.progress((time.monotonic() - start)/seconds)
+    readings = np.concatenate((session.stream.buffer.since(start)[:, 1], polled)) - session.tare.zero
+    job.result('readings', readings)
+
+def follow(job, a, step, timeout, progress=None):
+    """
+    Waits for a step of an uploaded program to finish. Cancelling stops the
+    program where it is
+    """
+    start = time.monotonic()
+    while True:
+        if job.cancelled.is_set():
+            a.stop()
+            raise TestCancelled()
+        try:
+            return step.result(settle_poll)
+        except concurrent.futures.TimeoutError:
+            pass
+        except concurrent.futures.CancelledError:
+            raise MoveFault('connection closed during step')
+        elapsed = time.monotonic() - start
+        if elapsed > timeout:
+            a.stop()
+            raise MoveFault('step did not finish within ' + str(timeout) + ' s')
+        if progress is not None:
+            progress(elapsed)
+
+def sample_force(session, curve, step):
+    """
+    Estimate of the force over the tail of the step's phase, or None
+    without readings
+    """
+    if not len(curve.phase(step.phase)) and curve.phases and curve.phases[-1][0] == step.phase:
+        # no stream from this firmware, fall back to a burst of readings
+        for read in range(estimators.burst_size):
+            curve.add(time.monotonic(), session.read_raw())
+    return curve.settled_force(step.phase, step.tail, step.estimator)
+
+def retract_steps(job, a, curve, distance=recipes.default_retract):
+    """
+    Retracts the platen off the sample, recording the unload, unless the
+    test was aborted with the platen left where it stopped
+    """
+    if not job.aborted and a.failout == 'good conn':
+        curve.mark('retract')
+        curve.command(max(curve.position - distance, 0))
+        a.finish(a.go_the_distance(retract, distance, fullspeed))
+    curve.end()
+
+def recipe_steps(job, session, recipe, thickness, steps=None):
+    """
+    Runs a test recipe (see recipes.py) on a sample `thickness` mm thick,
+    or its `steps` if they were planned already. Firmware that runs
+    sequences gets every move and dwell in one upload and the host follows
+    along, marking the curve's phases as the steps report done. Older
+    firmware is driven one step at a time
+    """
+    if steps is None:
+        steps = recipe.plan(thickness)
+    a = session.require()
+    job.arduino = a
+    session.stream.start(a, session.tare.require())
+    # a last look at the zero before the platen leaves
+    session.stream.track()
+    session.tare.retracted = False
+    curve = TestCurve(calibration=session.calibration, zero=session.tare.zero)
+    a.listeners.append(curve._sample)
+    motion = [step for step in steps if step.motion]
+    # dwells are weighted by their longest time, moves by a nominal 2 s
+    weights = [step.seconds if step.kind == 'dwell' else 2.0 for step in motion]
+    total = sum(weights) or 1.0
+    uploaded = None
+    if a.version >= recipes.sequence_version and len(motion) <= recipes.program_capacity:
+        uploaded = iter(a.upload([step.op(session.settle.rate) for step in motion]))
+    done = 0.0
+    samples = {}
+    uncertainties = {}
+    dwells = []
+    keys = []
+    try:
+        job.progress(0.02)
+        for step in steps:
+            job.check()
+            if step.kind == 'move':
+                curve.mark(step.phase)
+                curve.command(step.target)
+                if uploaded is None:
+                    a.finish(a.go_the_distance(step.pin, step.distance, step.pwm))
+                else:
+                    follow(job, a, next(uploaded), move_timeout)
+            elif step.kind == 'dwell':
+                curve.mark(step.phase)
+                report = lambda fraction: job.progress(0.02 + 0.96*(done + min(fraction, 1)*step.seconds)/total)
+                if uploaded is not None:
+                    elapsed = follow(job, a, next(uploaded), step.seconds + move_timeout,
+                        lambda elapsed: report(elapsed/step.seconds)).elapsed
+                    session.settle.dwells.append((step.phase, elapsed, elapsed < step.seconds))
+                elif step.until == 'settled':
+                    elapsed = session.settle.wait(step.seconds, step.phase, job.cancelled, report)
+                else:
+                    start = time.monotonic()
+                    job.cancelled.wait(step.seconds)
+                    elapsed = time.monotonic() - start
+                    session.settle.dwells.append((step.phase, elapsed, False))
+                dwells.append(step.phase + ' ' + str(round(elapsed, 1)) + ' s')
+            elif step.kind == 'sample':
+                with metrics.span('test_phase', phase='read ' + step.phase):
+                    force = sample_force(session, curve, step)
+                samples[step.name] = None if force is None else force.value
+                uncertainties[step.name] = None if force is None else force.uncertainty
+            elif step.kind == 'result':
+                spread = step.uncertainty(samples, uncertainties)
+                note = [] if spread is None else ['± ' + '%.2g' % spread]
+                job.result(step.key, step.evaluate(samples), ', '.join(note + dwells))
+                keys.append(step.key)
+                dwells = []
+            if step.motion:
+                done += weights[motion.index(step)]
+                job.progress(0.02 + 0.96*done/total)
+    finally:
+        try:
+            if uploaded is not None and not job.aborted and a.failout == 'good conn':
+                # ends the program if the test stopped part way through it
+                a.stop()
+            retract_steps(job, a, curve, recipe.retract)
+        finally:
+            a.listeners.remove(curve._sample)
+            for key in keys:
+                job.record(key, curve)
+    job.progress(1)
+
+def require_move_reports(a):
+    """
+    The original firmware (version 0) resolves moves as they are sent, so
+    a sequence would move on before the platen got anywhere and read the
+    force mid move. Tests need firmware that reports moves done
+    """
+    if a.version < 1:
+        raise MoveFault('firmware version ' + str(a.version)
+            + ' does not report moves done, update it to run tests')
+
+def approach_steps(job, session, a):
+    """
+    Lowers the platen onto the sample. The force stop ends the move as the
+    platen touches, so a recipe's targets are measured from the surface
+    """
+    require_move_reports(a)
+    session.tare.retracted = False
+    session.force_stop()
+    start = a.position
+    result = a.finish(a.go_the_distance(extend, approach_travel, approach_speed))
+    if None not in (start, result.position) and result.position - start >= 0.99*approach_travel:
+        raise MoveFault('no sample within ' + str(approach_travel) + ' mm')
+
+def test_steps(job, session, recipe, thickness, steps=None):
+    """
+    Runs a recipe the way a test is started from the panel: from home, with
+    the platen lowered onto the sample first
+    """
+    a = session.require()
+    job.arduino = a
+    require_move_reports(a)
+    session.tare.require()
+    session.tare.retracted = False
+    a.finish(a.gohome())
+    job.check()
+    approach_steps(job, session, a)
+    job.check()
+    recipe_steps(job, session, recipe, thickness, steps)
+
+def batch_steps(job, session, sample, batch_recipes):
+    """
+    Runs every recipe of a batch on one sample, from the plans made while
+    the previous sample was measured. Each one starts over from home, so
+    it finds the surface again rather than starting where the last one
+    retracted to
+    """
+    for number, (recipe, steps) in enumerate(zip(batch_recipes, sample.plans)):
+        job.check()
+        job.share = (number/len(batch_recipes), 1/len(batch_recipes))
+        test_steps(job, session, recipe, sample.thickness, steps)
@@ -0,0 +1,102 @@
+"""
+Long term storage for raw test curves
+
+Every run is written once as a float32 .npy file of (time s, indentation mm,
+force N) rows under <root>/<test date>/, the root being curves/ next to this
+file by default. The file is only ever opened again through a read-only
+memory map, so browsing thousands of curves never loads more of them than
+is actually looked at. index.jsonl holds one line per curve (sample, DOE,
+date, test, phases) for lookups without touching the curve files, and the
+tests table stores the curve's reference next to the scalar result.
+"""
+import json
+import os
+import re
+import threading
+import time
+
+import numpy as np
+
+curve_root = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'curves')
+
+
+class CurveStore():
+    def __init__(self, root=curve_root):
+        self.root = root
+        self.index_path = os.path.join(root, 'index.jsonl')
+        self.entries = {}
+        self.by_doe = {}
+        self.by_date = {}
+        self.by_sample = {}
+        self.index_read = 0
+        self.lock = threading.Lock()
+
+    def save(self, curve, sample_id, doe_id, test_date, test_name):
+        """
+        Writes one curve and indexes it. Returns the reference to store with
+        the result, a path relative to the store root
+        """
+        stamp = time.strftime('%H%M%S')
+        name = re.sub(r'[^\w.-]', '_', str(sample_id)) + '_' + re.sub(r'\W', '', test_name) + '_' + stamp
+        folder = re.sub(r'[^\w-]', '_', str(test_date))
+        os.makedirs(os.path.join(self.root, folder), exist_ok=True)
+        ref = folder + '/' + name + '.npy'
+        suffix = 1
+        while os.path.exists(os.path.join(self.root, ref)):
+            ref = folder + '/' + name + '_' + str(suffix) + '.npy'
+            suffix += 1
+        np.save(os.path.join(self.root, ref), curve.rows.astype(np.float32))
+        entry = {'ref': ref, 'sample_id': str(sample_id), 'DOE_ID': str(doe_id),
+            'test_date': str(test_date), 'test_name': test_name,
+            'rows': int(curve.count), 'phases': curve.phases,
+            'calibration': curve.calibration.label}
+        with self.lock:
+            with open(self.index_path, 'a') as index:
+                index.write(json.dumps(entry) + '\n')
+        return ref
+
+    def open(self, ref):
+        """
+        Returns the curve's rows as a read-only memory map
+        """
+        return np.load(os.path.join(self.root, ref), mmap_mode='r')
+
+    def refresh(self):
+        """
+        Reads whatever was appended to the index since the last call, so other
+        stations writing to a shared store show up without a full reload
+        """
+        with self.lock:
+            if not os.path.exists(self.index_path):
+                return
+            with open(self.index_path) as index:
+                index.seek(self.index_read)
+                for line in index:
+                    if not line.endswith('\n'):
+                        # half written by another station, pick it up next time
+                        break
+                    self.index_read += len(line.encode())
+                    entry = json.loads(line)
+                    self.entries[entry['ref']] = entry
+                    self.by_doe.setdefault(entry['DOE_ID'], []).append(entry['ref'])
+                    self.by_date.setdefault(entry['test_date'], []).append(entry['ref'])
+                    self.by_sample.setdefault(entry['sample_id'], []).append(entry['ref'])
+
+    def find(self, doe_id=None, test_date=None, sample_id=None):
+        """
+        Returns the index entries matching every criterion given, oldest first
+        """
+        self.refresh()
+        refs = None
+        for lookup, key in ((self.by_doe, doe_id), (self.by_date, test_date),
+                (self.by_sample, sample_id)):
+            if key is not None:
+                found = lookup.get(str(key), [])
+                if refs is None:
+                    refs = found
+                else:
+                    found = set(found)
+                    refs = [ref for ref in refs if ref in found]
+        if refs is None:
+            refs = list(self.entries)
+        return [self.entries[ref] for ref in refs]
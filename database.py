@@ -0,0 +1,97 @@
+"""
+MySQL access for the tester
+
+Connections come from one shared pool instead of a fresh connect per click.
+mysql.connector is only imported when the pool is first needed.
+Host and credentials are read from the [mysql] section of uft.ini next to
+this file, whatever folder the program is started from, and any key can
+be overridden with a UFT_DB_<KEY> environment variable.
+"""
+import configparser
+import os
+import threading
+
+import metrics
+
+config_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'uft.ini')
+config_defaults = {'host': 'localhost', 'user': 'root', 'password': 'password',
+    'database': 'foam', 'pool_size': '4'}
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def load_config(path=config_path):
+    parser = configparser.ConfigParser()
+    parser.read_dict({'mysql': config_defaults})
+    parser.read(path)
+    config = dict(parser['mysql'])
+    for key in config:
+        value = os.environ.get('UFT_DB_' + key.upper())
+        if value:
+            config[key] = value
+    return config
+
+
+def get_pool():
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            from mysql.connector import pooling
+            config = load_config()
+            _pool = pooling.MySQLConnectionPool(pool_name='uft',
+                pool_size=int(config['pool_size']), host=config['host'],
+                user=config['user'], passwd=config['password'],
+                database=config['database'])
+        return _pool
+
+
+def connect():
+    """
+    Borrows a connection from the pool. close() hands it back
+    """
+    return get_pool().get_connection()
+
+
+class ResultWriter():
+    # a repeated client_id leaves the row as it is, not IGNORE, which would
+    # also turn bad data into warnings and dropped or truncated rows
+    insert = """INSERT INTO tests(sample_id,DOE_ID,test_name,
+    result,test_date, operator, thickness, curve_ref, client_id)
+    VALUES(%s, %s, %s, %s, %s, %s, %s, %s, %s)
+    ON DUPLICATE KEY UPDATE test_id=test_id"""
+
+    def __init__(self, connect=connect):
+        """
+        Writes result rows to the tests table. `connect` returns a DB-API
+        connection, the pool by default
+        """
+        self.connect = connect
+
+    def write(self, rows):
+        """
+        Writes rows with one executemany in one transaction, which the
+        connector sends as a single multi-row INSERT. The last field of each
+        row is its client-generated id, and rows whose id is already in the
+        table are skipped, so a batch can safely be sent again after a lost
+        reply. Returns the test_ids the rows ended up with
+        """
+        if not rows:
+            return []
+        with metrics.span('db', op='write_results'):
+            conn = self.connect()
+            cursor = conn.cursor()
+            try:
+                cursor.executemany(self.insert, rows)
+                client_ids = [row[-1] for row in rows]
+                cursor.execute('select test_id from tests where client_id in ('
+                    + ', '.join(['%s']*len(client_ids)) + ')', client_ids)
+                test_ids = [row[0] for row in cursor.fetchall()]
+                conn.commit()
+            except Exception:
+                conn.rollback()
+                raise
+            finally:
+                cursor.close()
+                conn.close()
+        return test_ids
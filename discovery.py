@@ -0,0 +1,234 @@
+"""
+Finds the rigs attached to this machine
+
+Every candidate serial port (whatever pyserial lists, plus /dev/ttyUSB* and
+/dev/ttyACM* on Linux) is probed in parallel: the port is opened, the board
+reset waited out and the firmware asked for its protocol version, so
+probing N ports costs one board reset rather than N. A port is a rig if
+its firmware answers, or, for the original firmware that doesn't, if its
+USB vendor id belongs to an Arduino or a common USB-serial bridge.
+
+rigs.json, next to this file, caches what was found, keyed by USB serial
+number, so a rig keeps its name when it moves to another port and later
+startups connect to known rigs without probing. Devices that turned out
+not to be rigs are cached too and never probed again; delete their
+entries to have them re-probed. A watcher thread rescans the port list
+every few seconds to pick up rigs as they are plugged in and notice the
+ones that are unplugged.
+"""
+import concurrent.futures
+import glob
+import json
+import os
+import sys
+import threading
+
+import metrics
+
+cache_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'rigs.json')
+scan_interval = 2
+probe_workers = 16
+
+# Arduino, Arduino.org, WCH CH340, FTDI and Silicon Labs CP210x
+rig_vendors = {0x2341, 0x2A03, 0x1A86, 0x0403, 0x10C4}
+
+
+class Port():
+    def __init__(self, device, serial_number=None, vid=None):
+        self.device = device
+        self.serial_number = serial_number
+        self.vid = vid
+
+    @property
+    def key(self):
+        """
+        What the cache knows the device by: its USB serial number, or the
+        port itself for devices that don't report one
+        """
+        if self.serial_number:
+            return 'usb:' + self.serial_number
+        return 'port:' + self.device
+
+
+def candidates():
+    """
+    Returns a Port for every serial port that could have a rig on it
+    """
+    import serial
+    from serial.tools import list_ports
+    # if serial was imported lazily, finish loading it here rather than in
+    # several probe threads at once
+    serial.Serial
+    ports = {}
+    for info in list_ports.comports():
+        if sys.platform.startswith('linux') and info.device.startswith('/dev/ttyS') and info.vid is None:
+            # on board UARTs, never a rig and slow to open
+            continue
+        ports[info.device] = Port(info.device, info.serial_number, info.vid)
+    if sys.platform.startswith('linux'):
+        for device in glob.glob('/dev/ttyUSB*') + glob.glob('/dev/ttyACM*'):
+            ports.setdefault(device, Port(device))
+    return list(ports.values())
+
+
+class RigCache():
+    def __init__(self, path=cache_path):
+        """
+        {key: {'name': ..., 'port': ..., 'version': ...}} for rigs and
+        {key: {'rig': false}} for anything else that was probed
+        """
+        self.path = path
+        self.lock = threading.Lock()
+        try:
+            with open(path) as file:
+                self.entries = json.load(file)
+        except (OSError, ValueError):
+            self.entries = {}
+
+    def get(self, key):
+        with self.lock:
+            return self.entries.get(key)
+
+    def put(self, key, entry):
+        with self.lock:
+            self.entries[key] = entry
+            partial = self.path + '.tmp'
+            try:
+                with open(partial, 'w') as file:
+                    json.dump(self.entries, file, indent=1)
+                os.replace(partial, self.path)
+            except OSError:
+                # a read-only folder only costs probing again next time
+                pass
+
+    def names(self):
+        with self.lock:
+            return {entry['name'] for entry in self.entries.values() if entry.get('name')}
+
+
+class Discovery():
+    def __init__(self, connect, cache=None):
+        """
+        `connect` opens a port and returns an Arduino, whose failout and
+        version tell whether a rig answered. Rigs found by probing are
+        handed over still connected, so they don't reset a second time
+        """
+        self.connect = connect
+        self.cache = cache if cache is not None else RigCache()
+        self.attached = {}
+        self.rejected = set()
+        self.lock = threading.Lock()
+        self.stopping = threading.Event()
+        self.thread = None
+
+    def new_name(self):
+        names = self.cache.names()
+        number = 1
+        while 'Rig ' + str(number) in names:
+            number += 1
+        return 'Rig ' + str(number)
+
+    def known(self):
+        """
+        Returns (name, port) for the cached rigs that are attached right now,
+        without opening any port
+        """
+        found = []
+        with self.lock:
+            for port in candidates():
+                entry = self.cache.get(port.key)
+                if entry and entry.get('name') and port.device not in self.attached:
+                    if entry['port'] != port.device:
+                        self.cache.put(port.key, dict(entry, port=port.device))
+                    self.attached[port.device] = entry['name']
+                    found.append((entry['name'], port.device))
+        return found
+
+    def probe(self, port):
+        """
+        Returns the connected Arduino if a rig answers on `port`, else None
+        """
+        try:
+            a = self.connect(port.device)
+        except Exception:
+            return None
+        opened = a.failout == 'good conn'
+        if opened and (a.version >= 1 or port.vid in rig_vendors):
+            return a
+        a.close()
+        if opened and port.serial_number and port.vid not in rig_vendors:
+            # it opened but isn't a rig, don't probe it again
+            self.cache.put(port.key, {'rig': False, 'port': port.device})
+        return None
+
+    def scan(self):
+        """
+        Probes every new candidate port in parallel. Returns (name, port,
+        Arduino) for each rig found and the names of the rigs whose port has
+        gone
+        """
+        ports = candidates()
+        present = {port.device for port in ports}
+        with self.lock:
+            gone = [device for device in self.attached if device not in present]
+            removed = [self.attached.pop(device) for device in gone]
+            # a port that didn't answer is probed again once it is replugged
+            self.rejected &= present
+            fresh = []
+            for port in ports:
+                entry = self.cache.get(port.key)
+                if (port.device in self.attached or port.device in self.rejected
+                        or (entry and entry.get('rig') is False)):
+                    continue
+                fresh.append(port)
+        added = []
+        if fresh:
+            with concurrent.futures.ThreadPoolExecutor(min(len(fresh), probe_workers)) as pool:
+                for port, a in zip(fresh, pool.map(self.probe, fresh)):
+                    if a is None:
+                        with self.lock:
+                            self.rejected.add(port.device)
+                        continue
+                    entry = self.cache.get(port.key) or {'name': self.new_name()}
+                    self.cache.put(port.key, {'name': entry['name'], 'port': port.device,
+                        'version': a.version})
+                    with self.lock:
+                        self.attached[port.device] = entry['name']
+                    added.append((entry['name'], port.device, a))
+        return added, removed
+
+    def forget(self, device):
+        """
+        Lets a port be probed again on the next scan
+        """
+        with self.lock:
+            self.attached.pop(device, None)
+
+    def watch(self, added, removed, failed=None, interval=scan_interval):
+        """
+        Scans now and then every `interval` s on a background thread, calling
+        added(name, port, arduino) and removed(name) as rigs come and go, and
+        failed(error) for a scan that failed, which is also counted in the
+        port_scan_failures metric
+        """
+        def run():
+            while not self.stopping.is_set():
+                try:
+                    found, lost = self.scan()
+                except Exception as error:
+                    metrics.count('port_scan_failures')
+                    if failed is not None:
+                        failed(str(error))
+                    found, lost = [], []
+                for name in lost:
+                    removed(name)
+                for name, device, a in found:
+                    added(name, device, a)
+                self.stopping.wait(interval)
+        self.thread = threading.Thread(target=run, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.stopping.set()
+        if self.thread is not None:
+            self.thread.join(5)
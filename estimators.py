@@ -0,0 +1,133 @@
+"""
+Force estimators
+
+Reduce a window or burst of force readings to one value and its standard
+uncertainty, working on the whole array at once:
+
+    mean      the plain average
+    median    the middle reading, which a few spikes don't move
+    trimmed   the average once `trim_fraction` of the readings at either
+              end are dropped
+    iir       a first order low pass (exponential average) over the
+              readings, weighting the newest most
+    kalman    a Kalman filter for a force that wanders `kalman_drift` N
+              per reading, so it follows foam that is still relaxing more
+              closely than an average does
+
+The noise behind every uncertainty is worked out from the differences
+between successive readings, so a slow trend across the window isn't
+counted as noise. A recipe picks the estimator of each sample step with
+"estimator" (see recipes.py).
+"""
+import collections
+
+import numpy as np
+
+default_estimator = 'mean'
+trim_fraction = 0.1
+iir_alpha = 0.05
+kalman_drift = 0.01
+burst_size = 8
+
+Estimate = collections.namedtuple('Estimate', 'value uncertainty count')
+
+
+class EstimatorError(ValueError):
+    pass
+
+
+def noise(values):
+    """
+    Standard deviation of the reading noise, or None from under 3 readings.
+    Taken from the median absolute deviation of the differences, so spikes
+    don't inflate it, unless readings coarser than the noise leave that 0
+    """
+    if len(values) < 3:
+        return None
+    steps = np.diff(values)
+    spread = 1.4826*np.median(np.abs(steps - np.median(steps)))
+    if not spread:
+        spread = steps.std()
+    return float(spread/np.sqrt(2))
+
+
+def weighted(values, weights):
+    """
+    Estimate from fixed weights summing to 1, with white noise propagated
+    """
+    sigma = noise(values)
+    spread = None if sigma is None else sigma*float(np.sqrt(np.dot(weights, weights)))
+    return Estimate(float(np.dot(weights, values)), spread, len(values))
+
+
+def mean(values):
+    return weighted(values, np.full(len(values), 1/len(values)))
+
+
+def median(values):
+    sigma = noise(values)
+    # a median of normal noise is sqrt(pi/2) times as uncertain as the mean
+    spread = None if sigma is None else sigma*float(np.sqrt(np.pi/2/len(values)))
+    return Estimate(float(np.median(values)), spread, len(values))
+
+
+def trimmed(values, fraction=trim_fraction):
+    cut = int(fraction*len(values))
+    kept = np.sort(values)[cut:len(values) - cut]
+    sigma = noise(values)
+    spread = None if sigma is None else sigma/float(np.sqrt(len(kept)))
+    return Estimate(float(kept.mean()), spread, len(values))
+
+
+def iir(values, alpha=iir_alpha):
+    """
+    The last output of y += alpha*(x - y) started at the first reading,
+    worked out as the weights it puts on each reading
+    """
+    weights = alpha*(1 - alpha)**np.arange(len(values) - 1, -1, -1)
+    weights[0] = (1 - alpha)**(len(values) - 1)
+    return weighted(values, weights)
+
+
+def kalman(values, drift=kalman_drift):
+    """
+    Random walk Kalman filter started at the first reading. The gains don't
+    depend on the readings, so only they are stepped through and the
+    estimate is the weighted sum they amount to
+    """
+    sigma = noise(values)
+    if not sigma:
+        return mean(values)
+    variance = sigma**2
+    gains = np.ones(len(values))
+    error = variance
+    for index in range(1, len(values)):
+        error = error + drift**2
+        gains[index] = error/(error + variance)
+        error = (1 - gains[index])*error
+    # each reading's weight is its gain times the share later gains leave it
+    keep = np.append(np.cumprod((1 - gains[:0:-1]))[::-1], 1.0)
+    return Estimate(float(np.dot(gains*keep, values)), float(np.sqrt(error)), len(values))
+
+
+estimators = {'mean': mean, 'median': median, 'trimmed': trimmed, 'iir': iir, 'kalman': kalman}
+
+
+def estimate(values, method=default_estimator):
+    """
+    Returns the Estimate of `values` by the estimator named `method`, or
+    None without any readings
+    """
+    if method not in estimators:
+        raise EstimatorError('unknown estimator ' + repr(method))
+    values = np.asarray(values, dtype=float)
+    values = values[np.isfinite(values)]
+    if not len(values):
+        return None
+    return estimators[method](values)
+
+
+def describe(estimate):
+    if estimate is None or estimate.uncertainty is None:
+        return ''
+    return '± ' + '%.2g' % estimate.uncertainty
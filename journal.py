@@ -0,0 +1,137 @@
+"""
+Offline-first result journal
+
+Every committed result is appended to a local SQLite database (WAL mode),
+results.db next to this file, before anything touches the network, so a
+result is never lost because the MySQL server is down. A SyncWorker thread
+uploads unsynced rows to the tests table in batches, backing off while the
+server is unreachable. Each row carries a client-generated id, which the
+tests table keeps unique, so a batch that is resent after a lost reply is
+not inserted twice.
+"""
+import os
+import sqlite3
+import threading
+import time
+import uuid
+
+import database
+import metrics
+
+journal_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'results.db')
+sync_batch = 500
+sync_interval = 30
+backoff_start = 1
+backoff_max = 60
+
+fields = ('sample_id', 'DOE_ID', 'test_name', 'result', 'test_date', 'operator',
+    'thickness', 'curve_ref', 'client_id')
+
+
+class Journal():
+    def __init__(self, path=journal_path):
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.lock = threading.Lock()
+        with self.lock:
+            self.conn.execute('PRAGMA journal_mode=WAL')
+            self.conn.execute('PRAGMA synchronous=NORMAL')
+            self.conn.execute("""CREATE TABLE IF NOT EXISTS results(
+                client_id TEXT PRIMARY KEY, sample_id TEXT, DOE_ID TEXT,
+                test_name TEXT, result TEXT, test_date TEXT, operator TEXT,
+                thickness TEXT, curve_ref TEXT, created REAL, synced REAL)""")
+            self.conn.execute('CREATE INDEX IF NOT EXISTS unsynced ON results(synced, created)')
+            self.conn.commit()
+
+    def append(self, rows):
+        """
+        Journals (sample_id, DOE_ID, test_name, result, test_date, operator,
+        thickness, curve_ref) rows in one transaction and returns their
+        client ids
+        """
+        now = time.time()
+        client_ids = [uuid.uuid4().hex for row in rows]
+        with self.lock, metrics.span('db', op='journal_append'):
+            with self.conn:
+                self.conn.executemany("""INSERT INTO results(sample_id, DOE_ID,
+                    test_name, result, test_date, operator, thickness, curve_ref,
+                    client_id, created) VALUES(?, ?, ?, ?, ?, ?, ?, ?, ?, ?)""",
+                    [tuple(row) + (client_id, now) for row, client_id in zip(rows, client_ids)])
+        return client_ids
+
+    def pending(self, limit=sync_batch):
+        """
+        Returns the oldest unsynced rows, in ResultWriter.write order
+        """
+        with self.lock, metrics.span('db', op='journal_pending'):
+            return self.conn.execute('SELECT ' + ', '.join(fields)
+                + ' FROM results WHERE synced IS NULL ORDER BY created LIMIT ?',
+                (limit,)).fetchall()
+
+    def count_pending(self):
+        with self.lock:
+            return self.conn.execute('SELECT count(*) FROM results WHERE synced IS NULL').fetchone()[0]
+
+    def mark_synced(self, client_ids):
+        now = time.time()
+        with self.lock, metrics.span('db', op='journal_mark_synced'):
+            with self.conn:
+                self.conn.executemany('UPDATE results SET synced = ? WHERE client_id = ?',
+                    [(now, client_id) for client_id in client_ids])
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
+
+
+class SyncWorker(threading.Thread):
+    def __init__(self, journal, writer=None, synced=None, status=None):
+        """
+        Uploads the journal in the background. `synced` is called with the
+        test_ids of every batch that lands and `status` with the number of
+        rows still waiting and the last error, if any
+        """
+        super().__init__(daemon=True)
+        self.journal = journal
+        self.writer = writer if writer is not None else database.ResultWriter()
+        self.synced = synced
+        self.status = status
+        self.wakeup = threading.Event()
+        self.stopping = False
+
+    def wake(self):
+        self.wakeup.set()
+
+    def stop(self):
+        self.stopping = True
+        self.wakeup.set()
+
+    def run(self):
+        backoff = backoff_start
+        while not self.stopping:
+            error = None
+            try:
+                self.sync()
+                backoff = backoff_start
+                wait = sync_interval
+            except Exception as failure:
+                # any driver or network error just means try again later
+                error = str(failure)
+                wait = backoff
+                backoff = min(backoff*2, backoff_max)
+            if self.status is not None:
+                self.status(self.journal.count_pending(), error)
+            self.wakeup.wait(wait)
+            self.wakeup.clear()
+
+    def sync(self):
+        """
+        Uploads everything pending, one batch per transaction
+        """
+        while not self.stopping:
+            rows = self.journal.pending()
+            if not rows:
+                return
+            test_ids = self.writer.write(rows)
+            self.journal.mark_synced([row[-1] for row in rows])
+            if self.synced is not None:
+                self.synced(test_ids)
@@ -0,0 +1,106 @@
+"""
+Live force plot
+
+Draws a ForceStream's Trace (see core.py) against time or displacement at
+a fixed frame rate. The trace already holds the whole run in a bounded
+number of min/max buckets, and each frame merges them further down to one
+lowest and highest force per pixel column, so a frame costs the same
+however long the run or fast the stream. Frames are only drawn while the
+trace changes and the plot is on screen, and nothing is drawn from the
+serial reader thread.
+"""
+import numpy as np
+import PyQt5.QtWidgets as qtw
+from PyQt5 import QtCore, QtGui
+
+plot_fps = 25
+
+axes = {'time': ('Time (s)', 0), 'position': ('Displacement (mm)', 1)}
+
+
+def decimate(x, low, high, columns):
+    """
+    Merges consecutive points that land in the same pixel column into one
+    lowest and highest value each, and returns the (x, low, high) left
+    """
+    if len(x) <= 2*columns:
+        return x, low, high
+    span = (x.max() - x.min()) or 1.0
+    column = ((x - x.min())/span*(columns - 1)).astype(int)
+    starts = np.flatnonzero(np.concatenate(([True], column[1:] != column[:-1])))
+    return x[starts], np.minimum.reduceat(low, starts), np.maximum.reduceat(high, starts)
+
+
+def polygon(points):
+    """
+    QPolygonF of an (n, 2) array, filled through its memory rather than a
+    QPointF at a time
+    """
+    shape = QtGui.QPolygonF(len(points))
+    memory = shape.data()
+    memory.setsize(points.nbytes)
+    np.frombuffer(memory, dtype=np.float64).reshape(-1, 2)[:] = points
+    return shape
+
+
+class ForcePlot(qtw.QWidget):
+    def __init__(self, stream, axis='time', parent=None):
+        """
+        Force against 'time' or 'position' from `stream`, redrawn at most
+        plot_fps times a second
+        """
+        super().__init__(parent)
+        self.stream = stream
+        self.axis = axis
+        self.drawn = None
+        self.setMinimumSize(240, 160)
+        self.timer = QtCore.QTimer(self, timeout=self.frame)
+        self.timer.start(int(1000/plot_fps))
+
+    def frame(self):
+        if self.isVisible() and self.stream.trace.version != self.drawn:
+            self.update()
+        return
+
+    def paintEvent(self, event):
+        rows, self.drawn = self.stream.traced()
+        title, column = axes[self.axis]
+        rows = rows[np.isfinite(rows[:, column])]
+        painter = QtGui.QPainter(self)
+        palette = self.palette()
+        painter.setPen(palette.color(QtGui.QPalette.Text))
+        metrics = painter.fontMetrics()
+        line = metrics.height()
+        left_margin = metrics.horizontalAdvance('-888.8 N') + 8
+        area = QtCore.QRectF(left_margin, line/2, self.width() - left_margin - 8,
+            self.height() - 2*line - line/2 - 4)
+        painter.drawRect(area)
+        painter.drawText(QtCore.QRectF(area.left(), self.height() - line, area.width(), line),
+            QtCore.Qt.AlignCenter, title)
+        if len(rows):
+            x, low, high = decimate(rows[:, column], rows[:, 2], rows[:, 3], max(int(area.width()), 1))
+            left, right = x.min(), x.max()
+            bottom, top = min(low.min(), 0.0), high.max()
+            if right == left:
+                right = left + 1.0
+            if top == bottom:
+                top = bottom + 1.0
+            top = top + 0.05*(top - bottom)
+            painter.drawText(QtCore.QRectF(0, area.top(), left_margin - 4, line),
+                QtCore.Qt.AlignRight, '%.4g N' % top)
+            painter.drawText(QtCore.QRectF(0, area.bottom() - line, left_margin - 4, line),
+                QtCore.Qt.AlignRight, '%.4g N' % bottom)
+            scale = QtCore.QRectF(area.left(), area.bottom() + 2, area.width(), line)
+            painter.drawText(scale, QtCore.Qt.AlignLeft, '%.4g' % left)
+            painter.drawText(scale, QtCore.Qt.AlignRight, '%.4g' % right)
+            # each column is drawn from its lowest to its highest force
+            px = area.left() + (x - left)/(right - left)*area.width()
+            points = np.empty((2*len(x), 2))
+            points[0::2, 0] = points[1::2, 0] = px
+            points[0::2, 1] = area.bottom() - (low - bottom)/(top - bottom)*area.height()
+            points[1::2, 1] = area.bottom() - (high - bottom)/(top - bottom)*area.height()
+            # a cosmetic pen, the wide ones take Qt's slow path
+            painter.setPen(QtGui.QPen(palette.color(QtGui.QPalette.Highlight), 0))
+            painter.drawPolyline(polygon(points))
+        painter.end()
+        return
@@ -0,0 +1,197 @@
+"""
+Timing instrumentation for the tester
+
+Spans time the hot paths (serial commands, test phases, database calls,
+table rebuilds) into in-memory histograms with fixed, logarithmic buckets,
+so recording one costs a bisect and a few additions and never allocates
+per sample. Counters track events such as serial timeouts and reconnects.
+export() appends a summary line to a rotating JSON-lines log and rewrites
+a Prometheus text-format file, which node_exporter's textfile collector
+can pick up. Every series is labelled with the station's host name so
+numbers from several testers can be compared:
+
+    with metrics.span('serial_command', command='RF', port='COM3'):
+        ...
+    metrics.count('serial_timeouts', command='RF', port='COM3')
+    metrics.export()
+"""
+import bisect
+import contextlib
+import json
+import logging
+import logging.handlers
+import math
+import os
+import socket
+import threading
+import time
+
+log_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'metrics.jsonl')
+prometheus_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'uft.prom')
+log_bytes = 1000000
+log_backups = 5
+export_interval = 60
+prefix = 'uft_'
+
+# 100 us to about 105 s, doubling
+buckets = tuple(0.0001*2**power for power in range(21))
+
+
+class Histogram():
+    def __init__(self, bounds=buckets):
+        """
+        Counts of durations in s per bucket, plus their count, sum and maximum
+        """
+        self.bounds = bounds
+        self.counts = [0]*(len(bounds) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.sum += value
+        if value > self.max:
+            self.max = value
+
+    def quantile(self, fraction):
+        """
+        Upper bound of the bucket holding the given quantile, capped at the
+        largest value seen
+        """
+        if not self.count:
+            return None
+        rank = math.ceil(fraction*self.count)
+        seen = 0
+        for index, count in enumerate(self.counts):
+            seen += count
+            if seen >= rank:
+                break
+        if index == len(self.bounds):
+            return self.max
+        return min(self.bounds[index], self.max)
+
+    def summary(self):
+        return {'count': self.count, 'sum': self.sum, 'max': self.max,
+            'p50': self.quantile(0.5), 'p90': self.quantile(0.9),
+            'p99': self.quantile(0.99)}
+
+
+class Registry():
+    def __init__(self, station=None):
+        """
+        Histograms and counters keyed by name and labels
+        """
+        self.station = station if station is not None else socket.gethostname()
+        self.histograms = {}
+        self.counters = {}
+        self.lock = threading.Lock()
+        self.log = None
+
+    def observe(self, name, seconds, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = Histogram()
+            histogram.observe(seconds)
+
+    def count(self, name, amount=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + amount
+
+    @contextlib.contextmanager
+    def span(self, name, **labels):
+        """
+        Times the block into histogram `name`. A block that raises is
+        recorded too, labelled with error='<exception type>'
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        except BaseException as error:
+            labels['error'] = type(error).__name__
+            raise
+        finally:
+            self.observe(name, time.perf_counter() - start, **labels)
+
+    def snapshot(self):
+        """
+        Returns every series as plain data, for JSON
+        """
+        with self.lock:
+            histograms = [dict(name=name, labels=dict(labels), **histogram.summary())
+                for (name, labels), histogram in self.histograms.items()]
+            counters = [{'name': name, 'labels': dict(labels), 'value': value}
+                for (name, labels), value in self.counters.items()]
+        return {'time': time.time(), 'station': self.station,
+            'histograms': histograms, 'counters': counters}
+
+    def prometheus(self):
+        """
+        Returns every series in the Prometheus text exposition format
+        """
+        lines = []
+        typed = set()
+        station = (('station', self.station),)
+        with self.lock:
+            for (name, labels), histogram in sorted(self.histograms.items()):
+                metric = prefix + name + '_seconds'
+                if metric not in typed:
+                    lines.append('# TYPE ' + metric + ' histogram')
+                    typed.add(metric)
+                labels = station + labels
+                cumulative = 0
+                for bound, count in zip(histogram.bounds + (None,), histogram.counts):
+                    cumulative += count
+                    le = '+Inf' if bound is None else '%.4g' % bound
+                    lines.append(metric + '_bucket' + format_labels(labels + (('le', le),))
+                        + ' ' + str(cumulative))
+                lines.append(metric + '_sum' + format_labels(labels) + ' ' + repr(histogram.sum))
+                lines.append(metric + '_count' + format_labels(labels) + ' ' + str(histogram.count))
+            for (name, labels), value in sorted(self.counters.items()):
+                metric = prefix + name + '_total'
+                if metric not in typed:
+                    lines.append('# TYPE ' + metric + ' counter')
+                    typed.add(metric)
+                lines.append(metric + format_labels(station + labels) + ' ' + str(value))
+        return '\n'.join(lines) + '\n'
+
+    def export(self, log=log_path, prometheus=prometheus_path):
+        """
+        Appends a snapshot to the rotating JSON-lines log and replaces the
+        Prometheus file in one rename, so a scraper never reads half of it
+        """
+        if log:
+            if self.log is None or self.log.baseFilename != os.path.abspath(log):
+                self.log = logging.handlers.RotatingFileHandler(log,
+                    maxBytes=log_bytes, backupCount=log_backups)
+            self.log.emit(logging.makeLogRecord({'msg': json.dumps(self.snapshot()),
+                'levelno': logging.INFO, 'levelname': 'INFO'}))
+        if prometheus:
+            partial = prometheus + '.tmp'
+            with open(partial, 'w') as file:
+                file.write(self.prometheus())
+            os.replace(partial, prometheus)
+
+    def clear(self):
+        with self.lock:
+            self.histograms.clear()
+            self.counters.clear()
+
+
+def format_labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join(key + '="' + str(value).replace('\\', '\\\\').replace('"', '\\"')
+        .replace('\n', '\\n') + '"' for key, value in labels) + '}'
+
+
+registry = Registry()
+observe = registry.observe
+count = registry.count
+span = registry.span
+snapshot = registry.snapshot
+export = registry.export
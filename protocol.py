@@ -0,0 +1,99 @@
+"""
+Binary framing for the UFT serial protocol
+
+Every frame is 16 bytes, little endian:
+
+    sync (0xA5) | version | sequence id | command (2 chars) | pin | arg a (float) | arg b (float) | CRC-16
+
+The command and pin carry the same meaning as the ASCII commands ('WG', 11 ...)
+so both modes share one command set. Requests use sequence ids 1-255 and the
+firmware echoes the id in its reply, which lets several requests be in flight
+at once. Frames the firmware sends on its own (force samples, move done, text)
+use sequence id 0.
+"""
+import struct
+
+SYNC = 0xA5
+VERSION = 1
+BODY = struct.Struct('<BBB2sBff')
+CRC = struct.Struct('<H')
+FRAME_SIZE = BODY.size + CRC.size
+
+
+class FrameError(ValueError):
+    pass
+
+
+def _crc_table():
+    table = []
+    for byte in range(256):
+        crc = byte << 8
+        for bit in range(8):
+            if crc & 0x8000:
+                crc = ((crc << 1) ^ 0x1021) & 0xFFFF
+            else:
+                crc = (crc << 1) & 0xFFFF
+        table.append(crc)
+    return table
+
+CRC_TABLE = _crc_table()
+
+
+def crc16(data, crc=0xFFFF):
+    """
+    CRC-16/CCITT-FALSE (polynomial 0x1021, initial value 0xFFFF)
+    """
+    for byte in data:
+        crc = ((crc << 8) & 0xFFFF) ^ CRC_TABLE[((crc >> 8) ^ byte) & 0xFF]
+    return crc
+
+
+def pack(seq, command, pin=0, a=0.0, b=0.0):
+    body = BODY.pack(SYNC, VERSION, seq & 0xFF, command.encode(), int(pin),
+        float(a), float(b))
+    return body + CRC.pack(crc16(body))
+
+
+def unpack(frame):
+    """
+    Returns (seq, command, pin, a, b) for one complete frame
+    """
+    if len(frame) != FRAME_SIZE:
+        raise FrameError('frame is ' + str(len(frame)) + ' bytes')
+    body = bytes(frame[:BODY.size])
+    if CRC.unpack(frame[BODY.size:])[0] != crc16(body):
+        raise FrameError('bad crc')
+    sync, version, seq, command, pin, a, b = BODY.unpack(body)
+    if sync != SYNC or version != VERSION:
+        raise FrameError('bad header')
+    return seq, command.decode(errors='replace'), pin, a, b
+
+
+class FrameReader():
+    def __init__(self):
+        """
+        Splits a byte stream into frames. Garbage and corrupted frames are
+        skipped a byte at a time until the stream lines up on a good frame again
+        """
+        self.buffer = bytearray()
+        self.errors = 0
+
+    def feed(self, data):
+        self.buffer.extend(data)
+        frames = []
+        while True:
+            start = self.buffer.find(SYNC)
+            if start < 0:
+                self.buffer.clear()
+                break
+            if start:
+                del self.buffer[:start]
+            if len(self.buffer) < FRAME_SIZE:
+                break
+            try:
+                frames.append(unpack(self.buffer[:FRAME_SIZE]))
+                del self.buffer[:FRAME_SIZE]
+            except FrameError:
+                self.errors += 1
+                del self.buffer[:1]
+        return frames
@@ -0,0 +1,254 @@
+"""
+Declarative test recipes
+
+A recipe is a JSON (or, with PyYAML installed, YAML) file under recipes/
+listing the steps of a test:
+
+    {"move": 25, "speed": 25, "phase": "approach 25%"}
+        move the platen to 25 % of the sample thickness at 25 % speed. Targets
+        are measured from where the test started, on the sample's surface
+        (see core.approach_steps), not from the last move: the firmware's
+        moves are relative, so the old support routine's 0.25 and then 0.4
+        times the thickness ended at 65 %, which is why support.json moves
+        to 65
+    {"dwell": 5, "until": "settled", "phase": "dwell 25%"}
+        hold for at most 5 s, or until the force settles; "until": "time"
+        always holds the full time
+    {"sample": "f25", "phase": "dwell 25%", "tail": 1.0, "estimator": "median"}
+        the force over the last `tail` s of a phase (default: the last
+        dwell), named for use in results. It is the mean of the readings
+        unless another estimator (see estimators.py) is named
+    {"result": "support", "test_name": "support factor (N/N)", "value": "f65 / f25"}
+        a result, computed from the samples with + - * / and parentheses,
+        and its uncertainty from theirs
+
+plan() turns a recipe and a thickness into Steps. The move and dwell steps
+of a plan can be uploaded to firmware that runs sequences (protocol
+version 2) in one transmission as program ops, so the rig runs the test
+without a host round trip per step. The sample and result steps are
+worked out on the host from the streamed curve.
+"""
+import ast
+import glob
+import json
+import operator
+import os
+
+import estimators
+
+recipe_root = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'recipes')
+sequence_version = 2
+program_capacity = 32
+default_retract = 10
+
+# program ops, sent as the pin of a 'QA' command: 'QA<op>:<a>:<b>'
+op_extend = 1
+op_retract = 2
+op_dwell = 3
+op_settle = 4
+
+extend = 11
+retract = 10
+
+operators = {ast.Add: operator.add, ast.Sub: operator.sub,
+    ast.Mult: operator.mul, ast.Div: operator.truediv}
+
+
+class RecipeError(ValueError):
+    pass
+
+
+class Step():
+    def __init__(self, kind, phase=None, **fields):
+        """
+        One planned step. Moves carry the pin, distance (mm), target (mm
+        from where the test started) and PWM value, dwells the seconds and
+        whether they end on settling, samples the name, tail and estimator,
+        and results the key, test name and expression
+        """
+        self.kind = kind
+        self.phase = phase
+        self.__dict__.update(fields)
+
+    @property
+    def motion(self):
+        return self.kind in ('move', 'dwell')
+
+    def op(self, settle_rate):
+        """
+        Returns the (op, a, b) program op for a move or dwell
+        """
+        if self.kind == 'move':
+            return (op_extend if self.pin == extend else op_retract, self.distance, self.pwm)
+        if self.until == 'settled':
+            return (op_settle, self.seconds, settle_rate)
+        return (op_dwell, self.seconds, 0.0)
+
+    def evaluate(self, samples):
+        return evaluate(self.tree, samples)
+
+    def uncertainty(self, samples, uncertainties):
+        return uncertainty(self.tree, samples, uncertainties)
+
+
+class Recipe():
+    def __init__(self, name, steps, order=0, retract=default_retract, path=None):
+        self.name = name
+        self.steps = steps
+        self.order = order
+        self.retract = retract
+        self.path = path
+
+    def results(self):
+        """
+        Returns {result key: test_name} for the results the recipe produces
+        """
+        return {step['result']: step.get('test_name', step['result'])
+            for step in self.steps if 'result' in step}
+
+    def plan(self, thickness):
+        return plan(self, thickness)
+
+
+def evaluate(tree, samples):
+    if isinstance(tree, ast.Expression):
+        return evaluate(tree.body, samples)
+    if isinstance(tree, ast.Constant) and isinstance(tree.value, (int, float)):
+        return float(tree.value)
+    if isinstance(tree, ast.Name):
+        if samples.get(tree.id) is None:
+            raise ValueError('no reading for ' + tree.id)
+        return float(samples[tree.id])
+    if isinstance(tree, ast.UnaryOp) and isinstance(tree.op, ast.USub):
+        return -evaluate(tree.operand, samples)
+    if isinstance(tree, ast.BinOp) and type(tree.op) in operators:
+        try:
+            return operators[type(tree.op)](evaluate(tree.left, samples), evaluate(tree.right, samples))
+        except ZeroDivisionError:
+            raise ValueError('division by a zero reading')
+    raise RecipeError('unsupported expression')
+
+
+def uncertainty(tree, samples, uncertainties):
+    """
+    First order uncertainty of a result from its samples' uncertainties,
+    or None if none of them is known
+    """
+    value = evaluate(tree, samples)
+    total = None
+    for name, spread in uncertainties.items():
+        if spread is None or samples.get(name) is None:
+            continue
+        shifted = evaluate(tree, dict(samples, **{name: samples[name] + spread}))
+        total = (total or 0.0) + (shifted - value)**2
+    return None if total is None else total**0.5
+
+
+def parse(expression, names):
+    """
+    Parses a result expression, checking it only uses arithmetic and
+    samples taken earlier in the recipe
+    """
+    try:
+        tree = ast.parse(str(expression), mode='eval')
+    except SyntaxError:
+        raise RecipeError('bad expression ' + repr(expression))
+    for node in ast.walk(tree):
+        if isinstance(node, ast.Name) and node.id not in names:
+            raise RecipeError(repr(node.id) + ' is not sampled before ' + repr(expression))
+        if not isinstance(node, (ast.Expression, ast.Constant, ast.Name, ast.Load,
+                ast.UnaryOp, ast.USub, ast.BinOp) + tuple(operators)):
+            raise RecipeError('unsupported expression ' + repr(expression))
+    return tree
+
+
+def plan(recipe, thickness):
+    """
+    Turns a recipe into Steps for a sample `thickness` mm thick, resolving
+    percentages to distances and checking every reference
+    """
+    steps = []
+    position = 0.0
+    samples = set()
+    dwell = None
+    for number, spec in enumerate(recipe.steps, 1):
+        where = recipe.name + ' step ' + str(number)
+        try:
+            if 'move' in spec:
+                target = float(spec['move'])/100*thickness
+                distance = target - position
+                speed = float(spec.get('speed', 100))
+                if not 0 < speed <= 100:
+                    raise RecipeError(where + ': speed must be 1-100 %')
+                if not distance:
+                    continue
+                steps.append(Step('move', spec.get('phase', 'move ' + str(spec['move']) + '%'),
+                    pin=extend if distance > 0 else retract, distance=abs(distance),
+                    target=target, pwm=speed/100*255))
+                position = target
+            elif 'dwell' in spec:
+                until = spec.get('until', 'settled')
+                if until not in ('settled', 'time'):
+                    raise RecipeError(where + ': until must be settled or time')
+                dwell = spec.get('phase', 'dwell ' + str(number))
+                steps.append(Step('dwell', dwell, seconds=float(spec['dwell']), until=until))
+            elif 'sample' in spec:
+                phase = spec.get('phase', dwell)
+                if phase is None:
+                    raise RecipeError(where + ': sample before any dwell')
+                estimator = spec.get('estimator', estimators.default_estimator)
+                if estimator not in estimators.estimators:
+                    raise RecipeError(where + ': estimator must be one of ' + ', '.join(estimators.estimators))
+                samples.add(spec['sample'])
+                steps.append(Step('sample', phase, name=spec['sample'],
+                    tail=float(spec.get('tail', 1.0)), estimator=estimator))
+            elif 'result' in spec:
+                steps.append(Step('result', key=spec['result'],
+                    test_name=spec.get('test_name', spec['result']),
+                    tree=parse(spec['value'], samples)))
+            else:
+                raise RecipeError(where + ': unknown step ' + json.dumps(spec))
+        except (KeyError, TypeError, ValueError) as error:
+            if isinstance(error, RecipeError):
+                raise
+            raise RecipeError(where + ': ' + repr(error))
+    if position < 0:
+        raise RecipeError(recipe.name + ' ends above where it started')
+    return steps
+
+
+def load(path):
+    with open(path) as file:
+        if path.endswith(('.yaml', '.yml')):
+            import yaml
+            try:
+                spec = yaml.safe_load(file)
+            except yaml.YAMLError as error:
+                raise RecipeError(str(error))
+        else:
+            spec = json.load(file)
+    if not isinstance(spec, dict) or not isinstance(spec.get('steps'), list):
+        raise RecipeError(path + ': a recipe needs a list of steps')
+    name = spec.get('name', os.path.splitext(os.path.basename(path))[0])
+    recipe = Recipe(name, spec['steps'], spec.get('order', 0),
+        float(spec.get('retract', default_retract)), path)
+    # catch mistakes when the recipe is loaded, not halfway through a test
+    recipe.plan(100.0)
+    return recipe
+
+
+def load_all(root=recipe_root, skipped=None):
+    """
+    Returns every recipe under `root` sorted by order, then name. Recipes
+    that don't load are skipped, and (path, error) for each is added to the
+    `skipped` list if one is given
+    """
+    recipes = []
+    for path in sorted(glob.glob(os.path.join(root, '*.json'))
+            + glob.glob(os.path.join(root, '*.yaml')) + glob.glob(os.path.join(root, '*.yml'))):
+        try:
+            recipes.append(load(path))
+        except (OSError, ValueError, ImportError) as error:
+            if skipped is not None:
+                skipped.append((path, str(error)))
+    return sorted(recipes, key=lambda recipe: (recipe.order, recipe.name))
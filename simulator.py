@@ -0,0 +1,644 @@
+"""
+Simulated UFT rig on a pseudo-terminal
+
+Stands in for the Arduino, the actuator and a foam sample so the host
+software can be run, benchmarked and stressed without the machine. The
+simulator opens a pty and speaks the same protocol as the firmware, ASCII
+commands first and the binary framing in protocol.py after a 'WB' switch,
+so Arduino(serial_port=sim.port) connects to it unchanged. Version 2
+firmware also runs uploaded programs of moves and dwells (see recipes.py):
+
+    python simulator.py --link /tmp/uft-sim
+    UFT_SERIAL_PORT=/tmp/uft-sim python UFT.py
+
+Like the real board it resets whenever the host opens the port and ignores
+input until it has booted. Behind the protocol sit a linear actuator with a
+speed limit and dead band, a load cell with noise and drift, and a foam
+modelled as a nonlinear spring in parallel with Maxwell elements (a
+generalised standard linear solid), which gives the force relaxation the
+dwell and support hold wait out. Faults can be injected at random rates or
+on demand.
+"""
+import argparse
+import collections
+import errno
+import math
+import os
+import random
+import re
+import select
+import sys
+import threading
+import time
+import tty
+
+import protocol
+
+tick = 0.005
+boot_time = 1.5
+sample_rate = 10
+baud_rate = 9600
+firmware_version = 2
+sequence_version = 2
+program_capacity = 32
+
+extend = 11
+retract = 10
+
+# move fault codes, 'MF:<code>:<position>' in ASCII and the MD frame's pin in binary
+fault_stopped = 1
+fault_limit = 2
+fault_stall = 3
+
+# program ops, the pin of a 'QA' command
+op_extend = 1
+op_retract = 2
+op_dwell = 3
+op_settle = 4
+
+# how the firmware judges a settled dwell, as SettleDetector does on the host
+settle_window = 1.0
+settle_tolerance = 0.002
+settle_contact = 2.0
+
+command_pattern = re.compile(rb'([A-Z]{2})(\d+):([-+0-9.:e]*)')
+
+
+class Foam():
+    def __init__(self, thickness=100.0, stiffness=1.2, hardening=6.0,
+            branches=((0.8, 2.0), (0.4, 20.0)), gap=0.0):
+        """
+        Force in N for an indentation in mm. The elastic part is
+        stiffness*d*(1 + hardening*(d/thickness)**2), so the foam stiffens as
+        it densifies. Each (stiffness N/mm, time constant s) branch adds a
+        Maxwell element that loads up while the platen moves and relaxes
+        while it holds. The platen has to travel `gap` mm before touching
+        """
+        self.thickness = thickness
+        self.stiffness = stiffness
+        self.hardening = hardening
+        self.branches = [tuple(branch) for branch in branches]
+        self.gap = gap
+        self.stress = [0.0]*len(self.branches)
+        self.depth = 0.0
+
+    def elastic(self, depth):
+        return self.stiffness*depth*(1 + self.hardening*(depth/self.thickness)**2)
+
+    def update(self, position, dt):
+        depth = max(position - self.gap, 0.0)
+        change = depth - self.depth
+        self.depth = depth
+        if not depth:
+            # off the sample, the foam recovers freely
+            self.stress = [0.0]*len(self.branches)
+            return 0.0
+        for index, (stiffness, tau) in enumerate(self.branches):
+            stress = self.stress[index] + stiffness*change
+            self.stress[index] = stress*math.exp(-dt/tau)
+        return max(self.elastic(depth) + sum(self.stress), 0.0)
+
+
+class Actuator():
+    def __init__(self, max_speed=20.0, deadband=10.0, stroke=150.0):
+        """
+        Linear actuator driven by an 8 bit PWM value. Speed scales with PWM up
+        to max_speed mm/s, values at or below `deadband` don't move it, and
+        it can't travel past `stroke` mm. Retracting stops at the home switch
+        """
+        self.max_speed = max_speed
+        self.deadband = deadband
+        self.stroke = stroke
+        self.position = 0.0
+        self.target = None
+        self.speed = 0.0
+        self.started = None
+        self.stalled = False
+
+    def start(self, target, pwm):
+        pwm = min(max(pwm, 0.0), 255.0)
+        self.target = target
+        self.started = time.monotonic()
+        self.stalled = pwm <= self.deadband
+        self.speed = 0.0 if self.stalled else self.max_speed*pwm/255.0
+
+    def moving(self):
+        return self.target is not None
+
+    def stop(self):
+        self.target = None
+
+    def update(self, dt):
+        """
+        Advances the platen and returns None while moving, 0 once the target
+        is reached or a fault code if the move ended early
+        """
+        if self.target is None:
+            return None
+        if self.stalled:
+            if time.monotonic() - self.started > 1.0:
+                self.target = None
+                return fault_stall
+            return None
+        # a tick that began before the move started only moves it since then
+        step = self.speed*min(dt, time.monotonic() - self.started)
+        distance = self.target - self.position
+        if abs(distance) <= step:
+            self.position = self.target
+        else:
+            self.position += math.copysign(step, distance)
+        if self.position <= 0 and self.target < 0:
+            # the home switch ends a retract the same as reaching its target
+            self.position = 0.0
+            self.target = None
+            return 0
+        if self.position > self.stroke:
+            self.position = self.stroke
+            self.target = None
+            return fault_limit
+        if self.position == self.target:
+            self.target = None
+            return 0
+        return None
+
+
+class LoadCell():
+    def __init__(self, zero=84210.0, scale=1000.0, noise=0.03, drift=0.0,
+            bias=14.76, gain=1.0):
+        """
+        Raw reading is zero + load*gain*scale counts plus Gaussian noise of
+        `noise` N and a zero that wanders `drift` N/s. The firmware reports
+        (raw - tare)/scale + bias N, so `gain` is the error in its nominal
+        scale and the bias the constant the host removes when the rig is
+        uncalibrated
+        """
+        self.zero = zero
+        self.scale = scale
+        self.noise = noise
+        self.drift = drift
+        self.bias = bias
+        self.gain = gain
+        self.started = time.monotonic()
+
+    def raw(self, load):
+        wander = self.drift*(time.monotonic() - self.started)
+        return self.zero + (load*self.gain + wander + random.gauss(0.0, self.noise))*self.scale
+
+    def net(self, load, tare):
+        """
+        The tared load without the bias, which is what the firmware's force
+        stop compares against its limit
+        """
+        return (self.raw(load) - tare)/self.scale
+
+    def force(self, load, tare):
+        return self.net(load, tare) + self.bias
+
+
+class Simulator():
+    def __init__(self, foam=None, actuator=None, cell=None, version=firmware_version,
+            sample_rate=sample_rate, baud_rate=baud_rate, boot_time=boot_time,
+            drop_rate=0.0, corrupt_rate=0.0, stall_rate=0.0, link=None):
+        """
+        `version` 0 behaves like the original firmware: no handshake, no
+        binary mode and no move done messages, and version 1 has those but
+        doesn't run programs. `baud_rate` throttles what the
+        board sends the way the real UART would (0 for no limit). The fault
+        rates are per reply (dropped), per binary frame sent (one byte
+        corrupted) and per move (the motor never reports done)
+        """
+        self.foam = foam if foam is not None else Foam()
+        self.actuator = actuator if actuator is not None else Actuator()
+        self.cell = cell if cell is not None else LoadCell()
+        self.version = version
+        self.sample_rate = sample_rate
+        self.baud_rate = baud_rate
+        self.boot_time = boot_time
+        self.drop_rate = drop_rate
+        self.corrupt_rate = corrupt_rate
+        self.stall_rate = stall_rate
+        self.link = link
+        self.lock = threading.RLock()
+        self.write_lock = threading.Lock()
+        self.master = None
+        self.port = None
+        self.running = False
+        self.connected = False
+        self.threads = []
+        self.load = 0.0
+        self.weight = 0.0
+        self.resets = 0
+        self.commands = 0
+        self.boot()
+
+    def boot(self):
+        """
+        Power-on state of the board. The actuator and the foam are physical
+        and keep where they are
+        """
+        with self.lock:
+            self.booted = time.monotonic() + self.boot_time
+            self.binary = False
+            self.streaming = False
+            self.stream_tare = 0.0
+            self.force_limit = None
+            self.force_tare = 0.0
+            self.move_started = None
+            self.move_stalled = False
+            self.calibrating = None
+            self.program = []
+            self.step = None
+            self.input = bytearray()
+            self.frames = protocol.FrameReader()
+            self.actuator.stop()
+
+    def start(self):
+        self.master, slave = os.openpty()
+        tty.setraw(slave)
+        self.port = os.ttyname(slave)
+        # only the host holds the slave side, so its closing shows up as EIO
+        os.close(slave)
+        os.set_blocking(self.master, False)
+        if self.link:
+            if os.path.lexists(self.link):
+                os.remove(self.link)
+            os.symlink(self.port, self.link)
+        self.running = True
+        for target in (self._serve, self._physics):
+            thread = threading.Thread(target=target, daemon=True)
+            thread.start()
+            self.threads.append(thread)
+        return self.port
+
+    def stop(self):
+        self.running = False
+        for thread in self.threads:
+            thread.join(1)
+        self.threads = []
+        if self.link and os.path.islink(self.link):
+            os.remove(self.link)
+        if self.master is not None:
+            os.close(self.master)
+            self.master = None
+
+    def inject(self, fault):
+        """
+        Triggers a fault now: 'reset' reboots the board, 'stall' makes the
+        current move hang and 'limit' ends it on the travel limit. 'weight
+        <N>' hangs a reference weight on the load cell, for calibrating
+        """
+        with self.lock:
+            if fault.startswith('weight '):
+                try:
+                    self.weight = float(fault.split()[1])
+                except (IndexError, ValueError):
+                    raise ValueError('weight takes a load in N')
+            elif fault == 'reset':
+                self.resets += 1
+                self.boot()
+            elif fault == 'stall':
+                self.move_stalled = True
+            elif fault == 'limit' and self.actuator.moving():
+                self.actuator.stop()
+                self._move_done(fault_limit)
+            else:
+                raise ValueError('unknown fault ' + repr(fault))
+
+    ########## output ##########
+    def _write(self, data):
+        with self.write_lock:
+            try:
+                os.write(self.master, data)
+            except OSError:
+                # host not listening or its buffer is full, the bytes are lost
+                return
+            if self.baud_rate:
+                time.sleep(len(data)*10/self.baud_rate)
+
+    def _line(self, text):
+        self._write(text.encode() + b'\r\n')
+
+    def _frame(self, seq, code, pin=0, a=0.0, b=0.0):
+        frame = bytearray(protocol.pack(seq, code, pin, a, b))
+        if self.corrupt_rate and random.random() < self.corrupt_rate:
+            frame[random.randrange(len(frame))] ^= 1 << random.randrange(8)
+        self._write(bytes(frame))
+
+    def _reply(self, seq, code, value):
+        if self.drop_rate and random.random() < self.drop_rate:
+            return
+        if self.binary:
+            self._frame(seq, code, 0, value, 0.0)
+        elif isinstance(value, int):
+            self._line(str(value))
+        else:
+            # Serial.println(float) prints two decimals
+            self._line('%.2f' % value)
+
+    def _move_done(self, fault):
+        if self.version < 1 or self.move_started is None:
+            return
+        elapsed = 1000*(time.monotonic() - self.move_started)
+        self.move_started = None
+        position = self.actuator.position
+        if self.binary:
+            self._frame(0, 'MD', fault, position, elapsed)
+        elif fault:
+            self._line('MF:' + str(fault) + ':' + '%.3f' % position)
+        else:
+            self._line('MD:' + '%.3f' % position + ':' + str(int(elapsed)))
+
+    ########## input ##########
+    def _serve(self):
+        while self.running:
+            try:
+                readable = select.select([self.master], [], [], 0.02)[0]
+            except (OSError, ValueError):
+                return
+            try:
+                data = os.read(self.master, 4096)
+            except BlockingIOError:
+                data = b''
+                if not readable and not self.connected:
+                    # the host opened the port, which resets the board
+                    self.connected = True
+                    self.resets += 1
+                    self.boot()
+            except OSError as error:
+                if error.errno != errno.EIO:
+                    raise
+                # nobody has the port open
+                self.connected = False
+                time.sleep(0.02)
+                continue
+            if time.monotonic() < self.booted:
+                # the bootloader drops whatever arrives while it runs
+                continue
+            with self.lock:
+                if self.binary and data.startswith(b'RV'):
+                    # the host closed and reopened the port too quickly to
+                    # see the hangup, but a real board would have reset while
+                    # the host waited for it, so it is back in ASCII by now
+                    self.resets += 1
+                    self.boot()
+                    self.booted = time.monotonic()
+                if self.binary:
+                    for seq, code, pin, a, b in self.frames.feed(data):
+                        self._command(seq, code, pin, [a, b])
+                else:
+                    self.input.extend(data)
+                    self._parse(idle=not data)
+
+    def _parse(self, idle):
+        """
+        ASCII commands aren't terminated, so one ends where the next begins or
+        once the line has been quiet for a read (Serial.parseInt's timeout)
+        """
+        while True:
+            match = command_pattern.search(self.input)
+            if match is None:
+                if idle:
+                    self.input.clear()
+                return
+            if match.end() == len(self.input) and not idle:
+                return
+            code, pin, fields = match.groups()
+            del self.input[:match.end()]
+            args = []
+            for arg in fields.decode().split(':'):
+                try:
+                    args.append(float(arg))
+                except ValueError:
+                    args.append(0.0)
+            self._command(0, code.decode(), int(pin), args)
+            if self.binary:
+                # anything after the switch is already framed
+                self.input.clear()
+                return
+
+    def _command(self, seq, code, pin, args):
+        self.commands += 1
+        args = (args + [0.0, 0.0])[:2]
+        if self.binary and code not in ('RF', 'RT', 'WF'):
+            # every framed request is acknowledged with its sequence id
+            self._reply(seq, code, 0.0)
+        if code == 'RV':
+            if self.version:
+                self._line('V:' + str(self.version))
+        elif code == 'WB':
+            if self.version >= protocol.VERSION and int(pin) == protocol.VERSION:
+                self._line('OK')
+                self.binary = True
+                self.frames = protocol.FrameReader()
+        elif code == 'RF':
+            self._reply(seq, code, self.cell.force(self.load, args[0]))
+        elif code == 'RT':
+            self._reply(seq, code, int(round(self.cell.raw(self.load))))
+        elif code == 'WF':
+            self.force_limit = args[0]
+            self.force_tare = args[1]
+            self._reply(seq, code, self.cell.force(self.load, args[1]))
+        elif code == 'WS':
+            if self.step is not None:
+                self.actuator.stop()
+                self._step_done(fault_stopped)
+            elif self.actuator.moving():
+                self.actuator.stop()
+                self._move_done(fault_stopped)
+        elif code == 'WH':
+            self._move(0.0, 255.0)
+        elif code == 'WG':
+            if pin == extend:
+                self._move(self.actuator.position + args[0], args[1])
+            elif pin == retract:
+                self._move(self.actuator.position - args[0], args[1])
+        elif code == 'RS' and self.version >= 1:
+            self.streaming = pin == 1
+            self.stream_tare = args[0]
+        elif code == 'WC':
+            self.calibrating = (time.monotonic(), args[0], 0)
+        elif code == 'QC' and self.version >= sequence_version:
+            self.program = []
+            self.step = None
+        elif code == 'QA' and self.version >= sequence_version:
+            if len(self.program) < program_capacity:
+                self.program.append((int(pin), args[0], args[1]))
+        elif code == 'QR' and self.version >= sequence_version:
+            if self.program:
+                self._start_step(0)
+
+    ########## programs ##########
+    def _start_step(self, index):
+        """
+        Starts step `index` of the uploaded program. Its state is (index,
+        start time, force history for settling)
+        """
+        op, a, b = self.program[index]
+        self.step = (index, time.monotonic(), collections.deque())
+        if op == op_extend:
+            self.actuator.start(self.actuator.position + a, b)
+        elif op == op_retract:
+            self.actuator.start(self.actuator.position - a, b)
+
+    def _step_done(self, fault):
+        index, started, history = self.step
+        elapsed = 1000*(time.monotonic() - started)
+        position = self.actuator.position
+        if self.binary:
+            if fault:
+                self._frame(0, 'QF', index, position, fault)
+            else:
+                self._frame(0, 'QD', index, position, elapsed)
+        elif fault:
+            self._line('QF:' + str(index) + ':' + str(fault) + ':' + '%.3f' % position)
+        else:
+            self._line('QD:' + str(index) + ':' + '%.3f' % position + ':' + str(int(elapsed)))
+        if fault or index + 1 == len(self.program):
+            self.step = None
+            self.program = []
+        else:
+            self._start_step(index + 1)
+
+    def _run_step(self, now, done):
+        """
+        Advances the running program by one physics tick. `done` is what the
+        actuator reported for this tick
+        """
+        index, started, history = self.step
+        op, a, b = self.program[index]
+        if op in (op_extend, op_retract):
+            if done is not None:
+                self._step_done(done)
+        elif op == op_dwell:
+            if now - started >= a:
+                self._step_done(0)
+        elif op == op_settle:
+            history.append((now, (self.cell.raw(self.load) - self.cell.zero)/self.cell.scale))
+            while history and history[0][0] < now - settle_window:
+                history.popleft()
+            if now - started >= a or (now - started >= settle_window and self._settled(history, b)):
+                self._step_done(0)
+        else:
+            self._step_done(fault_stall)
+
+    def _settled(self, history, rate):
+        """
+        True once the force trend over the window is flat, see SettleDetector
+        """
+        count = len(history)
+        if count < 3:
+            return False
+        mean_t = sum(t for t, force in history)/count
+        mean_f = sum(force for t, force in history)/count
+        if abs(mean_f) < settle_contact:
+            return False
+        spread = sum((t - mean_t)**2 for t, force in history)
+        slope = sum((t - mean_t)*(force - mean_f) for t, force in history)/spread
+        return abs(slope) <= rate or abs(slope) <= settle_tolerance*abs(mean_f)
+
+    def _move(self, target, pwm):
+        if self.actuator.moving():
+            self._move_done(fault_stopped)
+        self.actuator.start(target, pwm)
+        self.move_started = time.monotonic()
+        self.move_stalled = bool(self.stall_rate) and random.random() < self.stall_rate
+
+    ########## physics ##########
+    def _physics(self):
+        last = time.monotonic()
+        next_sample = last
+        while self.running:
+            time.sleep(tick)
+            now = time.monotonic()
+            dt = now - last
+            last = now
+            with self.lock:
+                done = None
+                if not self.move_stalled:
+                    done = self.actuator.update(dt)
+                    if done is not None and self.step is None:
+                        self._move_done(done)
+                if self.step is not None:
+                    self._run_step(now, done)
+                self.load = self.foam.update(self.actuator.position, dt) + self.weight
+                if (self.force_limit is not None and self.actuator.moving()
+                        and self.cell.net(self.load, self.force_tare) >= self.force_limit):
+                    # the force stop ends the move where it is, as a normal finish
+                    self.actuator.stop()
+                    if self.step is not None:
+                        self._step_done(0)
+                    else:
+                        self._move_done(0)
+                    self.force_limit = None
+                if self.calibrating is not None:
+                    self._calibrate(now)
+                stream = self.streaming and now >= next_sample and now >= self.booted
+            if stream:
+                force = self.cell.force(self.load, self.stream_tare)
+                stamp = int(1000*now) % 100000000
+                if self.binary:
+                    self._frame(0, 'SF', 0, stamp, force)
+                else:
+                    self._line('S:' + str(stamp) + ':' + '%.2f' % force)
+                next_sample = max(next_sample + 1/self.sample_rate, now)
+
+    def _calibrate(self, now):
+        """
+        The calibration routine reports 15 raw readings, 0.2 s apart
+        """
+        started, spring, sent = self.calibrating
+        if now - started < 0.2*(sent + 1):
+            return
+        raw = self.cell.raw(self.load + spring)
+        if self.binary:
+            self._frame(0, 'CL', 0, sent + 1, raw)
+        else:
+            self._line('CL:' + str(sent + 1) + ':' + '%.0f' % raw)
+        self.calibrating = (started, spring, sent + 1) if sent + 1 < 15 else None
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Simulated UFT rig on a pseudo-terminal')
+    parser.add_argument('--link', help='also expose the port at this path')
+    parser.add_argument('--version', type=int, default=firmware_version,
+        help='firmware protocol version, 0 for the original ASCII-only firmware, 1 without programs')
+    parser.add_argument('--thickness', type=float, default=100.0, help='foam thickness in mm')
+    parser.add_argument('--stiffness', type=float, default=1.2, help='foam stiffness in N/mm')
+    parser.add_argument('--gap', type=float, default=0.0, help='travel before contact in mm')
+    parser.add_argument('--max-speed', type=float, default=20.0, help='actuator speed at full PWM in mm/s')
+    parser.add_argument('--noise', type=float, default=0.03, help='load cell noise in N')
+    parser.add_argument('--drift', type=float, default=0.0, help='load cell zero drift in N/s')
+    parser.add_argument('--gain', type=float, default=1.0,
+        help='load cell sensitivity over what the firmware assumes, 1 for none')
+    parser.add_argument('--sample-rate', type=float, default=sample_rate, help='streamed samples per s')
+    parser.add_argument('--baud', type=int, default=baud_rate, help='UART speed to emulate, 0 for none')
+    parser.add_argument('--boot-time', type=float, default=boot_time, help='s the board is deaf after a reset')
+    parser.add_argument('--drop-rate', type=float, default=0.0, help='fraction of replies lost')
+    parser.add_argument('--corrupt-rate', type=float, default=0.0, help='fraction of binary frames corrupted')
+    parser.add_argument('--stall-rate', type=float, default=0.0, help='fraction of moves that never finish')
+    args = parser.parse_args(argv)
+    sim = Simulator(Foam(args.thickness, args.stiffness, gap=args.gap),
+        Actuator(args.max_speed), LoadCell(noise=args.noise, drift=args.drift, gain=args.gain),
+        args.version, args.sample_rate, args.baud, args.boot_time,
+        args.drop_rate, args.corrupt_rate, args.stall_rate, args.link)
+    port = sim.start()
+    print('simulated rig on ' + port + (' (' + args.link + ')' if args.link else ''))
+    print("type reset, stall or limit to inject a fault, weight <N> to load the cell, Ctrl+D to quit")
+    sys.stdout.flush()
+    try:
+        for line in sys.stdin:
+            fault = line.strip()
+            if not fault:
+                continue
+            try:
+                sim.inject(fault)
+            except ValueError as error:
+                print(error)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        sim.stop()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,56 @@
+"""
+Unit tests of the binary framing
+
+    python -m pytest test_protocol.py
+"""
+import pytest
+
+import protocol
+
+
+def test_crc_matches_ccitt_false():
+    # the standard check value for '123456789'
+    assert protocol.crc16(b'123456789') == 0x29B1
+
+
+def test_frame_round_trip():
+    frame = protocol.pack(7, 'WG', 11, 25.5, 63.75)
+    assert len(frame) == protocol.FRAME_SIZE
+    assert protocol.unpack(frame) == (7, 'WG', 11, 25.5, 63.75)
+
+
+def test_corrupted_frame_is_rejected():
+    frame = bytearray(protocol.pack(1, 'RF', 0, 1.0, 2.0))
+    frame[8] ^= 0x01
+    with pytest.raises(protocol.FrameError):
+        protocol.unpack(frame)
+
+
+def test_reader_joins_a_frame_split_across_reads():
+    frame = protocol.pack(3, 'SF', 0, 1234.0, 5.5)
+    reader = protocol.FrameReader()
+    assert reader.feed(frame[:5]) == []
+    assert reader.feed(frame[5:11]) == []
+    assert reader.feed(frame[11:]) == [(3, 'SF', 0, 1234.0, 5.5)]
+    assert reader.errors == 0
+
+
+def test_reader_resyncs_after_garbage_and_a_corrupted_frame():
+    good = protocol.pack(1, 'MD', 0, 12.5, 800.0)
+    bad = bytearray(protocol.pack(2, 'SF', 0, 1.0, 2.0))
+    bad[-1] ^= 0xFF
+    reader = protocol.FrameReader()
+    # line noise with a stray sync byte, a frame with a bad CRC, then a good one
+    frames = reader.feed(b'\x00\x13' + bytes([protocol.SYNC]) + b'xy' + bytes(bad) + good)
+    assert frames == [(1, 'MD', 0, 12.5, 800.0)]
+    assert reader.errors >= 1
+    assert not reader.buffer
+
+
+def test_reader_keeps_a_partial_frame_after_a_corrupted_one():
+    bad = bytearray(protocol.pack(4, 'SF', 0, 1.0, 2.0))
+    bad[10] ^= 0x10
+    good = protocol.pack(5, 'SF', 0, 3.0, 4.0)
+    reader = protocol.FrameReader()
+    assert reader.feed(bytes(bad) + good[:9]) == []
+    assert reader.feed(good[9:]) == [(5, 'SF', 0, 3.0, 4.0)]
@@ -0,0 +1,99 @@
+"""
+End to end tests of a test run against the simulated rig
+
+    python -m pytest test_simulator.py
+"""
+import os
+import time
+
+import pytest
+
+import core
+import recipes
+import simulator
+
+thickness = 20.0
+
+
+@pytest.fixture(params=[0, 1, simulator.firmware_version])
+def rig(request):
+    """
+    A simulated rig with a 20 mm foam and a tared session on it, from the
+    original firmware, from firmware the host drives one move at a time
+    and from firmware that runs programs
+    """
+    sim = simulator.Simulator(simulator.Foam(thickness), simulator.Actuator(max_speed=80.0),
+        version=request.param, boot_time=0.2)
+    port = sim.start()
+    session = core.ArduinoSession(port)
+    core.Run(core.home_steps, session).execute()
+    if session.tare.offset is None:
+        # homing only tares when the firmware says the platen got there
+        time.sleep(1.0)
+        session.retare()
+    yield sim, session
+    session.close()
+    sim.stop()
+
+
+def run(steps, session, *args):
+    results = {}
+    failure = core.Run(steps, session, *args,
+        result=lambda key, value, note: results.__setitem__(key, value)).execute()
+    return failure, results
+
+
+def test_force_stop_ends_the_approach_at_contact(rig):
+    sim, session = rig
+    failure, results = run(lambda job, session: core.approach_steps(job, session, session.require()), session)
+    if session.arduino.version < 1:
+        assert failure[0] == 'Motion Fault' and 'firmware version 0' in failure[1]
+        return
+    assert failure is None
+    # the platen stopped on the surface, not on the first tick or at the end of its travel
+    assert 0.5 < session.arduino.position < 5.0
+    assert core.default_forcestop <= sim.load < core.default_forcestop + 2.0
+
+
+def test_recipe_from_contact(rig):
+    sim, session = rig
+    recipe = recipes.load(os.path.join(recipes.recipe_root, 'firmness.json'))
+    failure, results = run(core.test_steps, session, recipe, thickness)
+    if session.arduino.version < 1:
+        # no reading taken mid move and passed off as a result
+        assert failure[0] == 'Motion Fault' and not results
+        return
+    assert failure is None
+    # 25 % of 20 mm into the foam, past the 2 N the approach stopped at
+    assert 8.0 < results['firmness'] < 25.0
+    assert session.settle.dwells[-1][0] == 'dwell 25%'
+
+
+def test_displacement_follows_the_platen_through_a_move(rig):
+    sim, session = rig
+    recipe = recipes.load(os.path.join(recipes.recipe_root, 'firmness.json'))
+    session.stream.trace.clear()
+    failure, results = run(core.test_steps, session, recipe, thickness)
+    if session.arduino.version < 1:
+        return
+    assert failure is None
+    rows, version = session.stream.trace.rows()
+    deepest = max(rows[:, 1])
+    # on the way in, not only the two ends the firmware reported
+    assert 1.0 < deepest < 10.0
+    assert len({round(position, 1) for position in rows[:, 1] if 1.0 < position < deepest - 0.5}) >= 3
+
+
+def test_home_tares_only_once_the_firmware_says_it_is_home():
+    # the original firmware never reports a move done
+    sim = simulator.Simulator(version=0, boot_time=0.2)
+    session = core.ArduinoSession(sim.start())
+    try:
+        failure, results = run(core.home_steps, session)
+        assert failure is None
+        assert 'tare' not in results
+        assert session.tare.offset is None
+        assert not session.tare.retracted
+    finally:
+        session.close()
+        sim.stop()
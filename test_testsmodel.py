@@ -0,0 +1,78 @@
+"""
+Unit tests of the Test Database tab's keyset paging, against the SQLite
+stand-in the benchmarks use
+
+    python -m pytest test_testsmodel.py
+"""
+import pytest
+
+import benchmark
+import testsmodel
+
+# results with ties and NULLs, so page boundaries land on both
+results = [5.0, 5.0, None, None, None, 3.0, None, 5.0, 1.0, None, 3.0]
+
+
+@pytest.fixture
+def stand_in():
+    database = benchmark.SqliteDatabase()
+    database.conn.executemany("INSERT INTO tests(sample_id, result) VALUES(?, ?)",
+        [('S' + str(index), result) for index, result in enumerate(results)])
+    database.conn.commit()
+    return database
+
+
+def page_through(model):
+    model.reset()
+    while model.canFetchMore():
+        model.fetchMore()
+    result, test_id = model.columns[model.names.index('result')], model.columns[model.names.index('test_id')]
+    return [(result[row], test_id[row]) for row in range(model.count)]
+
+
+def expected(descending):
+    # NULLs sort lowest, as in MySQL, and ties are broken on test_id
+    rows = [(result, test_id) for test_id, result in enumerate(results, 1)]
+    rows.sort(key=lambda row: (row[0] is not None, row[0] or 0.0, row[1]), reverse=descending)
+    return rows
+
+
+@pytest.mark.parametrize('descending', [True, False])
+@pytest.mark.parametrize('page_size', [1, 2, 3, 4])
+def test_pages_cover_every_row_once_in_order(stand_in, page_size, descending):
+    model = testsmodel.TestsModel(stand_in.connect, page_size=page_size)
+    model.sort_name = 'result'
+    model.descending = descending
+    assert page_through(model) == expected(descending)
+
+
+def test_page_boundary_on_a_null_sort_key_descending(stand_in):
+    model = testsmodel.TestsModel(stand_in.connect, page_size=7)
+    model.sort_name = 'result'
+    model.reset()
+    assert model.key(model.count - 1) == (None, 10)
+    model.fetchMore()
+    assert [model.key(row) for row in range(7, model.count)] == [(None, 7), (None, 5), (None, 4), (None, 3)]
+    assert not model.canFetchMore()
+
+
+def test_page_boundary_on_a_null_sort_key_ascending(stand_in):
+    model = testsmodel.TestsModel(stand_in.connect, page_size=2)
+    model.sort_name = 'result'
+    model.descending = False
+    model.reset()
+    assert model.key(model.count - 1) == (None, 4)
+    model.fetchMore()
+    model.fetchMore()
+    # the last NULL, then on to the values
+    assert [model.key(row) for row in range(2, model.count)] == [(None, 5), (None, 7), (None, 10), (1.0, 9)]
+
+
+def test_failed_page_stops_paging(stand_in):
+    model = testsmodel.TestsModel(stand_in.connect, page_size=2)
+    errors = []
+    model.unavailable.connect(errors.append)
+    model.reset()
+    stand_in.conn.execute('DROP TABLE tests')
+    model.fetchMore()
+    assert errors and not model.canFetchMore()
@@ -0,0 +1,364 @@
+"""
+Table model behind the Test Database tab
+
+Rows of the tests table are fetched a page at a time as the view scrolls
+(canFetchMore/fetchMore), using keyset pagination on the sort column and
+test_id so every page costs the same however deep the view has scrolled.
+Sorting and filtering run on the server, and reloading for them, like fetching
+rows the sync worker just wrote, happens on
+the thread pool. A query that fails emits unavailable rather than raising
+into the view. Fetched values are kept column by
+column, numeric columns in compact typed arrays, instead of as one
+QTableWidgetItem per cell.
+"""
+import array
+
+from PyQt5 import QtCore
+
+import database
+import metrics
+
+page_size = 500
+
+
+class Column():
+    def __init__(self):
+        """
+        Values of one column. Numbers go in an array.array, anything else (or
+        a column that turns out to hold NULLs or text) in a plain list
+        """
+        self.values = None
+
+    def storage(self, values):
+        present = [value for value in values if value is not None]
+        if not present or len(present) != len(values):
+            return []
+        if all(type(value) is int for value in present):
+            return array.array('q')
+        if all(type(value) in (int, float) for value in present):
+            return array.array('d')
+        return []
+
+    def extend(self, values):
+        if self.values is None:
+            self.values = self.storage(values)
+        if isinstance(self.values, array.array):
+            try:
+                values = array.array(self.values.typecode, values)
+            except (TypeError, OverflowError):
+                self.values = list(self.values)
+        self.values.extend(values)
+
+    def insert(self, row, value):
+        try:
+            self.values.insert(row, value)
+        except (TypeError, OverflowError):
+            self.values = list(self.values)
+            self.values.insert(row, value)
+
+    def __getitem__(self, row):
+        return self.values[row]
+
+    def __len__(self):
+        return 0 if self.values is None else len(self.values)
+
+
+class FetchSignals(QtCore.QObject):
+    done = QtCore.pyqtSignal(object, object, object)
+    failed = QtCore.pyqtSignal(str)
+
+
+class Fetch(QtCore.QRunnable):
+    def __init__(self, model, newer=None):
+        """
+        Loads a model's first page on the thread pool, or with `newer` only
+        the rows with a test_id above it
+        """
+        super().__init__()
+        self.model = model
+        self.newer = newer
+        self.signals = FetchSignals()
+
+    def run(self):
+        try:
+            if self.newer is None:
+                newest = self.model.newest()
+                names, rows = self.model.fetch()
+            else:
+                newest = None
+                names, rows = self.model.fetch(newer=self.newer)
+        except Exception as error:
+            # whatever the driver raises, the GUI thread decides what to show
+            self.signals.failed.emit(str(error))
+            return
+        self.signals.done.emit(newest, names, rows)
+
+
+class TestsModel(QtCore.QAbstractTableModel):
+    ready = QtCore.pyqtSignal()
+    unavailable = QtCore.pyqtSignal(str)
+
+    def __init__(self, connect=database.connect, page_size=page_size, parent=None):
+        """
+        `connect` returns a DB-API connection, borrowed from the pool by default
+        """
+        super().__init__(parent)
+        self.connect = connect
+        self.page_size = page_size
+        self.names = []
+        self.columns = []
+        self.count = 0
+        self.sort_name = 'test_date'
+        self.descending = True
+        self.filter_name = None
+        self.filter_text = ''
+        self.more = True
+        self.max_id = None
+        self.fetcher = None
+        self.new_ids = set()
+
+    def query(self, after=None, newer=None):
+        """
+        Builds the SELECT for the page following the row keyed `after`, or for
+        the rows with a test_id above `newer`
+        """
+        where = []
+        params = []
+        if newer is not None:
+            where.append('test_id > %s')
+            params.append(newer)
+        if self.filter_name and self.filter_text:
+            where.append('`' + self.filter_name + '` LIKE %s')
+            params.append('%' + self.filter_text + '%')
+        order = ' DESC' if self.descending else ' ASC'
+        compare = ' < ' if self.descending else ' > '
+        if after is not None:
+            column = '`' + self.sort_name + '`'
+            if self.sort_name == 'test_id':
+                where.append('test_id' + compare + '%s')
+                params.append(after[1])
+            elif after[0] is None:
+                # NULLs sort below every value, so they come last descending
+                # and first ascending, and compare to nothing with < or =
+                if self.descending:
+                    where.append('(' + column + ' IS NULL AND test_id < %s)')
+                else:
+                    where.append('(' + column + ' IS NOT NULL OR test_id > %s)')
+                params.append(after[1])
+            else:
+                where.append('(' + column + compare + '%s OR (' + column + ' = %s AND test_id'
+                    + compare + '%s)' + (' OR ' + column + ' IS NULL' if self.descending else '') + ')')
+                params.extend((after[0], after[0], after[1]))
+        query = 'select * from tests'
+        if where:
+            query += ' where ' + ' and '.join(where)
+        if self.sort_name != 'test_id':
+            query += ' order by `' + self.sort_name + '`' + order + ', test_id' + order
+        else:
+            query += ' order by test_id' + order
+        return query + ' limit ' + str(int(self.page_size)), params
+
+    def fetch(self, after=None, newer=None):
+        """
+        Runs one page query and returns (column names, rows)
+        """
+        query, params = self.query(after, newer)
+        with metrics.span('db', op='fetch_page'):
+            conn = self.connect()
+            try:
+                cursor = conn.cursor()
+                cursor.execute(query, params)
+                rows = cursor.fetchall()
+                names = [column[0] for column in cursor.description]
+                cursor.close()
+            finally:
+                conn.close()
+        return names, rows
+
+    def key(self, row):
+        return (self.columns[self.names.index(self.sort_name)][row],
+            self.columns[self.names.index('test_id')][row])
+
+    def append(self, names, rows):
+        if not self.names:
+            self.names = names
+            self.columns = [Column() for name in names]
+        with metrics.span('table_rebuild', kind='append'):
+            self.beginInsertRows(QtCore.QModelIndex(), self.count, self.count + len(rows) - 1)
+            for index, column in enumerate(self.columns):
+                column.extend([row[index] for row in rows])
+            self.count += len(rows)
+            self.endInsertRows()
+
+    def newest(self):
+        """
+        Returns the highest test_id in the table, a single index lookup
+        """
+        with metrics.span('db', op='newest'):
+            conn = self.connect()
+            try:
+                cursor = conn.cursor()
+                cursor.execute('select max(test_id) from tests')
+                newest = cursor.fetchall()[0][0]
+                cursor.close()
+            finally:
+                conn.close()
+        return newest
+
+    def position(self, key):
+        """
+        Returns the row a new row keyed `key` belongs at in the current order
+        """
+        low, high = 0, self.count
+        while low < high:
+            middle = (low + high)//2
+            if (self.key(middle) > key) == self.descending:
+                low = middle + 1
+            else:
+                high = middle
+        return low
+
+    def insert_new(self, test_ids):
+        """
+        Shows rows that were just written without reloading the table. Only
+        rows above the highest test_id already seen are fetched, and they are
+        slotted in locally if they are exactly the ones we wrote. Anything
+        else means another station wrote too, and the view is reloaded. The
+        query runs on the thread pool like reset_async(), and ids that come
+        in while it runs are fetched along with these
+        """
+        if not test_ids:
+            return
+        if self.max_id is None or not self.names or (self.fetcher is not None and self.fetcher.newer is None):
+            # a reload that may have queried before the write is superseded too
+            self.reset_async()
+            return
+        self.new_ids.update(test_ids)
+        self.start(Fetch(self, self.max_id), self.inserted)
+
+    def inserted(self, newest, names, rows):
+        self.fetcher = None
+        test_ids, self.new_ids = self.new_ids, set()
+        test_id = self.names.index('test_id')
+        if names != self.names or not {row[test_id] for row in rows} <= set(test_ids):
+            self.reset_async()
+            return
+        sort = self.names.index(self.sort_name)
+        with metrics.span('table_rebuild', kind='insert'):
+            for row in rows:
+                try:
+                    position = self.position((row[sort], row[test_id]))
+                except TypeError:
+                    self.reset_async()
+                    return
+                if position == self.count and self.more:
+                    # past what has been fetched, fetchMore will bring it in
+                    continue
+                self.beginInsertRows(QtCore.QModelIndex(), position, position)
+                for index, column in enumerate(self.columns):
+                    column.insert(position, row[index])
+                self.count += 1
+                self.endInsertRows()
+        self.max_id = max(test_ids)
+
+    def reset(self):
+        """
+        Drops everything fetched and loads the first page again
+        """
+        newest = self.newest()
+        names, rows = self.fetch()
+        self.load(names, rows)
+        self.max_id = newest if newest is not None else 0
+
+    def reset_async(self):
+        """
+        Like reset() but fetches on the thread pool and emits ready (or
+        unavailable) when done, so a slow or missing server never holds up
+        the GUI. A fetch still running is superseded, not waited for
+        """
+        self.start(Fetch(self), self.loaded)
+
+    def start(self, fetcher, done):
+        if self.fetcher is not None:
+            self.fetcher.signals.done.disconnect()
+            self.fetcher.signals.failed.disconnect()
+        self.fetcher = fetcher
+        self.fetcher.signals.done.connect(done)
+        self.fetcher.signals.failed.connect(self.failed)
+        QtCore.QThreadPool.globalInstance().start(self.fetcher)
+
+    def failed(self, error):
+        self.fetcher = None
+        self.new_ids = set()
+        self.unavailable.emit(error)
+
+    def loaded(self, newest, names, rows):
+        self.fetcher = None
+        self.new_ids = set()
+        self.load(names, rows)
+        self.max_id = newest if newest is not None else 0
+        self.ready.emit()
+
+    def load(self, names, rows):
+        with metrics.span('table_rebuild', kind='reset'):
+            self.beginResetModel()
+            self.names = names
+            self.columns = [Column() for name in names]
+            self.count = 0
+            self.endResetModel()
+        if rows:
+            self.append(names, rows)
+        self.more = len(rows) == self.page_size
+        if names:
+            self.headerDataChanged.emit(QtCore.Qt.Horizontal, 0, len(names) - 1)
+
+    def canFetchMore(self, parent=QtCore.QModelIndex()):
+        return not parent.isValid() and self.more and self.count > 0
+
+    def fetchMore(self, parent=QtCore.QModelIndex()):
+        try:
+            names, rows = self.fetch(self.key(self.count - 1))
+        except Exception as error:
+            # stop asking until the next reload
+            self.more = False
+            self.unavailable.emit(str(error))
+            return
+        if rows:
+            self.append(names, rows)
+        self.more = len(rows) == self.page_size
+
+    def rowCount(self, parent=QtCore.QModelIndex()):
+        return 0 if parent.isValid() else self.count
+
+    def columnCount(self, parent=QtCore.QModelIndex()):
+        return 0 if parent.isValid() else len(self.names)
+
+    def data(self, index, role=QtCore.Qt.DisplayRole):
+        if role != QtCore.Qt.DisplayRole or not index.isValid():
+            return None
+        value = self.columns[index.column()][index.row()]
+        return '' if value is None else str(value)
+
+    def headerData(self, section, orientation, role=QtCore.Qt.DisplayRole):
+        if role != QtCore.Qt.DisplayRole:
+            return None
+        if orientation == QtCore.Qt.Horizontal and section < len(self.names):
+            return self.names[section]
+        if orientation == QtCore.Qt.Vertical:
+            return section + 1
+        return None
+
+    def sort(self, column, order=QtCore.Qt.AscendingOrder):
+        if column < 0 or column >= len(self.names):
+            return
+        self.sort_name = self.names[column]
+        self.descending = order == QtCore.Qt.DescendingOrder
+        self.reset_async()
+
+    def set_filter(self, name, text):
+        """
+        Shows only rows whose `name` column contains `text`
+        """
+        self.filter_name = name if name in self.names else None
+        self.filter_text = text
+        self.reset_async()